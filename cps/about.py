@@ -31,7 +31,7 @@ from flask_babel import gettext as _
 
 from . import db, calibre_db, converter, uploader, constants, dep_check
 from .render_template import render_title_template
-from .usermanagement import user_login_required
+from .usermanagement import user_login_required, credential_cache
 
 
 about = flask.Blueprint('about', __name__)
@@ -77,9 +77,10 @@ def collect_stats():
 @about.route("/stats")
 @user_login_required
 def stats():
-    counter = calibre_db.session.query(db.Books).count()
-    authors = calibre_db.session.query(db.Authors).count()
-    categories = calibre_db.session.query(db.Tags).count()
-    series = calibre_db.session.query(db.Series).count()
-    return render_title_template('stats.html', bookcounter=counter, authorcounter=authors, versions=collect_stats(),
-                                 categorycounter=categories, seriecounter=series, title=_("Statistics"), page="stat")
+    counts = calibre_db.get_library_counts()
+    return render_title_template('stats.html', bookcounter=counts['books'], authorcounter=counts['authors'],
+                                 versions=collect_stats(), categorycounter=counts['categories'],
+                                 seriecounter=counts['series'],
+                                 db_connection_stats=db.CalibreDB.connection_stats(),
+                                 credential_stats=credential_cache.stats(),
+                                 title=_("Statistics"), page="stat")
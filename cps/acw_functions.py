@@ -281,7 +281,7 @@ def acw_stats_show():
     data_epub_fixer_with_fixes = acw_db.get_epub_fixer_history(fixes=True, verbose=False)
 
     return render_title_template("acw_stats.html", title=_("Autocaliweb Sever Stats & Archive"), page="acw-stats",
-                                acw_stats=get_acw_stats(),
+                                acw_stats=get_acw_stats(), ingest_status=acw_db.get_ingest_status(),
                                 data_enforcement=data_enforcement, headers_enforcement=headers["enforcement"]["no_paths"], 
                                 data_enforcement_with_paths=data_enforcement_with_paths,headers_enforcement_with_paths=headers["enforcement"]["with_paths"], 
                                 data_imports=data_imports, headers_import=headers["imports"],
@@ -289,6 +289,14 @@ def acw_stats_show():
                                 data_epub_fixer=data_epub_fixer, headers_epub_fixer=headers["epub_fixer"]["no_fixes"],
                                 data_epub_fixer_with_fixes=data_epub_fixer_with_fixes, headers_epub_fixer_with_fixes=headers["epub_fixer"]["with_fixes"])
                                     
+@acw_stats.route("/acw-stats-show/ingest-status", methods=["GET"])
+@login_required_if_no_ano
+@admin_required
+def show_ingest_status():
+    """Queue depth and stage timings of the ingest daemon"""
+    acw_db = ACW_DB()
+    return jsonify(acw_db.get_ingest_status() or {})
+
 @acw_stats.route("/acw-stats-show/full-enforcement", methods=["GET", "POST"])
 @login_required_if_no_ano
 @admin_required
@@ -521,6 +529,7 @@ def kill_convert_library(queue):
                 ...
             # Empty tmp conversion dir of half finished files
             empty_tmp_con_dir(get_tmp_conversion_dir())
+            shutil.rmtree(os.path.join(get_tmp_conversion_dir(), "convert-library"), ignore_errors=True)
             # Remove the trigger file that triggered this block
             try:
                 os.remove(trigger_file)
@@ -51,6 +51,7 @@ from .embed_helper import get_calibre_binarypath
 from .gdriveutils import is_gdrive_ready, gdrive_support
 from .render_template import render_title_template, get_sidebar_config
 from .services.worker import WorkerThread
+from .tasks.kepub import kepub_backlog
 from .usermanagement import user_login_required
 from .cw_babel import get_available_translations, get_available_locale, get_user_locale_language
 from . import debug_info
@@ -1741,6 +1742,15 @@ def cancel_task():
     return ""
 
 
+@admi.route("/ajax/kepub_backlog")
+@user_login_required
+@admin_required
+def kepub_backlog_status():
+    response = make_response(json.dumps(kepub_backlog.stats))
+    response.headers["Content-Type"] = "application/json; charset=utf-8"
+    return response
+
+
 def _db_simulate_change():
     param = request.form.to_dict()
     to_save = dict()
@@ -1809,6 +1819,7 @@ def _db_configuration_update_helper():
             ub.session.query(ub.KoboSyncedBooks).delete()
             helper.delete_thumbnail_cache()
             ub.session_commit()
+            calibre_db.invalidate_filters()
             # deleted visibilities based on custom column and tags
             config.config_restricted_column = 0
             config.config_denied_tags = ""
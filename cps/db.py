@@ -19,7 +19,15 @@
 
 import os
 import re
+import sqlite3
 import json
+import base64
+import binascii
+import string
+import threading
+import zlib
+from collections import OrderedDict
+from itertools import chain, groupby
 from datetime import datetime, timezone
 from urllib.parse import quote
 import unidecode
@@ -27,11 +35,12 @@ import unidecode
 from uuid import uuid4
 
 from sqlite3 import OperationalError as sqliteOperationalError
-from sqlalchemy import create_engine
-from sqlalchemy import Table, Column, ForeignKey, CheckConstraint
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy import Table, Column, ForeignKey, CheckConstraint, MetaData
 from sqlalchemy import String, Integer, Boolean, TIMESTAMP, Float
-from sqlalchemy.orm import relationship, sessionmaker, scoped_session
+from sqlalchemy.orm import relationship, sessionmaker, scoped_session, aliased, Session
 from sqlalchemy.orm.collections import InstrumentedList
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.ext.declarative import DeclarativeMeta
 from sqlalchemy.exc import OperationalError
 try:
@@ -39,13 +48,15 @@ try:
     from sqlalchemy.orm import declarative_base
 except ImportError:
     from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.pool import StaticPool
-from sqlalchemy.sql.expression import and_, true, false, text, func, or_
+from sqlalchemy.pool import StaticPool, QueuePool
+from sqlalchemy.sql.expression import and_, true, false, text, func, or_, exists, type_coerce, UnaryExpression
+from sqlalchemy.sql.expression import select, insert
+from sqlalchemy.sql import operators
 from sqlalchemy.ext.associationproxy import association_proxy
 from .cw_login import current_user
 from flask_babel import gettext as _
 from flask_babel import get_locale
-from flask import flash, g, Flask
+from flask import flash, g, Flask, has_app_context
 
 from . import logger, ub, isoLanguages
 from .pagination import Pagination
@@ -54,6 +65,13 @@ from .string_helper import strip_whitespaces
 log = logger.create()
 
 cc_exceptions = ['composite', 'series']
+# Stay well below sqlite's limit of host parameters per statement
+SQL_PARAMETER_CHUNK = 500
+_NOCASE_TABLE = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+COUNT_CACHE_SIZE = 256
+# Shortest term the trigram tokenizer of the search index can match
+SEARCH_INDEX_MIN_TERM = 3
+SEARCH_INDEX_COLUMNS = ['title', 'authors', 'tags', 'series', 'publishers', 'custom']
 cc_classes = {}
 
 Base = declarative_base()
@@ -88,6 +106,15 @@ books_publishers_link = Table('books_publishers_link', Base.metadata,
                               Column('publisher', Integer, ForeignKey('publishers.id'), primary_key=True)
                               )
 
+# FTS5 table in app.db holding the lowercased and unidecoded metadata of each book with the book id as rowid,
+# the hidden column named like the table is the one to match against
+book_search = Table('book_search', MetaData(),
+                    Column('rowid', Integer, primary_key=True),
+                    Column('book_search', String),
+                    *[Column(name, String) for name in SEARCH_INDEX_COLUMNS],
+                    Column('last_modified', String)
+                    )
+
 
 class Library_Id(Base):
     __tablename__ = 'library_id'
@@ -543,6 +570,31 @@ class CalibreDB:
     config = None
     config_calibre_dir = None
     app_db_path = None
+    # Process wide engine with a bounded pool of connections which have calibre and app database attached,
+    # shared by all requests and worker threads, replaced as a whole on reconnect
+    engine = None
+    session_factory = None
+    pool_size = 5
+    pool_max_overflow = 10
+    pool_timeout = 30
+    _engine_lock = threading.Lock()
+    _pool_stats = {"connects": 0, "checkouts": 0}
+    # Changes whenever books get archived or unarchived
+    archive_version = 0
+    # Changes whenever shelves, read states or archived books in app.db are committed
+    app_db_version = 0
+    # Changes whenever downloads are committed, only the lists of downloaded books depend on it
+    downloads_version = 0
+    # Total number of books of paginated queries, valid as long as metadata.db and the app.db versions are unchanged
+    _count_cache = OrderedDict()
+    _count_cache_lock = threading.Lock()
+    # Library stamp and number of books, authors, tags and series in the whole library
+    _library_counts = None
+    # Library stamp and searchable custom columns the search index was last brought up to date with,
+    # False once sqlite turned out to lack FTS5 with the trigram tokenizer
+    search_index_state = None
+    search_index_available = None
+    _search_index_lock = threading.Lock()
 
     def __init__(self, _app: Flask=None):  # , expire_on_commit=True, init=False):
         """ Initialize a new CalibreDB session
@@ -655,6 +707,7 @@ class CalibreDB:
     def teardown(self, exception):
         ctx = g.get("lib_sql")
         if ctx:
+            # returns the connection to the pool
             ctx.close()
 
     @property
@@ -672,7 +725,39 @@ class CalibreDB:
 
 
     def connect(self):
-        return self.setup_db(self.config_calibre_dir, self.app_db_path)
+        session_factory = self.session_factory
+        if session_factory is None:
+            return self.setup_db(self.config_calibre_dir, self.app_db_path)
+        return scoped_session(session_factory)
+
+    @classmethod
+    def _create_engine(cls, dbpath, app_db_path):
+        engine = create_engine('sqlite://',
+                               echo=False,
+                               isolation_level="SERIALIZABLE",
+                               connect_args={'check_same_thread': False},
+                               poolclass=QueuePool,
+                               pool_size=cls.pool_size,
+                               max_overflow=cls.pool_max_overflow,
+                               pool_timeout=cls.pool_timeout)
+
+        @event.listens_for(engine, "connect")
+        def attach_databases(dbapi_connection, __):
+            # Runs once per physical connection, the page cache survives as long as the connection is pooled
+            cursor = dbapi_connection.cursor()
+            try:
+                cursor.execute('PRAGMA cache_size = 10000;')
+                cursor.execute("attach database '{}' as calibre;".format(dbpath))
+                cursor.execute("attach database '{}' as app_settings;".format(app_db_path))
+            finally:
+                cursor.close()
+            cls._pool_stats["connects"] += 1
+
+        @event.listens_for(engine, "checkout")
+        def count_checkout(__, ___, ____):
+            cls._pool_stats["checkouts"] += 1
+
+        return engine
 
     @classmethod
     def setup_db(cls, config_calibre_dir, app_db_path):
@@ -686,36 +771,73 @@ class CalibreDB:
             cls.config.invalidate()
             return None
 
-        try:
-            engine = create_engine('sqlite://',
-                                       echo=False,
-                                       isolation_level="SERIALIZABLE",
-                                       connect_args={'check_same_thread': False},
-                                       poolclass=StaticPool)
-            with engine.begin() as connection:
-                connection.execute(text('PRAGMA cache_size = 10000;'))
-                connection.execute(text("attach database '{}' as calibre;".format(dbpath)))
-                connection.execute(text("attach database '{}' as app_settings;".format(app_db_path)))
-
-            conn = engine.connect()
-            # conn.text_factory = lambda b: b.decode(errors = 'ignore') possible fix for #1302
-        except Exception as ex:
-            cls.config.invalidate(ex)
-            return None
+        with cls._engine_lock:
+            try:
+                engine = cls._create_engine(dbpath, app_db_path)
+                conn = engine.connect()
+                # conn.text_factory = lambda b: b.decode(errors = 'ignore') possible fix for #1302
+            except Exception as ex:
+                cls.config.invalidate(ex)
+                return None
 
-        cls.config.db_configured = True
+            cls.config.db_configured = True
 
-        if not cc_classes:
             try:
-                cc = conn.execute(text("SELECT id, datatype FROM custom_columns"))
-                cls.setup_db_cc_classes(cc)
-            except OperationalError as e:
-                log.error_or_exception(e)
-                return None
+                if not cc_classes:
+                    try:
+                        cc = conn.execute(text("SELECT id, datatype FROM custom_columns"))
+                        cls.setup_db_cc_classes(cc)
+                    except OperationalError as e:
+                        log.error_or_exception(e)
+                        engine.dispose()
+                        return None
+            finally:
+                conn.close()
+
+            # Swap the pool, sessions still bound to the old engine finish on it, idle connections are closed
+            old_engine = cls.engine
+            cls.engine = engine
+            cls.session_factory = sessionmaker(autocommit=False,
+                                               autoflush=False,
+                                               bind=engine, future=True)
+            if old_engine is not None:
+                old_engine.dispose()
+
+        return scoped_session(cls.session_factory)
 
-        return scoped_session(sessionmaker(autocommit=False,
-                                           autoflush=False,
-                                           bind=engine, future=True))
+    @classmethod
+    def get_library_stamp(cls):
+        """Returns a value which changes whenever metadata.db is written, by autocaliweb or by calibre"""
+        if not cls.config_calibre_dir:
+            return None
+        try:
+            stat = os.stat(os.path.join(cls.config_calibre_dir, "metadata.db"))
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    @classmethod
+    def dispose(cls):
+        with cls._engine_lock:
+            if cls.engine is not None:
+                cls.engine.dispose()
+            cls.engine = None
+            cls.session_factory = None
+
+    @classmethod
+    def connection_stats(cls):
+        connects = cls._pool_stats["connects"]
+        checkouts = cls._pool_stats["checkouts"]
+        stats = {"connects": connects,
+                 "checkouts": checkouts,
+                 "reused": max(checkouts - connects, 0),
+                 "reuse_ratio": round((checkouts - connects) / checkouts, 3) if checkouts > connects else 0.0,
+                 "pool_size": cls.pool_size,
+                 "checked_out": 0}
+        engine = cls.engine
+        if engine is not None:
+            stats["checked_out"] = engine.pool.checkedout()
+        return stats
 
 
     def get_book(self, book_id):
@@ -755,6 +877,12 @@ class CalibreDB:
         if not self.session.query(Metadata_Dirtied).filter(Metadata_Dirtied.book == book_id).one_or_none():
             self.session.add(Metadata_Dirtied(book_id))
 
+    def set_all_metadata_dirty(self):
+        """Marks every book in the library for metadata backup with a single statement"""
+        self.session.execute(insert(Metadata_Dirtied).from_select(
+            [Metadata_Dirtied.book],
+            select(Books.id).where(Books.id.notin_(select(Metadata_Dirtied.book)))))
+
     def delete_dirty_metadata(self, book_id):
         try:
             self.session.query(Metadata_Dirtied).filter(Metadata_Dirtied.book == book_id).delete()
@@ -763,15 +891,32 @@ class CalibreDB:
             self.session.rollback()
             log.error("Database error: {}".format(e))
 
-    # Language and content filters for displaying in the UI
+    @classmethod
+    def invalidate_filters(cls):
+        """Has to be called after archive states change, invalidates cached results based on common_filters"""
+        cls.archive_version += 1
+
+    def filter_signature(self, allow_show_archived=False, return_all_languages=False):
+        """Identifies the set of books visible for the current user with the given filter parameters"""
+        return (int(current_user.id), allow_show_archived, return_all_languages, self.archive_version,
+                current_user.filter_language(), current_user.denied_tags, current_user.allowed_tags,
+                self.config.config_restricted_column, current_user.denied_column_value,
+                current_user.allowed_column_value)
+
+    # Language and content filters for displaying in the UI, built once per request and filter settings
     def common_filters(self, allow_show_archived=False, return_all_languages=False):
+        signature = self.filter_signature(allow_show_archived, return_all_languages)
+        cached_filters = g.setdefault('common_filters', dict()) if has_app_context() else dict()
+        if signature not in cached_filters:
+            cached_filters[signature] = self._build_common_filters(allow_show_archived, return_all_languages)
+        return cached_filters[signature]
+
+    def _build_common_filters(self, allow_show_archived=False, return_all_languages=False):
         if not allow_show_archived:
-            archived_books = (ub.session.query(ub.ArchivedBook)
-                              .filter(ub.ArchivedBook.user_id==int(current_user.id))
-                              .filter(ub.ArchivedBook.is_archived==True)
-                              .all())
-            archived_book_ids = [archived_book.book_id for archived_book in archived_books]
-            archived_filter = Books.id.notin_(archived_book_ids)
+            archived_book = aliased(ub.ArchivedBook)
+            archived_filter = ~exists().where(and_(archived_book.book_id == Books.id,
+                                                   archived_book.user_id == int(current_user.id),
+                                                   archived_book.is_archived == True))
         else:
             archived_filter = true()
 
@@ -827,6 +972,22 @@ class CalibreDB:
         return query.outerjoin(ub.ArchivedBook, and_(Books.id == ub.ArchivedBook.book_id,
                                                      int(current_user.id) == ub.ArchivedBook.user_id))
 
+    def get_hot_books(self, offset, limit, order, config_read_column=0):
+        """Returns a page of the most downloaded books the current user may see, with their archived and read state, and
+        the total number of those books. The downloads are joined from app.db in the same query"""
+        query = (self.generate_linked_query(config_read_column, Books)
+                 .join(ub.Downloads, ub.Downloads.book_id == Books.id)
+                 .filter(self.common_filters())
+                 .group_by(Books.id))
+        entries = list()
+        total = 0
+        try:
+            total = self.cached_count(query, downloads=True)
+            entries = query.order_by(*order).order_by(Books.id).offset(offset).limit(limit).all()
+        except Exception as ex:
+            log.error_or_exception(ex)
+        return self.order_authors(entries, True, True), total
+
     @staticmethod
     def get_checkbox_sorted(inputlist, state, offset, limit, order, combo=False):
         outcome = list()
@@ -848,12 +1009,14 @@ class CalibreDB:
 
     # Fill indexpage with all requested data from database
     def fill_indexpage(self, page, pagesize, database, db_filter, order,
-                       join_archive_read=False, config_read_column=0, *join):
+                       join_archive_read=False, config_read_column=0, *join, seek=None):
         return self.fill_indexpage_with_archived_books(page, database, pagesize, db_filter, order, False,
-                                                       join_archive_read, config_read_column, *join)
+                                                       join_archive_read, config_read_column, *join, seek=seek)
 
+    # seek switches to keyset pagination if the order allows it: "" for the first page, afterwards the
+    # pagination.next_seek token of the previous page. Unknown tokens fall back to the offset of the page
     def fill_indexpage_with_archived_books(self, page, database, pagesize, db_filter, order, allow_show_archived,
-                                           join_archive_read, config_read_column, *join):
+                                           join_archive_read, config_read_column, *join, seek=None):
         pagesize = pagesize or self.config.config_books_per_page
         if current_user.show_detail_random():
             random_query = self.generate_linked_query(config_read_column, database)
@@ -885,45 +1048,99 @@ class CalibreDB:
                 element += 1
         query = query.filter(db_filter)\
             .filter(self.common_filters(allow_show_archived))
+        keyset = _keyset_columns(database, order) if seek is not None and not join else None
         entries = list()
         pagination = list()
         try:
-            pagination = Pagination(page, pagesize, query.count())
-            entries = query.order_by(*order).offset(off).limit(pagesize).all()
+            downloads = any(element is ub.Downloads for element in join)
+            pagination = Pagination(page, pagesize, self.cached_count(query, allow_show_archived, downloads))
+            if keyset:
+                query = query.order_by(*order).order_by(database.id)
+                after = _parse_seek_token(seek, keyset)
+                if after is not None:
+                    entries = query.filter(_keyset_after(keyset, database.id, after)).limit(pagesize).all()
+                else:
+                    entries = query.offset(off).limit(pagesize).all()
+                if entries:
+                    last = entries[-1][0] if join_archive_read else entries[-1]
+                    pagination.next_seek = self._seek_token(keyset, database, last.id)
+            else:
+                entries = query.order_by(*order).offset(off).limit(pagesize).all()
         except Exception as ex:
             log.error_or_exception(ex)
         # display authors in right order
         entries = self.order_authors(entries, True, join_archive_read)
         return entries, randm, pagination
 
+    def get_library_counts(self):
+        """Returns the number of books, authors, categories and series in the library, counted again only after
+        metadata.db changed"""
+        stamp = self.get_library_stamp()
+        cached = CalibreDB._library_counts
+        if stamp is not None and cached and cached[0] == stamp:
+            return dict(cached[1])
+        row = self.session.execute(select(select(func.count(Books.id)).scalar_subquery(),
+                                          select(func.count(Authors.id)).scalar_subquery(),
+                                          select(func.count(Tags.id)).scalar_subquery(),
+                                          select(func.count(Series.id)).scalar_subquery())).one()
+        counts = dict(zip(('books', 'authors', 'categories', 'series'), row))
+        if stamp is not None:
+            CalibreDB._library_counts = (stamp, counts)
+        return dict(counts)
+
+    def cached_count(self, query, allow_show_archived=False, downloads=False):
+        """Returns query.count(), cached per statement and filter signature of the current user. downloads marks
+        queries joining the downloads, their count changes with every download"""
+        stamp = self.get_library_stamp()
+        if stamp is None:
+            return query.count()
+        stamp = (stamp, CalibreDB.app_db_version, CalibreDB.downloads_version if downloads else None)
+        compiled = query.statement.compile()
+        key = (self.filter_signature(allow_show_archived), str(compiled), repr(sorted(compiled.params.items())))
+        with self._count_cache_lock:
+            cached = self._count_cache.get(key)
+            if cached and cached[0] == stamp:
+                self._count_cache.move_to_end(key)
+                return cached[1]
+        count = query.count()
+        with self._count_cache_lock:
+            self._count_cache[key] = (stamp, count)
+            self._count_cache.move_to_end(key)
+            while len(self._count_cache) > COUNT_CACHE_SIZE:
+                self._count_cache.popitem(last=False)
+        return count
+
+    def _seek_token(self, keyset, database, last_id):
+        # The raw stored values are used, as sqlite compares and sorts e.g. timestamps as text
+        values = self.session.query(*[type_coerce(column, String) for column, __ in keyset])\
+            .filter(database.id == last_id).one()
+        token = json.dumps([_keyset_signature(keyset), list(values) + [last_id]])
+        return base64.urlsafe_b64encode(token.encode('utf-8')).decode('ascii')
+
     # Orders all Authors in the list according to authors sort
     def order_authors(self, entries, list_return=False, combined=False):
-        for entry in entries:
-            if combined:
-                sort_authors = entry.Books.author_sort.split('&')
-                ids = [a.id for a in entry.Books.authors]
-
-            else:
-                sort_authors = entry.author_sort.split('&')
-                ids = [a.id for a in entry.authors]
+        books = [entry.Books if combined else entry for entry in entries]
+        self._load_book_authors(books)
+        known_sorts = self._known_author_sorts(books)
+        for entry, book in zip(entries, books):
+            sort_authors = book.author_sort.split('&')
+            book_authors = sorted(book.authors, key=lambda a: a.id or 0)
+            ids = [a.id for a in book_authors]
             authors_ordered = list()
             # error = False
             for auth in sort_authors:
                 auth = strip_whitespaces(auth)
-                results = self.session.query(Authors).filter(Authors.sort == auth).all()
                 # ToDo: How to handle not found author name
-                if not len(results):
-                    book_id = entry.id if isinstance(entry, Books) else entry[0].id
-                    log.error("Author '{}' of book {} not found to display name in right order".format(auth, book_id))
+                if _nocase(auth) not in known_sorts:
+                    log.error("Author '{}' of book {} not found to display name in right order".format(auth, book.id))
                     # error = True
                     break
-                for r in results:
-                    if r.id in ids:
+                for r in book_authors:
+                    if r.id in ids and r.sort is not None and _nocase(r.sort) == _nocase(auth):
                         authors_ordered.append(r)
                         ids.remove(r.id)
             for author_id in ids:
-                result = self.session.query(Authors).filter(Authors.id == author_id).first()
-                authors_ordered.append(result)
+                authors_ordered.append(next(a for a in book_authors if a.id == author_id))
 
             if list_return:
                 if combined:
@@ -934,6 +1151,31 @@ class CalibreDB:
                 return authors_ordered
         return entries
 
+    def _load_book_authors(self, books):
+        # Fill the not yet loaded authors relationship of all books with one query instead of one per book
+        unloaded = {book.id: book for book in books
+                    if book.id is not None and 'authors' not in inspect(book).dict}
+        if not unloaded:
+            return
+        authors = {book_id: [] for book_id in unloaded}
+        for book_ids in _chunks(list(unloaded), SQL_PARAMETER_CHUNK):
+            rows = (self.session.query(books_authors_link.c.book, Authors)
+                    .join(Authors, Authors.id == books_authors_link.c.author)
+                    .filter(books_authors_link.c.book.in_(book_ids))
+                    .order_by(Authors.id))
+            for book_id, author in rows:
+                authors[book_id].append(author)
+        for book_id, book in unloaded.items():
+            set_committed_value(book, 'authors', authors[book_id])
+
+    def _known_author_sorts(self, books):
+        sort_terms = {strip_whitespaces(auth) for book in books for auth in (book.author_sort or '').split('&')}
+        known_sorts = set()
+        for terms in _chunks(list(sort_terms), SQL_PARAMETER_CHUNK):
+            known_sorts.update(_nocase(row.sort) for row in
+                               self.session.query(Authors.sort).filter(Authors.sort.in_(terms)).distinct())
+        return known_sorts
+
     def get_typeahead(self, database, query, replace=('', ''), tag_filter=true()):
         query = query or ''
         self.create_functions()
@@ -959,10 +1201,6 @@ class CalibreDB:
         strip_whitespaces(term).lower()
         self.create_functions()
         # self.session.connection().connection.connection.create_function("lower", 1, lcase)
-        q = list()
-        author_terms = re.split("[, ]+", term)
-        for author_term in author_terms:
-            q.append(Books.authors.any(func.lower(Authors.name).ilike("%" + author_term + "%")))
         query = self.generate_linked_query(config.config_read_column, Books)
         if len(join) == 6:
             query = query.outerjoin(join[0], join[1]).outerjoin(join[2]).outerjoin(join[3], join[4]).outerjoin(join[5])
@@ -972,20 +1210,195 @@ class CalibreDB:
             query = query.outerjoin(join[0], join[1])
         elif len(join) == 1:
             query = query.outerjoin(join[0])
+        query = query.filter(self.common_filters(True))
 
-        cc = self.get_cc_columns(config, filter_config_custom_read=True)
+        matches = self.search_index_matches(term, config)
+        if matches is not None:
+            return query.filter(Books.id.in_(matches))
+
+        q = list()
+        author_terms = re.split("[, ]+", term)
+        for author_term in author_terms:
+            q.append(Books.authors.any(func.lower(Authors.name).ilike("%" + author_term + "%")))
         filter_expression = [Books.tags.any(func.lower(Tags.name).ilike("%" + term + "%")),
                              Books.series.any(func.lower(Series.name).ilike("%" + term + "%")),
                              Books.authors.any(and_(*q)),
                              Books.publishers.any(func.lower(Publishers.name).ilike("%" + term + "%")),
                              func.lower(Books.title).ilike("%" + term + "%")]
-        for c in cc:
-            if c.datatype not in ["datetime", "rating", "bool", "int", "float"]:
-                filter_expression.append(
-                    getattr(Books,
-                            'custom_column_' + str(c.id)).any(
-                        func.lower(cc_classes[c.id].value).ilike("%" + term + "%")))
-        return query.filter(self.common_filters(True)).filter(or_(*filter_expression))
+        for c in self.get_search_cc_columns(config):
+            filter_expression.append(
+                getattr(Books,
+                        'custom_column_' + str(c.id)).any(
+                    func.lower(cc_classes[c.id].value).ilike("%" + term + "%")))
+        return query.filter(or_(*filter_expression))
+
+    def search_index_matches(self, term, config):
+        """Returns the select of the ids of the books matching the term in the full text search index
+
+        The index holds the same lowercased and unidecoded values the LIKE search compares with, the trigram
+        tokenizer finds substrings of at least 3 characters. Terms containing LIKE wildcards or too short to be found
+        by the index return None and are searched in the library itself.
+        """
+        folded_term = lcase(term)
+        author_terms = [lcase(author_term) for author_term in re.split("[, ]+", term) if author_term]
+        long_terms = [author_term for author_term in author_terms if len(author_term) >= SEARCH_INDEX_MIN_TERM]
+        if len(folded_term) < SEARCH_INDEX_MIN_TERM or not long_terms or '%' in term or '_' in term:
+            return None
+        if not self.update_search_index(config):
+            return None
+        fields = [field for field in SEARCH_INDEX_COLUMNS if field != 'authors']
+        expression = "{{{}}} : {} OR authors : ({})".format(" ".join(fields),
+                                                           _match_phrase(folded_term),
+                                                           " AND ".join(_match_phrase(author_term)
+                                                                        for author_term in long_terms))
+        matches = select(book_search.c.rowid).where(book_search.c.book_search.match(expression))
+        if len(long_terms) < len(author_terms):
+            # Author names are only matched by their longer parts in the index, the short ones are checked afterwards
+            matches = matches.where(or_(*[book_search.c[field].like("%" + folded_term + "%") for field in fields],
+                                        and_(*[book_search.c.authors.like("%" + author_term + "%")
+                                               for author_term in author_terms])))
+        return matches
+
+    def update_search_index(self, config):
+        """Brings the search index in app.db up to date with the library, returns False if it can't be used"""
+        if CalibreDB.search_index_available is False:
+            return False
+        columns = self.get_search_cc_columns(config)
+        state = (self.get_library_stamp(), ",".join(str(c.id) for c in columns))
+        if CalibreDB.search_index_state == state:
+            return True
+        with CalibreDB._search_index_lock:
+            if CalibreDB.search_index_state == state:
+                return True
+            try:
+                if CalibreDB.search_index_available is None:
+                    self._create_search_index()
+                    if not CalibreDB.search_index_available:
+                        return False
+                self._update_search_index(columns, state[1])
+            except OperationalError as ex:
+                ub.session.rollback()
+                self.session.rollback()
+                log.error("Updating search index failed: %s", ex)
+                return False
+            CalibreDB.search_index_state = state
+        return True
+
+    @staticmethod
+    def _create_search_index():
+        try:
+            probe = sqlite3.connect(":memory:")
+            probe.execute("CREATE VIRTUAL TABLE probe USING fts5(value, tokenize='trigram')")
+            probe.close()
+        except sqlite3.Error as ex:
+            log.warning("Sqlite %s lacks FTS5 with trigram tokenizer, searching without index: %s",
+                        sqlite3.sqlite_version, ex)
+            CalibreDB.search_index_available = False
+            return
+        ub.session.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS book_search USING fts5({}, "
+                                "last_modified UNINDEXED, tokenize='trigram')".format(", ".join(SEARCH_INDEX_COLUMNS))))
+        ub.session.commit()
+        CalibreDB.search_index_available = True
+
+    def _search_index_fields(self, columns):
+        # index column, kind of the names in book_search_name, model, name column and relation to the books
+        fields = [('authors', 'authors', Authors, Authors.name, Books.authors),
+                  ('tags', 'tags', Tags, Tags.name, Books.tags),
+                  ('series', 'series', Series, Series.name, Books.series),
+                  ('publishers', 'publishers', Publishers, Publishers.name, Books.publishers)]
+        for c in columns:
+            # comments are stored per book and changing them changes the book's last_modified
+            kind = 'custom_column_' + str(c.id) if c.datatype != 'comments' else None
+            fields.append(('custom', kind, cc_classes[c.id], cc_classes[c.id].value,
+                           getattr(Books, 'custom_column_' + str(c.id))))
+        return fields
+
+    def _update_search_index(self, columns, signature):
+        """Reindexes new and changed books and books linked to renamed or deleted names, removes deleted books"""
+        known = ub.SearchIndexName
+        if ub.session.query(known.name).filter(known.kind == 'columns').scalar() != signature:
+            # Another set of custom columns is searchable, index all books again
+            ub.session.execute(book_search.delete())
+            ub.session.query(known).delete()
+            ub.session.add(known(kind='columns', item=0, name=signature))
+            ub.session.commit()
+
+        outdated = set()
+        for book_id, last_modified, indexed_modified in (
+                self.session.query(Books.id, type_coerce(Books.last_modified, String), book_search.c.last_modified)
+                .outerjoin(book_search, book_search.c.rowid == Books.id)):
+            if indexed_modified is None or indexed_modified != last_modified:
+                outdated.add(book_id)
+        orphans = [row[0] for row in self.session.query(book_search.c.rowid)
+                   .filter(book_search.c.rowid.notin_(select(Books.id)))]
+
+        # Renaming an author, tag, ... doesn't touch the books, compare with the names the index was built from
+        changed_names = list()
+        removed_names = list()
+        for field, kind, model, name_column, relation in self._search_index_fields(columns):
+            if not kind:
+                continue
+            indexed = self.session.query(known.item).filter(known.kind == kind).first() is not None
+            changed = (self.session.query(model.id, name_column)
+                       .outerjoin(known, and_(known.kind == kind, known.item == model.id))
+                       .filter(or_(known.item.is_(None), known.name != name_column)).all())
+            removed = (self.session.query(known.item, known.name).filter(known.kind == kind)
+                       .filter(known.item.notin_(select(model.id))).all())
+            changed_names.extend({'kind': kind, 'item': item, 'name': name} for item, name in changed)
+            removed_names.extend((kind, item) for item, __ in removed)
+            if not indexed:
+                continue
+            for chunk in _chunks([item for item, __ in changed], SQL_PARAMETER_CHUNK):
+                outdated.update(row[0] for row in self.session.query(Books.id).join(relation)
+                                .filter(model.id.in_(chunk)))
+            for __, name in removed:
+                outdated.update(row[0] for row in self.session.query(book_search.c.rowid)
+                                .filter(book_search.c[field].like("%" + lcase(name or "") + "%")))
+        # Release the read transaction before app.db is written through its own connection
+        self.session.rollback()
+
+        for chunk in _chunks(orphans, SQL_PARAMETER_CHUNK):
+            ub.session.execute(book_search.delete().where(book_search.c.rowid.in_(chunk)))
+        ub.session.commit()
+        for chunk in _chunks(sorted(outdated), SQL_PARAMETER_CHUNK):
+            rows = self._search_index_rows(chunk, columns)
+            self.session.rollback()
+            ub.session.execute(book_search.delete().where(book_search.c.rowid.in_(chunk)))
+            if rows:
+                ub.session.execute(book_search.insert(), rows)
+            ub.session.commit()
+        for chunk in _chunks(changed_names, SQL_PARAMETER_CHUNK):
+            for kind, items in groupby(chunk, key=lambda name: name['kind']):
+                ub.session.query(known).filter(known.kind == kind)\
+                    .filter(known.item.in_([name['item'] for name in items])).delete(synchronize_session=False)
+            ub.session.bulk_insert_mappings(known, chunk)
+        for kind, items in groupby(removed_names, key=lambda name: name[0]):
+            for chunk in _chunks([item for __, item in items], SQL_PARAMETER_CHUNK):
+                ub.session.query(known).filter(known.kind == kind)\
+                    .filter(known.item.in_(chunk)).delete(synchronize_session=False)
+        ub.session.commit()
+        if outdated or orphans:
+            log.debug("Search index updated for %s books, %s removed", len(outdated), len(orphans))
+
+    def _search_index_rows(self, book_ids, columns):
+        rows = dict()
+        for book_id, title, last_modified in (self.session.query(Books.id, Books.title,
+                                                                 type_coerce(Books.last_modified, String))
+                                              .filter(Books.id.in_(book_ids))):
+            rows[book_id] = {'rowid': book_id, 'title': lcase(title or ""), 'last_modified': last_modified}
+            rows[book_id].update({field: list() for field in SEARCH_INDEX_COLUMNS[1:]})
+        for field, __, ___, name_column, relation in self._search_index_fields(columns):
+            for book_id, name in self.session.query(Books.id, name_column).join(relation).filter(Books.id.in_(book_ids)):
+                if book_id in rows and name:
+                    rows[book_id][field].append(lcase(name))
+        for row in rows.values():
+            for field in SEARCH_INDEX_COLUMNS[1:]:
+                row[field] = "\n".join(row[field])
+        return list(rows.values())
+
+    def get_search_cc_columns(self, config):
+        return [c for c in self.get_cc_columns(config, filter_config_custom_read=True)
+                if c.datatype not in ["datetime", "rating", "bool", "int", "float"]]
 
     def get_cc_columns(self, config, filter_config_custom_read=False):
         tmp_cc = self.session.query(CustomColumns).filter(CustomColumns.datatype.notin_(cc_exceptions)).all()
@@ -1007,18 +1420,17 @@ class CalibreDB:
     def get_search_results(self, term, config, offset=None, order=None, limit=None, *join):
         order = order[0] if order else [Books.sort]
         pagination = None
-        result = self.search_query(term, config, *join).order_by(*order).all()
-        result_count = len(result)
+        query = self.search_query(term, config, *join).order_by(*order)
+        # All ids are kept for actions on the whole search result, only the requested page is loaded
+        result_ids = [row[0] for row in query.with_entities(Books.id)]
+        result_count = len(result_ids)
         if offset is not None and limit is not None:
             offset = int(offset)
-            limit_all = offset + int(limit)
             pagination = Pagination((offset / (int(limit)) + 1), limit, result_count)
-        else:
-            offset = 0
-            limit_all = result_count
+            query = query.offset(offset).limit(int(limit))
 
-        ub.store_combo_ids(result)
-        entries = self.order_authors(result[offset:limit_all], list_return=True, combined=True)
+        ub.store_search_ids(result_ids)
+        entries = self.order_authors(query.all(), list_return=True, combined=True)
 
         return entries, result_count, pagination
 
@@ -1088,6 +1500,113 @@ class CalibreDB:
         self.update_config(config, config.config_calibre_dir, app_db_path)
 
 
+# Shelves, read states and archived books change the number of books in some lists
+_COUNTED_APP_DB_MODELS = (ub.BookShelf, ub.ReadBook, ub.ArchivedBook)
+
+
+def _app_db_change(model):
+    if model is ub.Downloads:
+        return 'downloads_changed'
+    if model in _COUNTED_APP_DB_MODELS:
+        return 'app_db_changed'
+    return None
+
+
+@event.listens_for(Session, "after_flush")
+def _track_app_db_flush(session, flush_context):
+    for obj in chain(session.new, session.dirty, session.deleted):
+        change = _app_db_change(type(obj))
+        if change:
+            session.info[change] = True
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _track_app_db_bulk(orm_execute_state):
+    mapper = orm_execute_state.bind_mapper
+    if (orm_execute_state.is_delete or orm_execute_state.is_update) and mapper is not None:
+        change = _app_db_change(mapper.class_)
+        if change:
+            orm_execute_state.session.info[change] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _bump_app_db_version(session):
+    if session.info.pop('app_db_changed', False):
+        CalibreDB.app_db_version += 1
+    if session.info.pop('downloads_changed', False):
+        CalibreDB.downloads_version += 1
+
+
+@event.listens_for(Session, "after_rollback")
+def _reset_app_db_changes(session):
+    session.info.pop('app_db_changed', None)
+    session.info.pop('downloads_changed', None)
+
+
+def _keyset_columns(database, order):
+    """Returns the (column, descending) pairs of an order made of plain columns of the queried table, otherwise None"""
+    table = getattr(database, '__table__', None)
+    if table is None or 'id' not in table.c:
+        return None
+    keyset = list()
+    for element in order:
+        if hasattr(element, '__clause_element__'):
+            element = element.__clause_element__()
+        descending = False
+        if isinstance(element, UnaryExpression):
+            if element.modifier not in (operators.asc_op, operators.desc_op):
+                return None
+            descending = element.modifier is operators.desc_op
+            element = element.element
+        if not isinstance(element, Column) or element.table is not table:
+            return None
+        keyset.append((element, descending))
+    return keyset
+
+
+def _keyset_signature(keyset):
+    return zlib.crc32(",".join("{} {}".format(column.key, descending) for column, descending in keyset).encode())
+
+
+def _parse_seek_token(seek, keyset):
+    if not seek:
+        return None
+    try:
+        signature, values = json.loads(base64.urlsafe_b64decode(seek.encode('ascii')))
+    except (ValueError, TypeError, binascii.Error):
+        return None
+    if signature != _keyset_signature(keyset) or not isinstance(values, list) or len(values) != len(keyset) + 1:
+        return None
+    return values
+
+
+def _keyset_after(keyset, id_column, values):
+    # Rows sorted after the given values in sqlite order (NULL is the smallest value), ties are ordered by id
+    condition = id_column > values[-1]
+    for (column, descending), value in reversed(list(zip(keyset, values))):
+        column = type_coerce(column, String)
+        if descending:
+            after = false() if value is None else or_(column < value, column.is_(None))
+        else:
+            after = column.isnot(None) if value is None else column > value
+        condition = or_(after, and_(column.is_not_distinct_from(value), condition))
+    return condition
+
+
+def _nocase(s):
+    # Python equivalent of sqlite's NOCASE collation, which only folds ascii characters
+    return s.translate(_NOCASE_TABLE)
+
+
+def _chunks(values, size):
+    for index in range(0, len(values), size):
+        yield values[index:index + size]
+
+
+def _match_phrase(value):
+    return '"' + value.replace('"', '""') + '"'
+
+
 def lcase(s):
     try:
         return unidecode.unidecode(s.lower())
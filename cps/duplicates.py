@@ -1,114 +1,180 @@
-from flask import Blueprint
+import threading
+from collections import OrderedDict
+
+from flask import Blueprint, request
 from flask_babel import gettext as _
-from sqlalchemy import func, and_
+from sqlalchemy import func
+from sqlalchemy.orm import selectinload
 
-from . import db, calibre_db, logger
-from .admin import admin_required  
+from . import db, ub, calibre_db, config, logger
+from .admin import admin_required
 from .usermanagement import login_required_if_no_ano
 from .render_template import render_title_template
 from .cw_login import current_user
+from .pagination import Pagination
+from .string_helper import normalize_key, strip_whitespaces
 
 duplicates = Blueprint('duplicates', __name__)
 log = logger.create()
 
+# Duplicate groups per filter signature and mode, valid as long as metadata.db is unchanged
+_group_cache = OrderedDict()
+_group_cache_lock = threading.Lock()
+GROUP_CACHE_SIZE = 16
+
 
-@duplicates.route("/duplicates")
+@duplicates.route("/duplicates", defaults={'page': 1})
+@duplicates.route("/duplicates/<int:page>")
 @login_required_if_no_ano
 @admin_required
-def show_duplicates():
+def show_duplicates(page):
     """Display books with duplicate titles and authors"""
     print("[acw-duplicates] Loading duplicates page...", flush=True)
     log.info("[acw-duplicates] Loading duplicates page for user: %s", current_user.name)
-    
+    fuzzy = request.args.get('fuzzy') == '1'
+
     try:
-        # Use SQL to efficiently find duplicates with proper user filtering
-        duplicate_groups = find_duplicate_books()
-        
-        print(f"[acw-duplicates] Found {len(duplicate_groups)} duplicate groups total", flush=True)
-        log.info("[acw-duplicates] Found %s duplicate groups total", len(duplicate_groups))
-        
-        return render_title_template('duplicates.html', 
+        # Group in SQL and only load the books shown on this page
+        groups = find_duplicate_groups(fuzzy)
+        per_page = config.config_books_per_page
+        pagination = Pagination(page, per_page, len(groups))
+        duplicate_groups = load_duplicate_groups(groups[(page - 1) * per_page:page * per_page])
+
+        print(f"[acw-duplicates] Found {len(groups)} duplicate groups total", flush=True)
+        log.info("[acw-duplicates] Found %s duplicate groups total", len(groups))
+
+        return render_title_template('duplicates.html',
                                      duplicate_groups=duplicate_groups,
-                                     title=_("Duplicate Books"), 
+                                     group_count=len(groups),
+                                     pagination=pagination,
+                                     fuzzy=fuzzy,
+                                     title=_("Duplicate Books"),
                                      page="duplicates")
-                                     
+
     except Exception as e:
         print(f"[acw-duplicates] Critical error loading duplicates page: {str(e)}", flush=True)
         log.error("[acw-duplicates] Critical error loading duplicates page: %s", str(e))
         # Return empty page on error
-        return render_title_template('duplicates.html', 
+        return render_title_template('duplicates.html',
                                      duplicate_groups=[],
-                                     title=_("Duplicate Books"), 
+                                     group_count=0,
+                                     fuzzy=fuzzy,
+                                     title=_("Duplicate Books"),
                                      page="duplicates")
 
 
-def find_duplicate_books():
-    """Find books with duplicate title + primary author combinations using efficient SQL"""
-    
-    # Get all books with proper user filtering - this is much simpler and more reliable
-    # than trying to do complex joins for duplicate detection
-    books_query = (calibre_db.session.query(db.Books)
-                   .filter(calibre_db.common_filters())  # Respect user permissions and library filtering
-                   .order_by(db.Books.title, db.Books.timestamp.desc()))
-    
-    all_books = books_query.all()
-    print(f"[acw-duplicates] Retrieved {len(all_books)} books with user filtering applied", flush=True)
-    
-    # Group books by title + primary author combination (case-insensitive)
-    title_author_groups = {}
-    
-    for book in all_books:
-        # Ensure authors are loaded (lazy loading)
-        if not book.authors:
-            continue
-            
-        # Get primary author (use Calibre-Web's standard approach)
-        book.ordered_authors = calibre_db.order_authors([book])
-        primary_author = book.ordered_authors[0].name if book.ordered_authors else "Unknown"
-        
-        # Create case-insensitive key
-        key = (book.title.lower().strip(), primary_author.lower().strip())
-        
-        if key not in title_author_groups:
-            title_author_groups[key] = []
-        title_author_groups[key].append(book)
-    
-    print(f"[acw-duplicates] Grouped books into {len(title_author_groups)} unique title+author combinations", flush=True)
-    
-    # Filter to only groups with duplicates and prepare display data
+def find_duplicate_groups(fuzzy=False):
+    """Returns the book ids of all duplicate groups ordered by title and author
+
+    Cached until metadata.db, the archived books or the restrictions of the user change.
+
+    The default mode compares trimmed titles and the primary author case-insensitive, the fuzzy mode compares
+    the precomputed normalized (unidecoded, without punctuation) keys stored in app.db
+    """
+    stamp = calibre_db.get_library_stamp()
+    cache_key = (calibre_db.filter_signature(), fuzzy)
+    with _group_cache_lock:
+        cached = _group_cache.get(cache_key)
+        if cached and cached[0] == stamp:
+            return cached[1]
+
+    if fuzzy:
+        update_duplicate_keys()
+        title_key = ub.DuplicateKey.title_key
+        author_key = ub.DuplicateKey.author_key
+        query = (calibre_db.session.query(func.group_concat(db.Books.id))
+                 .join(ub.DuplicateKey, ub.DuplicateKey.book_id == db.Books.id))
+    else:
+        # The primary author is the first entry of author_sort
+        title_key = func.trim(db.Books.title).collate('NOCASE')
+        author_key = func.trim(func.substr(db.Books.author_sort, 1,
+                                           func.instr(db.Books.author_sort + '&', '&') - 1)).collate('NOCASE')
+        query = calibre_db.session.query(func.group_concat(db.Books.id))
+    rows = (query.filter(db.Books.authors.any())
+            .filter(calibre_db.common_filters())  # Respect user permissions and library filtering
+            .group_by(title_key, author_key)
+            .having(func.count(db.Books.id) > 1)
+            .order_by(title_key, author_key)
+            .all())
+    groups = [[int(book_id) for book_id in row[0].split(',')] for row in rows]
+
+    with _group_cache_lock:
+        _group_cache[cache_key] = (stamp, groups)
+        _group_cache.move_to_end(cache_key)
+        while len(_group_cache) > GROUP_CACHE_SIZE:
+            _group_cache.popitem(last=False)
+    return groups
+
+
+def update_duplicate_keys():
+    """Computes the normalized keys of new and changed books and removes the keys of deleted books"""
+    rows = (calibre_db.session.query(db.Books.id, db.Books.title, db.Books.author_sort, db.Books.last_modified,
+                                     ub.DuplicateKey.last_modified)
+            .outerjoin(ub.DuplicateKey, ub.DuplicateKey.book_id == db.Books.id)
+            .all())
+    stale = list()
+    for book_id, title, author_sort, last_modified, key_modified in rows:
+        last_modified = last_modified.replace(tzinfo=None) if last_modified else None
+        if key_modified is None or key_modified != last_modified:
+            stale.append({'book_id': book_id,
+                          'title_key': normalize_key(title),
+                          'author_key': normalize_key(strip_whitespaces((author_sort or '').split('&')[0])),
+                          'last_modified': last_modified})
+    orphans = [row[0] for row in calibre_db.session.query(ub.DuplicateKey.book_id)
+               .outerjoin(db.Books, db.Books.id == ub.DuplicateKey.book_id)
+               .filter(db.Books.id.is_(None))]
+    if not stale and not orphans:
+        return
+    # Release the read transaction before app.db is written through its own connection
+    calibre_db.session.rollback()
+    try:
+        outdated = [entry['book_id'] for entry in stale] + orphans
+        for index in range(0, len(outdated), db.SQL_PARAMETER_CHUNK):
+            (ub.session.query(ub.DuplicateKey)
+             .filter(ub.DuplicateKey.book_id.in_(outdated[index:index + db.SQL_PARAMETER_CHUNK]))
+             .delete(synchronize_session=False))
+        ub.session.bulk_insert_mappings(ub.DuplicateKey, stale)
+        ub.session.commit()
+        log.debug("[acw-duplicates] Updated %s duplicate keys, removed %s", len(stale), len(orphans))
+    except Exception as e:
+        ub.session.rollback()
+        log.error("[acw-duplicates] Updating duplicate keys failed: %s", str(e))
+
+
+def load_duplicate_groups(groups):
+    """Loads the books of the given groups of book ids and prepares them for display"""
+    book_ids = [book_id for group in groups for book_id in group]
+    books = dict()
+    for index in range(0, len(book_ids), db.SQL_PARAMETER_CHUNK):
+        for book in (calibre_db.session.query(db.Books)
+                     .filter(db.Books.id.in_(book_ids[index:index + db.SQL_PARAMETER_CHUNK]))
+                     .options(selectinload(db.Books.authors),
+                              selectinload(db.Books.series),
+                              selectinload(db.Books.data))):
+            books[book.id] = book
+    calibre_db.order_authors(list(books.values()), list_return=True)
+
     duplicate_groups = []
-    for (lower_title, lower_author), books in title_author_groups.items():
-        if len(books) > 1:
-            # Sort books by timestamp (newest first)
-            books.sort(key=lambda x: x.timestamp, reverse=True)
-            
-            # Add additional information for display
-            for book in books:
-                # Ensure we have ordered authors
-                if not hasattr(book, 'ordered_authors') or not book.ordered_authors:
-                    book.ordered_authors = calibre_db.order_authors([book])
-                
-                book.author_names = ', '.join([author.name.replace('|', ',') for author in book.ordered_authors])
-                # Add cover URL
-                if book.has_cover:
-                    book.cover_url = f"/cover/{book.id}"
-                else:
-                    book.cover_url = "/static/generic_cover.jpg"
-            
-            duplicate_groups.append({
-                'title': books[0].title,
-                'author': books[0].author_names.split(',')[0].strip(),  # Primary author
-                'count': len(books),
-                'books': books
-            })
-            
-            book_ids = [book.id for book in books]
-            print(f"[acw-duplicates] Found duplicate group: '{books[0].title}' by {books[0].author_names.split(',')[0].strip()} ({len(books)} copies) - IDs: {book_ids}", flush=True)
-            log.info("[acw-duplicates] Found duplicate group: '%s' by %s (%s copies) - IDs: %s", 
-                    books[0].title, books[0].author_names.split(',')[0].strip(), len(books), book_ids)
-    
-    # Sort by title, then author for consistent display
-    duplicate_groups.sort(key=lambda x: (x['title'].lower(), x['author'].lower()))
-    
-    print(f"[acw-duplicates] Found {len(duplicate_groups)} duplicate groups total", flush=True)
-    return duplicate_groups
\ No newline at end of file
+    for group in groups:
+        group_books = [books[book_id] for book_id in group if book_id in books]
+        if len(group_books) < 2:
+            continue
+        # Sort books by timestamp (newest first)
+        group_books.sort(key=lambda x: x.timestamp, reverse=True)
+
+        # Add additional information for display
+        for book in group_books:
+            book.author_names = ', '.join([author.name.replace('|', ',') for author in book.ordered_authors])
+            # Add cover URL
+            if book.has_cover:
+                book.cover_url = f"/cover/{book.id}"
+            else:
+                book.cover_url = "/static/generic_cover.jpg"
+
+        duplicate_groups.append({
+            'title': group_books[0].title,
+            'author': group_books[0].author_names.split(',')[0].strip(),  # Primary author
+            'count': len(group_books),
+            'books': group_books
+        })
+    return duplicate_groups
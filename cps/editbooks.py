@@ -41,7 +41,7 @@ from . import constants, logger, isoLanguages, gdriveutils, uploader, helper, ko
 from .clean_html import clean_string
 from . import config, ub, db, calibre_db
 from .services.worker import WorkerThread
-from .tasks.upload import TaskUpload
+from .tasks.upload import TaskUpload, TaskUploadBooks
 from .render_template import render_title_template
 from .kobo_sync_status import change_archived_books
 from .redirect import get_redirect_location
@@ -108,41 +108,19 @@ def upload():
         book_id = request.form.get('book_id', -1)
         return do_edit_book(book_id, request.files.getlist("btn-upload-format"))
     elif len(request.files.getlist("btn-upload")):
+        if len(request.files.getlist("btn-upload")) > 1:
+            return upload_in_background(request.files.getlist("btn-upload"))
         for requested_file in request.files.getlist("btn-upload"):
             try:
-                modify_date = False
                 # create the function for sorting...
                 calibre_db.create_functions(config)
                 meta, error = file_handling_on_upload(requested_file)
                 if error:
                     return error
 
-                db_book, input_authors, title_dir = create_book_on_upload(modify_date, meta)
-
-                # Comments need book id therefore only possible after flush
-                modify_date |= edit_book_comments(Markup(meta.description).unescape(), db_book)
-
+                db_book, error = add_uploaded_book(meta)
                 book_id = db_book.id
                 title = db_book.title
-                if config.config_use_google_drive:
-                    helper.upload_new_file_gdrive(book_id,
-                                                  input_authors[0],
-                                                  title,
-                                                  title_dir,
-                                                  meta.file_path,
-                                                  meta.extension.lower())
-                    for file_format in db_book.data:
-                        file_format.name = (helper.get_valid_filename(title, chars=42) + ' - '
-                                            + helper.get_valid_filename(input_authors[0], chars=42))
-                else:
-                    error = helper.update_dir_structure(book_id,
-                                                        config.get_book_path(),
-                                                        input_authors[0],
-                                                        meta.file_path,
-                                                        title_dir + meta.extension.lower())
-                move_coverfile(meta, db_book)
-                if modify_date:
-                    calibre_db.set_metadata_dirty(book_id)
                 # save data to database, reread data
                 calibre_db.session.commit()
 
@@ -817,7 +795,8 @@ def prepare_authors_on_upload(title, authr):
             if not db_author:
                 db_author = db.Authors(inp, helper.get_sorted_author(inp), "")
                 calibre_db.session.add(db_author)
-                calibre_db.session.commit()
+                # committed together with the book, the author is rolled back with it if adding the book fails
+                calibre_db.session.flush()
             sort_author = helper.get_sorted_author(inp)
         else:
             if not db_author:
@@ -891,24 +870,87 @@ def create_book_on_upload(modify_date, meta):
     return db_book, input_authors, title_dir
 
 
-def file_handling_on_upload(requested_file):
+def upload_in_background(requested_files):
+    """Saves the uploaded files to the temp dir and leaves reading their metadata and adding them to the library to a
+    background task, so the request doesn't run into timeouts for many books"""
+    staged = []
+    for requested_file in requested_files:
+        if check_file_on_upload(requested_file):
+            continue
+        try:
+            staged.append(uploader.stage_upload(requested_file))
+        except (IOError, OSError):
+            log.error("File %s could not saved to temp dir", requested_file.filename)
+            flash(_("File %(filename)s could not saved to temp dir",
+                    filename=requested_file.filename), category="error")
+    if staged:
+        WorkerThread.add(current_user.name, TaskUploadBooks(N_("Adding %(count)s uploaded books", count=len(staged)),
+                                                            staged, current_user.id, request.url_root))
+        flash(_("%(count)s files are being added to the library, the Tasks page shows the progress",
+                count=len(staged)), category="success")
+    return Response(json.dumps({"location": url_for("web.index")}), mimetype='application/json')
+
+
+def add_uploaded_book(meta):
+    """Adds the uploaded file as new book to the library and moves the file and cover into the book folder. The
+    session is left for the caller to commit. Returns the book and an error message of moving the file"""
+    modify_date = False
+    error = None
+    db_book, input_authors, title_dir = create_book_on_upload(modify_date, meta)
+
+    # Comments need book id therefore only possible after flush
+    modify_date |= edit_book_comments(Markup(meta.description).unescape(), db_book)
+
+    book_id = db_book.id
+    title = db_book.title
+    if config.config_use_google_drive:
+        helper.upload_new_file_gdrive(book_id,
+                                      input_authors[0],
+                                      title,
+                                      title_dir,
+                                      meta.file_path,
+                                      meta.extension.lower())
+        for file_format in db_book.data:
+            file_format.name = (helper.get_valid_filename(title, chars=42) + ' - '
+                                + helper.get_valid_filename(input_authors[0], chars=42))
+    else:
+        error = helper.update_dir_structure(book_id,
+                                            config.get_book_path(),
+                                            input_authors[0],
+                                            meta.file_path,
+                                            title_dir + meta.extension.lower())
+    move_coverfile(meta, db_book)
+    if modify_date:
+        calibre_db.set_metadata_dirty(book_id)
+    return db_book, error
+
+
+def check_file_on_upload(requested_file):
+    """Returns an error response if the file may not be uploaded"""
     # check if file extension is correct
     allowed_extensions = config.config_upload_formats.split(',')
     if requested_file:
         if config.config_check_extensions and allowed_extensions != ['']:
             if not validate_mime_type(requested_file, allowed_extensions):
                 flash(_("File type isn't allowed to be uploaded to this server"), category="error")
-                return None, Response(json.dumps({"location": url_for("web.index")}), mimetype='application/json')
+                return Response(json.dumps({"location": url_for("web.index")}), mimetype='application/json')
     if '.' in requested_file.filename:
         file_ext = requested_file.filename.rsplit('.', 1)[-1].lower()
         if file_ext not in allowed_extensions and '' not in allowed_extensions:
             flash(
                 _("File extension '%(ext)s' is not allowed to be uploaded to this server",
                   ext=file_ext), category="error")
-            return None, Response(json.dumps({"location": url_for("web.index")}), mimetype='application/json')
+            return Response(json.dumps({"location": url_for("web.index")}), mimetype='application/json')
     else:
         flash(_('File to be uploaded must have an extension'), category="error")
-        return None, Response(json.dumps({"location": url_for("web.index")}), mimetype='application/json')
+        return Response(json.dumps({"location": url_for("web.index")}), mimetype='application/json')
+    return None
+
+
+def file_handling_on_upload(requested_file):
+    error = check_file_on_upload(requested_file)
+    if error:
+        return None, error
 
     # extract metadata from file
     try:
@@ -16,15 +16,99 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program. If not, see <http://www.gnu.org/licenses/>.
 from uuid import uuid4
+import hashlib
 import os
+import shutil
+import threading
 
 from .file_helper import get_temp_dir
 from .subproc_wrapper import process_open
-from . import logger, config
-from .constants import SUPPORTED_CALIBRE_BINARIES
+from . import logger, config, db, fs
+from .constants import SUPPORTED_CALIBRE_BINARIES, CACHE_TYPE_EMBEDDED
 
 log = logger.create()
 
+# Book files with embedded metadata are kept until the cache grows beyond this size, least recently used go first
+EMBED_CACHE_SIZE = int(os.environ.get('ACW_EMBED_CACHE_MB', 2048)) * 1024 * 1024
+_embed_cache_prune_lock = threading.Lock()
+
+
+def get_custom_columns_version(session):
+    """Changes whenever custom columns written into the embedded metadata are added, removed or changed"""
+    columns = (session.query(db.CustomColumns.id, db.CustomColumns.label, db.CustomColumns.datatype,
+                             db.CustomColumns.is_multiple, db.CustomColumns.display)
+               .filter(db.CustomColumns.mark_for_delete == 0)
+               .filter(db.CustomColumns.datatype.notin_(db.cc_exceptions))
+               .order_by(db.CustomColumns.id).all())
+    return hashlib.sha1(repr([tuple(column) for column in columns]).encode()).hexdigest()
+
+
+def get_embedded_file(session, book, book_format, generate, source_path=None, variant=""):
+    """Returns folder and file name (without extension) of the book format with embedded metadata and whether the file
+    belongs to the cache. generate() creates the file and returns folder and file name, it only runs if the book, its
+    file or the custom columns changed since the last time and the result is served from the cache afterwards. A file
+    that couldn't be cached is a temporary file the caller has to remove"""
+    key = [book.id, book_format.lower(), book.last_modified, get_custom_columns_version(session), variant]
+    if source_path:
+        try:
+            stat = os.stat(source_path)
+            key.extend((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            pass
+    name = hashlib.sha256("|".join(str(part) for part in key).encode()).hexdigest()
+    try:
+        cache_dir = fs.FileSystem().get_cache_file_dir(name, CACHE_TYPE_EMBEDDED)
+    except OSError:
+        return generate() + (False,)
+    cache_file = os.path.join(cache_dir, name + "." + book_format)
+    try:
+        # the modification time marks the last use for the eviction
+        os.utime(cache_file)
+        return cache_dir, name, True
+    except OSError:
+        pass
+
+    tmp_dir, tmp_name = generate()
+    if not tmp_name:
+        return tmp_dir, tmp_name, False
+    part_file = os.path.join(cache_dir, name + "." + str(uuid4()) + ".part")
+    try:
+        shutil.move(os.path.join(tmp_dir, tmp_name + "." + book_format), part_file)
+        os.replace(part_file, cache_file)
+    except OSError as ex:
+        log.debug("Could not cache file with embedded metadata: %s", ex)
+        return tmp_dir, tmp_name, False
+    prune_embed_cache()
+    return cache_dir, name, True
+
+
+def prune_embed_cache(max_size=EMBED_CACHE_SIZE):
+    """Deletes the least recently used files once the cache grew beyond max_size"""
+    if not _embed_cache_prune_lock.acquire(blocking=False):
+        return
+    try:
+        entries = []
+        for root, __, files in os.walk(fs.FileSystem().get_cache_dir(CACHE_TYPE_EMBEDDED)):
+            for file in files:
+                if file.endswith(".part"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, file))
+                    entries.append((stat.st_mtime, stat.st_size, os.path.join(root, file)))
+                except OSError:
+                    continue
+        total = sum(entry[1] for entry in entries)
+        for __, size, path in sorted(entries):
+            if total <= max_size:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                continue
+    finally:
+        _embed_cache_prune_lock.release()
+
 
 def do_calibre_export(book_id, book_format):
     try:
@@ -65,7 +65,7 @@ from .tasks.thumbnail import TaskClearCoverThumbnailCache, TaskGenerateCoverThum
 from .tasks.metadata_backup import TaskBackupMetadata
 from .file_helper import get_temp_dir
 from .epub_helper import get_content_opf, create_new_metadata_backup, updateEpub, replace_metadata
-from .embed_helper import do_calibre_export
+from .embed_helper import do_calibre_export, get_embedded_file
 
 log = logger.create()
 
@@ -748,7 +748,10 @@ def get_book_cover_with_uuid(book_uuid, resolution=None):
     return get_book_cover_internal(book, resolution=resolution)
 
 def get_book_cover_epoch_date_with_uuid(book_uuid):
-    book = calibre_db.get_book_by_uuid(book_uuid)
+    return get_book_cover_epoch_date(calibre_db.get_book_by_uuid(book_uuid))
+
+
+def get_book_cover_epoch_date(book):
     if book and book.has_cover:
         file_path = os.path.join(config.get_book_path(), book.path, "cover.jpg")
         if os.path.isfile(file_path):
@@ -952,14 +955,13 @@ def do_download_file(book, book_format, client, data, headers):
                  (book_format == "kepub" and config.config_kepubifypath) or
                  (book_format != "kepub" and config.config_binariesdir)):
                 output_path = os.path.join(config.config_calibre_dir, book.path)
-                if not os.path.exists(output_path):
-                    os.makedirs(output_path)
                 output = os.path.join(config.config_calibre_dir, book.path, book_name + "." + book_format)
-                gd.downloadFile(book.path, book_name + "." + book_format, output)
-                if book_format == "kepub" and config.config_kepubifypath:
-                    filename, download_name = do_kepubify_metadata_replace(book, output)
-                elif book_format != "kepub" and config.config_binariesdir:
-                    filename, download_name = do_calibre_export(book.id, book_format)
+
+                def fetch():
+                    if not os.path.exists(output_path):
+                        os.makedirs(output_path)
+                    gd.downloadFile(book.path, book_name + "." + book_format, output)
+                filename, download_name = do_embed_metadata(book, book_format, output, fetch)
             else:
                 return gd.do_gdrive_download(df, headers)
         else:
@@ -973,11 +975,11 @@ def do_download_file(book, book_format, client, data, headers):
         if client == "kobo" and book_format == "kepub":
             headers["Content-Disposition"] = headers["Content-Disposition"].replace(".kepub", ".kepub.epub")
 
-        if book_format == "kepub" and config.config_kepubifypath and config.config_embed_metadata:
-            filename, download_name = do_kepubify_metadata_replace(book, os.path.join(filename,
-                                                                                      book_name + "." + book_format))
-        elif book_format != "kepub" and config.config_binariesdir and config.config_embed_metadata:
-            filename, download_name = do_calibre_export(book.id, book_format)
+        if config.config_embed_metadata and (
+             (book_format == "kepub" and config.config_kepubifypath) or
+             (book_format != "kepub" and config.config_binariesdir)):
+            filename, download_name = do_embed_metadata(book, book_format,
+                                                        os.path.join(filename, book_name + "." + book_format))
         else:
             download_name = book_name
 
@@ -990,6 +992,22 @@ def do_download_file(book, book_format, client, data, headers):
     return response
 
 
+def do_embed_metadata(book, book_format, file_path, fetch=None):
+    """Returns folder and file name of the book format with embedded metadata, taken from the cache unless the book
+    changed since it was last generated. fetch() retrieves the book file first if it isn't stored locally"""
+    def generate():
+        if fetch:
+            fetch()
+        if book_format == "kepub":
+            return do_kepubify_metadata_replace(book, file_path)
+        return do_calibre_export(book.id, book_format)
+    # the kepub metadata is written in the language of the user
+    variant = "{}/{}".format(current_user.locale, get_locale()) if book_format == "kepub" else ""
+    filename, download_name, __ = get_embedded_file(calibre_db.session, book, book_format, generate,
+                                                     source_path=None if fetch else file_path, variant=variant)
+    return filename, download_name
+
+
 def do_kepubify_metadata_replace(book, file_path):
     custom_columns = (calibre_db.session.query(db.CustomColumns)
                       .filter(db.CustomColumns.mark_for_delete == 0)
@@ -18,6 +18,7 @@
 #  along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import base64
+import threading
 from datetime import datetime, timezone
 import os
 import uuid
@@ -42,6 +43,8 @@ from sqlalchemy import func, null, literal
 from sqlalchemy.sql.expression import and_, or_
 from sqlalchemy.exc import StatementError
 from sqlalchemy.sql import select
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 import requests
 
 from . import config, logger, kobo_auth, db, calibre_db, helper, shelf as shelf_lib, ub, csrf, kobo_sync_status
@@ -50,6 +53,7 @@ from .epub import get_epub_layout
 from .constants import COVER_THUMBNAIL_SMALL, COVER_THUMBNAIL_MEDIUM, COVER_THUMBNAIL_LARGE
 from .helper import get_download_link
 from .services import SyncToken as SyncToken, hardcover
+from .tasks.kepub import queue_kepub_conversion, PRIORITY_REQUESTED
 from .web import download_required
 from .kobo_auth import requires_kobo_auth, get_auth_token
 
@@ -59,6 +63,10 @@ KOBO_IMAGEHOST_URL = "https://cdn.kobo.com/book-images"
 
 SYNC_ITEM_LIMIT = 100
 
+# metadata.db stamp seen by the last library sync, the database is only reloaded if it changes
+_library_stamp = None
+_library_stamp_lock = threading.Lock()
+
 kobo = Blueprint("kobo", __name__, url_prefix="/kobo/<auth_token>")
 kobo_auth.disable_failed_auth_redirect_for_blueprint(kobo)
 kobo_auth.register_url_value_preprocessor(kobo)
@@ -166,11 +174,9 @@ def HandleSyncRequest():
     new_archived_last_modified = datetime.min
     sync_results = []
 
-    # We reload the book database so that the user gets a fresh view of the library
-    # in case of external changes (e.g: adding a book through Calibre).
-    calibre_db.reconnect_db(config, ub.app_DB_path)
-    # also refresh thumbnails if configured
-    helper.update_thumbnail_cache()
+    # Reload the book database and refresh thumbnails only if the library was changed since the last sync
+    # (e.g: adding a book through Calibre)
+    refresh_library_if_changed()
 
     only_kobo_shelves = current_user.kobo_only_shelves_sync
 
@@ -195,9 +201,6 @@ def HandleSyncRequest():
                            .filter(ub.BookShelf.date_added > sync_token.books_last_modified)
                            .filter(db.Data.format.in_(KOBO_FORMATS))
                            .filter(calibre_db.common_filters(allow_show_archived=True))
-                           .order_by(db.Books.last_modified)
-                           .order_by(db.Books.id)
-                           .order_by(ub.ArchivedBook.last_modified)
                            .join(ub.BookShelf, db.Books.id == ub.BookShelf.book_id)
                            .join(ub.Shelf)
                            .filter(ub.Shelf.user_id == current_user.id)
@@ -252,17 +255,27 @@ def HandleSyncRequest():
                            .order_by(db.Books.id))
 
     reading_states_in_new_entitlements = []
-    books = changed_entries.limit(SYNC_ITEM_LIMIT)
-    log.debug("Books to Sync: {}".format(len(books.all())))
+    # Fetch one entry more than the page size to find out if another sync round is needed
+    books = changed_entries.limit(SYNC_ITEM_LIMIT + 1).all()
+    cont_sync = len(books) > SYNC_ITEM_LIMIT
+    books = books[:SYNC_ITEM_LIMIT]
+    log.debug("Books to Sync: {}".format(len(books)))
     log.debug("sync_token.books_last_created: %s" % sync_token.books_last_created)
+    load_sync_books([book.Books.id for book in books])
+    reading_states = get_or_create_reading_states([book.Books.id for book in books])
+    synced_books = []
+    removed_books = []
+    missing_kepub = []
     for book in books:
+        # EPUB is served until the background conversion to KEPUB is finished
         formats = [data.format for data in book.Books.data]
-        if 'KEPUB' not in formats and config.config_kepubifypath and 'EPUB' in formats:
-            helper.convert_book_format(book.Books.id, config.get_book_path(), 'EPUB', 'KEPUB', current_user.name)
+        if 'KEPUB' not in formats and 'EPUB' in formats:
+            missing_kepub.append(book.Books.id)
 
-        kobo_reading_state = get_or_create_reading_state(book.Books.id)
+        kobo_reading_state = reading_states[book.Books.id]
+        deleted = only_kobo_shelves and book.deleted
         entitlement = {
-            "BookEntitlement": create_book_entitlement(book.Books, archived = book.is_archived==True or (only_kobo_shelves and book.deleted)),
+            "BookEntitlement": create_book_entitlement(book.Books, archived=book.is_archived == True or deleted),
             "BookMetadata": get_metadata(book.Books),
         }
 
@@ -279,13 +292,9 @@ def HandleSyncRequest():
             pass
 
         log.debug("Syncing book: %s, ts_created: %s", book.Books.id, ts_created)
-        if ts_created > sync_token.books_last_created:
-            entitlement["BookMetadata"] = get_metadata(book.Books)
+        if ts_created > sync_token.books_last_created and not deleted:
             sync_results.append({"NewEntitlement": entitlement})
-        elif only_kobo_shelves and book.deleted:
-            sync_results.append({"ChangedEntitlement": entitlement})
         else:
-            entitlement["BookMetadata"] = get_metadata(book.Books)
             sync_results.append({"ChangedEntitlement": entitlement})
 
         new_books_last_modified = max(
@@ -299,10 +308,12 @@ def HandleSyncRequest():
             pass
 
         new_books_last_created = max(ts_created, new_books_last_created)
-        if only_kobo_shelves and book.deleted:
-            kobo_sync_status.remove_synced_books(book.Books.id)
+        if deleted:
+            removed_books.append(book.Books.id)
         else:
-            kobo_sync_status.add_synced_books(book.Books.id)
+            synced_books.append(book.Books.id)
+    kobo_sync_status.update_synced_books(synced_books, removed_books)
+    queue_kepub_conversion(missing_kepub)
 
     max_change = changed_entries.filter(ub.ArchivedBook.is_archived)\
         .filter(ub.ArchivedBook.user_id == current_user.id) \
@@ -312,11 +323,7 @@ def HandleSyncRequest():
 
     new_archived_last_modified = max(new_archived_last_modified, max_change)
 
-    # no. of books returned
-    book_count = changed_entries.count() - books.count()
-    # last entry:
-    cont_sync = bool(book_count)
-    log.debug("Remaining books to Sync: {}".format(book_count))
+    log.debug("More books to Sync: {}".format(cont_sync))
     # generate reading state data
     changed_reading_states = ub.session.query(ub.KoboReadingState)
 
@@ -337,10 +344,17 @@ def HandleSyncRequest():
     changed_reading_states = changed_reading_states.filter(
         and_(ub.KoboReadingState.user_id == current_user.id,
              ub.KoboReadingState.book_id.notin_(reading_states_in_new_entitlements)))\
-        .order_by(ub.KoboReadingState.last_modified)
-    cont_sync |= bool(changed_reading_states.count() > SYNC_ITEM_LIMIT)
-    for kobo_reading_state in changed_reading_states.limit(SYNC_ITEM_LIMIT).all():
-        book = calibre_db.session.query(db.Books).filter(db.Books.id == kobo_reading_state.book_id).one_or_none()
+        .order_by(ub.KoboReadingState.last_modified)\
+        .options(selectinload(ub.KoboReadingState.book_read_link),
+                 selectinload(ub.KoboReadingState.current_bookmark),
+                 selectinload(ub.KoboReadingState.statistics))
+    changed_reading_states = changed_reading_states.limit(SYNC_ITEM_LIMIT + 1).all()
+    cont_sync |= len(changed_reading_states) > SYNC_ITEM_LIMIT
+    changed_reading_states = changed_reading_states[:SYNC_ITEM_LIMIT]
+    state_books = {book.id: book for book in calibre_db.session.query(db.Books)
+                   .filter(db.Books.id.in_([state.book_id for state in changed_reading_states]))}
+    for kobo_reading_state in changed_reading_states:
+        book = state_books.get(kobo_reading_state.book_id)
         if book:
             sync_results.append({
                 "ChangedReadingState": {
@@ -361,6 +375,35 @@ def HandleSyncRequest():
     return generate_sync_response(sync_token, sync_results, cont_sync)
 
 
+def refresh_library_if_changed():
+    global _library_stamp
+    stamp = calibre_db.get_library_stamp()
+    with _library_stamp_lock:
+        if stamp is not None and stamp == _library_stamp:
+            return
+        _library_stamp = stamp
+    log.debug("Kobo: Library changed since last sync, reloading database")
+    calibre_db.reconnect_db(config, ub.app_DB_path)
+    # also refresh thumbnails if configured
+    helper.update_thumbnail_cache()
+
+
+def load_sync_books(book_ids):
+    # Load everything needed for the entitlements of one sync page with one query per relation
+    # instead of lazy loading them book by book
+    if book_ids:
+        (calibre_db.session.query(db.Books)
+         .filter(db.Books.id.in_(book_ids))
+         .options(selectinload(db.Books.data),
+                  selectinload(db.Books.authors),
+                  selectinload(db.Books.comments),
+                  selectinload(db.Books.identifiers),
+                  selectinload(db.Books.languages),
+                  selectinload(db.Books.publishers),
+                  selectinload(db.Books.series))
+         .all())
+
+
 def generate_sync_response(sync_token, sync_results, set_cont=False):
     extra_headers = {}
     if config.config_kobo_proxy and not set_cont:
@@ -400,6 +443,9 @@ def HandleMetadataRequest(book_uuid):
         log.info("Book %s not found in database", book_uuid)
         return redirect_or_proxy_request()
 
+    formats = [data.format for data in book.data]
+    if 'KEPUB' not in formats and 'EPUB' in formats:
+        queue_kepub_conversion([book.id], PRIORITY_REQUESTED)
     metadata = get_metadata(book)
     response = make_response(json.dumps([metadata], ensure_ascii=False))
     response.headers["Content-Type"] = "application/json; charset=utf-8"
@@ -522,7 +568,7 @@ def get_metadata(book):
         if i.format_type() == "ISBN":
             book_isbn = i.val
 
-    coverVersion = helper.get_book_cover_epoch_date_with_uuid(book_uuid)
+    coverVersion = helper.get_book_cover_epoch_date(book)
     if coverVersion:
         coverImageId = book_uuid + "/" + coverVersion
     else:
@@ -808,14 +854,18 @@ def create_kobo_tag(shelf):
         "Name": shelf.name,
         "Type": "UserTag"
     }
-    for book_shelf in shelf.books:
-        book = calibre_db.get_book(book_shelf.book_id)
-        if not book:
-            log.info("Book (id: %s) in BookShelf (id: %s) not found in book database",  book_shelf.book_id, shelf.id)
+    book_ids = [book_shelf.book_id for book_shelf in shelf.books]
+    book_uuids = dict()
+    for index in range(0, len(book_ids), db.SQL_PARAMETER_CHUNK):
+        book_uuids.update(calibre_db.session.query(db.Books.id, db.Books.uuid)
+                          .filter(db.Books.id.in_(book_ids[index:index + db.SQL_PARAMETER_CHUNK])).all())
+    for book_id in book_ids:
+        if book_id not in book_uuids:
+            log.info("Book (id: %s) in BookShelf (id: %s) not found in book database",  book_id, shelf.id)
             continue
         tag["Items"].append(
             {
-                "RevisionId": book.uuid,
+                "RevisionId": book_uuids[book_id],
                 "Type": "ProductRevisionTagItem"
             }
         )
@@ -923,6 +973,45 @@ def get_or_create_reading_state(book_id):
     return book_read.kobo_reading_state
 
 
+def get_or_create_reading_states(book_ids):
+    """Bulk version of get_or_create_reading_state, returns the reading states of the current user by book id"""
+    def load_read_books():
+        loaded = dict()
+        for book_read in (ub.session.query(ub.ReadBook)
+                          .filter(ub.ReadBook.user_id == int(current_user.id), ub.ReadBook.book_id.in_(book_ids))
+                          .options(selectinload(ub.ReadBook.kobo_reading_state)
+                                   .selectinload(ub.KoboReadingState.current_bookmark),
+                                   selectinload(ub.ReadBook.kobo_reading_state)
+                                   .selectinload(ub.KoboReadingState.statistics))):
+            if book_read.kobo_reading_state:
+                # the backref is not populated by the eager load and would be lazy loaded for every book
+                set_committed_value(book_read.kobo_reading_state, 'book_read_link', book_read)
+            loaded[book_read.book_id] = book_read
+        return loaded
+
+    if not book_ids:
+        return {}
+    read_books = load_read_books()
+    created = False
+    for book_id in book_ids:
+        book_read = read_books.get(book_id)
+        if not book_read:
+            book_read = read_books[book_id] = ub.ReadBook(user_id=current_user.id, book_id=book_id)
+            ub.session.add(book_read)
+            created = True
+        if not book_read.kobo_reading_state:
+            kobo_reading_state = ub.KoboReadingState(user_id=book_read.user_id, book_id=book_id)
+            kobo_reading_state.current_bookmark = ub.KoboBookmark()
+            kobo_reading_state.statistics = ub.KoboStatistics()
+            book_read.kobo_reading_state = kobo_reading_state
+            created = True
+    if created:
+        ub.session_commit()
+        # the commit expired all loaded states, load them again in one go
+        read_books = load_read_books()
+    return {book_id: read_books[book_id].kobo_reading_state for book_id in book_ids}
+
+
 def get_kobo_reading_state_response(book, kobo_reading_state):
     return {
         "EntitlementId": book.uuid,
@@ -65,13 +65,15 @@ from os import urandom
 from functools import wraps
 
 from flask import g, Blueprint, abort, request
-from .cw_login import login_user, current_user
+from .cw_login import login_user
 from flask_babel import gettext as _
 from flask_limiter import RateLimitExceeded
+from sqlalchemy.sql import select
 
-from . import logger, config, calibre_db, db, helper, ub, lm, limiter
+from . import logger, config, calibre_db, db, ub, lm, limiter
 from .render_template import render_title_template
 from .usermanagement import user_login_required
+from .tasks.kepub import kepub_backlog, queue_kepub_conversion
 
 
 log = logger.create()
@@ -106,21 +108,34 @@ def generate_auth_token(user_id):
         ub.session.add(auth_token)
         ub.session_commit()
 
-    books = calibre_db.session.query(db.Books).join(db.Data).all()
-
-    for book in books:
-        formats = [data.format for data in book.data]
-        if 'KEPUB' not in formats and config.config_kepubifypath and 'EPUB' in formats:
-            helper.convert_book_format(book.id, config.config_calibre_dir, 'EPUB', 'KEPUB', current_user.name)
+    queue_kepub_for_sync(user_id)
 
     return render_title_template(
         "generate_kobo_auth_url.html",
         title=_("Kobo Setup"),
         auth_token=auth_token.auth_token,
+        kepub_queued=kepub_backlog.stats['queued'] if config.config_kepubifypath else 0,
         warning=warning
     )
 
 
+def queue_kepub_for_sync(user_id):
+    """Queues the books the first Kobo sync of the user will offer and which are still missing their KEPUB, as many
+    as fit into the conversion backlog. The sync itself queues the rest once the device asks for them"""
+    free = kepub_backlog.free
+    if not config.config_kepubifypath or not free:
+        return
+    query = (calibre_db.session.query(db.Books.id)
+             .filter(db.Books.data.any(db.Data.format == 'EPUB'))
+             .filter(~db.Books.data.any(db.Data.format == 'KEPUB')))
+    user = ub.session.query(ub.User).filter(ub.User.id == user_id).first()
+    if user and user.kobo_only_shelves_sync:
+        query = query.filter(db.Books.id.in_(select(ub.BookShelf.book_id)
+                                             .join(ub.Shelf, ub.Shelf.id == ub.BookShelf.shelf)
+                                             .where(ub.Shelf.user_id == user_id, ub.Shelf.kobo_sync)))
+    queue_kepub_conversion([row.id for row in query.order_by(db.Books.timestamp.desc()).limit(free)])
+
+
 @kobo_auth.route("/deleteauthtoken/<int:user_id>", methods=["POST"])
 @user_login_required
 def delete_auth_token(user_id):
@@ -18,7 +18,7 @@
 
 
 from .cw_login import current_user
-from . import ub
+from . import ub, db
 from datetime import datetime, timezone
 from sqlalchemy.sql.expression import or_, and_, true
 # from sqlalchemy import exc
@@ -37,6 +37,23 @@ def add_synced_books(book_id):
         ub.session_commit()
 
 
+# Add and remove the synced books of one sync page for the current user with a single commit
+def update_synced_books(added_ids, removed_ids):
+    added_ids = set(added_ids)
+    removed_ids = set(removed_ids)
+    if added_ids:
+        present = {row.book_id for row in ub.session.query(ub.KoboSyncedBooks.book_id)
+                   .filter(ub.KoboSyncedBooks.user_id == current_user.id)
+                   .filter(ub.KoboSyncedBooks.book_id.in_(added_ids))}
+        ub.session.bulk_insert_mappings(ub.KoboSyncedBooks, [{'user_id': current_user.id, 'book_id': book_id}
+                                                             for book_id in added_ids - present])
+    if removed_ids:
+        ub.session.query(ub.KoboSyncedBooks).filter(ub.KoboSyncedBooks.user_id == current_user.id)\
+            .filter(ub.KoboSyncedBooks.book_id.in_(removed_ids)).delete(synchronize_session=False)
+    if added_ids or removed_ids:
+        ub.session_commit()
+
+
 # Select all entries of current book in kobo_synced_books table, which are from current user and delete them
 def remove_synced_book(book_id, all=False, session=None):
     if not all:
@@ -62,6 +79,7 @@ def change_archived_books(book_id, state=None, message=None):
 
     ub.session.merge(archived_book)
     ub.session_commit(message)
+    db.CalibreDB.invalidate_filters()
     return archived_book.is_archived
 
 
@@ -19,12 +19,11 @@ from typing import Dict, Optional, Any, Tuple
 
 from flask import Blueprint, request, jsonify, g, render_template
 from flask_babel import gettext as _
-from werkzeug.security import check_password_hash
 from sqlalchemy import func
 
 from . import logger, ub, config, csrf, constants, services
 from .cw_login import current_user
-from .usermanagement import user_login_required
+from .usermanagement import user_login_required, credential_cache
 
 log = logger.create()
 
@@ -104,7 +103,7 @@ def authenticate_user() -> Optional[ub.User]:
         return None
 
     # Standard password check (convert password to string like Calibre-Web does)
-    if check_password_hash(str(user.password), password):
+    if credential_cache.check_password(user, password):
         log.info(f"authenticate_user: Successfully authenticated user: {user.name}")
         return user
 
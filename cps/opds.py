@@ -62,7 +62,7 @@ def feed_osd():
 @requires_basic_auth_if_no_ano
 def feed_cc_search(query):
     # Handle strange query from Libera Reader with + instead of spaces
-    plus_query = unquote_plus(request.environ['RAW_URI'].split('/opds/search/')[1]).strip()
+    plus_query = unquote_plus(request.environ['RAW_URI'].split('/opds/search/')[1].split('?')[0]).strip()
     return feed_search(plus_query)
 
 
@@ -87,7 +87,8 @@ def feed_letter_books(book_id):
                                                         db.Books,
                                                         letter,
                                                         [db.Books.sort],
-                                                        True, config.config_read_column)
+                                                        True, config.config_read_column,
+                                                        seek=request.args.get("after", ""))
 
     return render_xml_template('feed.xml', entries=entries, pagination=pagination)
 
@@ -100,7 +101,8 @@ def feed_new():
     off = request.args.get("offset") or 0
     entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
                                                         db.Books, True, [db.Books.timestamp.desc()],
-                                                        True, config.config_read_column)
+                                                        True, config.config_read_column,
+                                                        seek=request.args.get("after", ""))
     return render_xml_template('feed.xml', entries=entries, pagination=pagination)
 
 
@@ -124,7 +126,8 @@ def feed_best_rated():
     entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
                                                         db.Books, db.Books.ratings.any(db.Ratings.rating > 9),
                                                         [db.Books.timestamp.desc()],
-                                                        True, config.config_read_column)
+                                                        True, config.config_read_column,
+                                                        seek=request.args.get("after", ""))
     return render_xml_template('feed.xml', entries=entries, pagination=pagination)
 
 
@@ -133,20 +136,10 @@ def feed_best_rated():
 def feed_hot():
     if not auth.current_user().check_visibility(constants.SIDEBAR_HOT):
         abort(404)
-    off = request.args.get("offset") or 0
-    all_books = ub.session.query(ub.Downloads, func.count(ub.Downloads.book_id)).order_by(
-        func.count(ub.Downloads.book_id).desc()).group_by(ub.Downloads.book_id)
-    hot_books = all_books.offset(off).limit(config.config_books_per_page)
-    entries = list()
-    for book in hot_books:
-        query = calibre_db.generate_linked_query(config.config_read_column, db.Books)
-        download_book = query.filter(calibre_db.common_filters()).filter(
-            book.Downloads.book_id == db.Books.id).first()
-        if download_book:
-            entries.append(download_book)
-        else:
-            ub.delete_download(book.Downloads.book_id)
-    num_books = entries.__len__()
+    off = int(request.args.get("offset") or 0)
+    entries, num_books = calibre_db.get_hot_books(off, config.config_books_per_page,
+                                                  [func.count(ub.Downloads.book_id).desc()],
+                                                  config.config_read_column)
     pagination = Pagination((int(off) / (int(config.config_books_per_page)) + 1),
                             config.config_books_per_page, num_books)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination)
@@ -274,7 +267,8 @@ def feed_series(book_id):
                                                         db.Books,
                                                         db.Books.series.any(db.Series.id == book_id),
                                                         [db.Books.series_index],
-                                                        True, config.config_read_column)
+                                                        True, config.config_read_column,
+                                                        seek=request.args.get("after", ""))
     return render_xml_template('feed.xml', entries=entries, pagination=pagination)
 
 
@@ -332,7 +326,8 @@ def feed_format(book_id):
                                                         db.Books,
                                                         db.Books.data.any(db.Data.format == book_id.upper()),
                                                         [db.Books.timestamp.desc()],
-                                                        True, config.config_read_column)
+                                                        True, config.config_read_column,
+                                                        seek=request.args.get("after", ""))
     return render_xml_template('feed.xml', entries=entries, pagination=pagination)
 
 
@@ -362,7 +357,8 @@ def feed_languages(book_id):
                                                         db.Books,
                                                         db.Books.languages.any(db.Languages.id == book_id),
                                                         [db.Books.timestamp.desc()],
-                                                        True, config.config_read_column)
+                                                        True, config.config_read_column,
+                                                        seek=request.args.get("after", ""))
     return render_xml_template('feed.xml', entries=entries, pagination=pagination)
 
 
@@ -446,11 +442,7 @@ def get_metadata_calibre_companion(uuid, library):
 @opds.route("/opds/stats")
 @requires_basic_auth_if_no_ano
 def get_database_stats():
-    stat = dict()
-    stat['books'] = calibre_db.session.query(db.Books).count()
-    stat['authors'] = calibre_db.session.query(db.Authors).count()
-    stat['categories'] = calibre_db.session.query(db.Tags).count()
-    stat['series'] = calibre_db.session.query(db.Series).count()
+    stat = calibre_db.get_library_counts()
     return make_response(jsonify(stat))
 
 
@@ -499,9 +491,9 @@ class FeedObject:
 
 def feed_search(term):
     if term:
-        entries, __, ___ = calibre_db.get_search_results(term, config=config)
-        entries_count = len(entries) if len(entries) > 0 else 1
-        pagination = Pagination(1, entries_count, entries_count)
+        off = request.args.get("offset") or 0
+        entries, __, pagination = calibre_db.get_search_results(term, config, off, None,
+                                                                config.config_books_per_page)
         return render_xml_template('feed.xml', searchterm=term, entries=entries, pagination=pagination)
     else:
         return render_xml_template('feed.xml', searchterm="")
@@ -523,7 +515,8 @@ def render_xml_dataset(data_table, book_id):
                                                         db.Books,
                                                         getattr(db.Books, data_table.__tablename__).any(data_table.id == book_id),
                                                         [db.Books.timestamp.desc()],
-                                                        True, config.config_read_column)
+                                                        True, config.config_read_column,
+                                                        seek=request.args.get("after", ""))
     return render_xml_template('feed.xml', entries=entries, pagination=pagination)
 
 
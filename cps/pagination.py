@@ -29,6 +29,8 @@ class Pagination(object):
         self.page = int(page)
         self.per_page = int(per_page)
         self.total_count = int(total_count)
+        # token of the last entry for keyset pagination, set if the page was loaded in keyset mode
+        self.next_seek = None
 
     @property
     def next_offset(self):
@@ -27,6 +27,7 @@ from .ub import User
 
 # CWA specific imports
 import requests
+import threading
 from datetime import datetime
 import os.path
 
@@ -37,6 +38,27 @@ from acw_db import ACW_DB
 
 log = logger.create()
 
+ACW_RELEASE_URL = "https://api.github.com/repos/gelbphoenix/autocaliweb/releases/latest"
+# Hours between two checks for a new ACW release
+ACW_RELEASE_CHECK_INTERVAL = 6
+# Seconds a check waits for GitHub, the previous result stays in place if it doesn't answer
+ACW_RELEASE_TIMEOUT = 10
+
+
+class AcwReleaseState:
+    """Result of the last check for a new ACW release. It's filled in by a scheduled job, rendering a page only reads
+    it and never waits for GitHub"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.update_available = False
+        self.current_version = ""
+        self.tag_name = ""
+        self.checked = None
+        self.last_notification = None
+
+
+acw_release = AcwReleaseState()
+
 def get_sidebar_config(kwargs=None):
     kwargs = kwargs or []
     simple = bool([e for e in ['kindle', 'tolino', "kobo", "bookeen"]
@@ -123,7 +145,8 @@ def get_sidebar_config(kwargs=None):
 def acw_update_available() -> tuple[bool, str, str]:
     with open("/app/ACW_RELEASE", 'r') as f:
         current_version = f.read().strip()
-    response = requests.get("https://api.github.com/repos/gelbphoenix/autocaliweb/releases/latest")
+    response = requests.get(ACW_RELEASE_URL, timeout=ACW_RELEASE_TIMEOUT)
+    response.raise_for_status()
     tag_name = response.json().get('tag_name', current_version)
     return (tag_name != current_version), current_version, tag_name
 
@@ -139,28 +162,44 @@ def get_acw_last_notification() -> str:
             last_notification = f.read()
     return last_notification
 
+# Scheduled job, asks GitHub for the newest release if update notifications are enabled
+def check_acw_release() -> None:
+    try:
+        if not ACW_DB().acw_settings['acw_update_notifications']:
+            return
+        # the date is only taken from the notice file once, afterwards acw_update_notification keeps it up to date
+        last_notification = None if acw_release.last_notification else get_acw_last_notification()
+        update_available, current_version, tag_name = acw_update_available()
+    except Exception as e:
+        print(f"[acw-update-notification-service] The following error occurred when checking for available updates:\n{e}", flush=True)
+        return
+    with acw_release.lock:
+        acw_release.update_available = update_available
+        acw_release.current_version = current_version
+        acw_release.tag_name = tag_name
+        acw_release.checked = datetime.now()
+        if acw_release.last_notification is None:
+            acw_release.last_notification = last_notification
+
+
 # Displays a notification to the user that an update for CWA is available, no matter which page they're on
 # Currently set to only display once per calender day
 def acw_update_notification() -> None:
-    db = ACW_DB()
-    if db.acw_settings['acw_update_notifications']:
-        current_date = datetime.now().strftime("%Y-%m-%d")
-        acw_last_notification = get_acw_last_notification()
-        
-        if acw_last_notification == current_date:
+    current_date = datetime.now().strftime("%Y-%m-%d")
+    with acw_release.lock:
+        if not acw_release.update_available or acw_release.last_notification == current_date:
             return
+        acw_release.last_notification = current_date
+        current_version, tag_name = acw_release.current_version, acw_release.tag_name
+    if not ACW_DB().acw_settings['acw_update_notifications']:
+        return
 
-        update_available, current_version, tag_name = acw_update_available()
-        if update_available:
-            message = f"⚡🚨 ACW UPDATE AVAILABLE! 🚨⚡ Current - {current_version} | Newest - {tag_name} | To update, just re-pull the image! This message will only display once per day |"
-            flash(_(message), category="acw_update")
-            print(f"[acw-update-notification-service] {message}", flush=True)
+    message = f"⚡🚨 ACW UPDATE AVAILABLE! 🚨⚡ Current - {current_version} | Newest - {tag_name} | To update, just re-pull the image! This message will only display once per day |"
+    flash(_(message), category="acw_update")
+    print(f"[acw-update-notification-service] {message}", flush=True)
 
-        with open('/app/acw_update_notice', 'w') as f:
-            f.write(current_date)
-        return
-    else:
-        return
+    with open('/app/acw_update_notice', 'w') as f:
+        f.write(current_date)
 
 
 # Returns the template for rendering and includes the instance name
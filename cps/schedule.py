@@ -19,7 +19,8 @@
 import datetime
 
 from . import config, constants
-from .services.background_scheduler import BackgroundScheduler, CronTrigger, use_APScheduler
+from .services.background_scheduler import BackgroundScheduler, CronTrigger, DateTrigger, IntervalTrigger, use_APScheduler
+from .render_template import check_acw_release, ACW_RELEASE_CHECK_INTERVAL
 from .tasks.database import TaskReconnectDatabase
 from .tasks.clean import TaskClean
 from .tasks.thumbnail import TaskGenerateCoverThumbnails, TaskGenerateSeriesThumbnails, TaskClearCoverThumbnailCache
@@ -81,6 +82,10 @@ def register_scheduled_tasks(reconnect=True):
         if should_task_be_running(start, duration):
             scheduler.schedule_tasks_immediately(tasks=get_scheduled_tasks(reconnect))
 
+        # Look for new ACW releases in the background, admin pages only show the last result
+        scheduler.schedule(func=check_acw_release, trigger=IntervalTrigger(hours=ACW_RELEASE_CHECK_INTERVAL),
+                           name="check acw release")
+
 
 def register_startup_tasks():
     scheduler = BackgroundScheduler()
@@ -95,6 +100,7 @@ def register_startup_tasks():
             scheduler.schedule_tasks_immediately(tasks=get_scheduled_tasks(False))
         else:
             scheduler.schedule_tasks_immediately(tasks=[[lambda: TaskClean(), 'delete temp', True]])
+        scheduler.schedule(func=check_acw_release, trigger=DateTrigger(), name="immediately check acw release")
 
 
 def should_task_be_running(start, duration):
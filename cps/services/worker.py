@@ -16,17 +16,17 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import threading
 import abc
 import uuid
-import time
 
 try:
     import queue
 except ImportError:
     import Queue as queue
 from datetime import datetime
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 from cps import logger
 
@@ -43,6 +43,24 @@ STAT_CANCELLED = 5
 # Only retain this many tasks in dequeued list
 TASK_CLEANUP_TRIGGER = 20
 
+# task execution lanes, every lane has its own queue and runs up to its limit of tasks at the same time
+LANE_CONVERT = 'convert'
+LANE_PRECONVERT = 'preconvert'
+LANE_MAIL = 'mail'
+LANE_THUMBNAILS = 'thumbnails'
+LANE_MAINTENANCE = 'maintenance'
+LANE_UPLOAD = 'upload'
+
+# Limits can be changed with the environment variable ACW_TASK_LANES, e.g. "convert=2,mail=3"
+DEFAULT_LANE_LIMITS = OrderedDict([
+    (LANE_CONVERT, 1),
+    (LANE_PRECONVERT, 1),
+    (LANE_MAIL, 2),
+    (LANE_THUMBNAILS, 1),
+    (LANE_MAINTENANCE, 1),
+    (LANE_UPLOAD, 1),
+])
+
 QueuedTask = namedtuple('QueuedTask', 'num, user, added, task, hidden')
 
 
@@ -53,6 +71,21 @@ def _get_main_thread():
     raise Exception("main thread not found?!")
 
 
+def get_lane_limits(setting=None):
+    limits = OrderedDict(DEFAULT_LANE_LIMITS)
+    setting = os.environ.get('ACW_TASK_LANES', '') if setting is None else setting
+    for entry in setting.split(','):
+        name, __, value = entry.partition('=')
+        name = name.strip()
+        if not name:
+            continue
+        try:
+            limits[name] = max(1, int(value))
+        except ValueError:
+            log.error("Invalid task lane setting '{}', using default".format(entry))
+    return limits
+
+
 class ImprovedQueue(queue.Queue):
     def to_list(self):
         """
@@ -63,6 +96,53 @@ class ImprovedQueue(queue.Queue):
             return list(self.queue)
 
 
+class TaskLane:
+    """Queue of one kind of tasks, worked off by its own pool of threads"""
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.queue = ImprovedQueue()
+        self.running = 0
+        self.finished = 0
+        self.wait_time = 0.0
+        self.run_time = 0.0
+        self.lock = threading.Lock()
+        self.threads = list()
+
+    def start(self, worker):
+        for index in range(self.limit):
+            thread = threading.Thread(target=worker.run_lane, args=(self,),
+                                      name="WorkerLane-{}-{}".format(self.name, index))
+            self.threads.append(thread)
+            thread.start()
+
+    def task_started(self):
+        with self.lock:
+            self.running += 1
+
+    def task_finished(self, item):
+        with self.lock:
+            self.running -= 1
+            self.finished += 1
+            if item.task.start_time:
+                self.wait_time += max((item.task.start_time - item.added).total_seconds(), 0)
+                self.run_time += item.task.runtime.total_seconds()
+
+    @property
+    def stats(self):
+        with self.lock:
+            finished = self.finished
+            return {
+                'name': self.name,
+                'limit': self.limit,
+                'running': self.running,
+                'depth': self.queue.qsize(),
+                'finished': finished,
+                'wait_time': self.wait_time / finished if finished else 0.0,
+                'run_time': self.run_time / finished if finished else 0.0,
+            }
+
+
 # Class for all worker tasks in the background
 class WorkerThread(threading.Thread):
     _instance = None
@@ -81,6 +161,7 @@ class WorkerThread(threading.Thread):
         self.doLock = threading.Lock()
         self.queue = ImprovedQueue()
         self.num = 0
+        self.lanes = OrderedDict((name, TaskLane(name, limit)) for name, limit in get_lane_limits().items())
         self.start()
 
     @classmethod
@@ -101,8 +182,17 @@ class WorkerThread(threading.Thread):
     def tasks(self):
         with self.doLock:
             tasks = self.queue.to_list() + self.dequeued
+            for lane in self.lanes.values():
+                tasks += lane.queue.to_list()
             return sorted(tasks, key=lambda x: x.num)
 
+    @property
+    def lane_stats(self):
+        return [lane.stats for lane in self.lanes.values()]
+
+    def get_lane(self, task):
+        return self.lanes.get(getattr(task, 'lane', LANE_MAINTENANCE)) or self.lanes[LANE_MAINTENANCE]
+
     def cleanup_tasks(self):
         with self.doLock:
             dead = []
@@ -120,9 +210,11 @@ class WorkerThread(threading.Thread):
 
             self.dequeued = sorted(ret, key=lambda y: y.num)
 
-    # Main thread loop starting the different tasks
+    # Main thread loop handing the tasks over to their lanes
     def run(self):
         main_thread = _get_main_thread()
+        for lane in self.lanes.values():
+            lane.start(self)
         while main_thread.is_alive():
             try:
                 # this blocks until something is available. This can cause issues when the main thread dies - this
@@ -132,7 +224,20 @@ class WorkerThread(threading.Thread):
                 # possible file / database corruption
                 item = self.queue.get(timeout=1)
             except queue.Empty:
-                time.sleep(1)
+                continue
+
+            with self.doLock:
+                # move the task in one step to keep it visible in the task list
+                self.get_lane(item.task).queue.put(item)
+            self.queue.task_done()
+
+    # Thread loop of a lane starting the tasks of this lane
+    def run_lane(self, lane):
+        main_thread = _get_main_thread()
+        while main_thread.is_alive():
+            try:
+                item = lane.queue.get(timeout=1)
+            except queue.Empty:
                 continue
 
             with self.doLock:
@@ -145,14 +250,20 @@ class WorkerThread(threading.Thread):
 
             # sometimes tasks (like Upload) don't actually have work to do and are created as already finished
             if item.task.stat is STAT_WAITING:
+                lane.task_started()
                 # CalibreTask.start() should wrap all exceptions in its own error handling
-                item.task.start(self)
+                try:
+                    item.task.start(self)
+                finally:
+                    lane.task_finished(item)
 
             # remove self_cleanup tasks and hidden "System Tasks" from list
             if item.task.self_cleanup or item.hidden:
-                self.dequeued.remove(item)
+                with self.doLock:
+                    if item in self.dequeued:
+                        self.dequeued.remove(item)
 
-            self.queue.task_done()
+            lane.queue.task_done()
 
     def end_task(self, task_id):
         ins = self.get_instance()
@@ -190,6 +301,11 @@ class CalibreTask:
         """Does this task gracefully handle being cancelled (STAT_ENDED, STAT_CANCELLED)?"""
         raise NotImplementedError
 
+    @property
+    def lane(self):
+        """The execution lane this task is queued in"""
+        return LANE_MAINTENANCE
+
     def start(self, *args):
         self.start_time = datetime.now()
         self.stat = STAT_STARTED
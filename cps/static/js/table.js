@@ -19,6 +19,9 @@
 /* global getPath, confirmDialog */
 
 var selections = [];
+// keyset token for loading the page following the last one, only valid for the same sorting and search
+var nextPage = null;
+var lastQuery = null;
 var reload = false;
 
 $(function() {
@@ -936,6 +939,10 @@ function responseHandler(res) {
     $.each(res.rows, function (i, row) {
         row.state = $.inArray(row.id, selections) !== -1;
     });
+    nextPage = null;
+    if (res.after && lastQuery) {
+        nextPage = $.extend({}, lastQuery, {offset: lastQuery.offset + lastQuery.limit, after: res.after});
+    }
     return res;
 }
 
@@ -1204,6 +1211,13 @@ function deleteUser(a,id){
 function queryParams(params)
 {
     params.state = JSON.stringify(selections);
+    params.after = "";
+    if (nextPage && nextPage.offset === params.offset && nextPage.limit === params.limit &&
+        nextPage.sort === params.sort && nextPage.order === params.order && nextPage.search === params.search) {
+        params.after = nextPage.after;
+    }
+    lastQuery = {offset: params.offset, limit: params.limit, sort: params.sort, order: params.order,
+                 search: params.search};
     return params;
 }
 
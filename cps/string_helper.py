@@ -17,8 +17,16 @@
 #  along with this program. If not, see <http://www.gnu.org/licenses/>.
 import re
 
+import unidecode
+
 
 def strip_whitespaces(text):
     text = re.sub(r'^[\s\u200B-\u200D\ufeff]+', '', text)
     text = re.sub(r'[\s\u200B-\u200D\ufeff]+$', '', text)
     return text
+
+
+def normalize_key(text):
+    """Lower case ascii form of text without punctuation, used to compare titles and names loosely"""
+    text = unidecode.unidecode(text or '').lower()
+    return re.sub(r'[^a-z0-9]+', ' ', text).strip()
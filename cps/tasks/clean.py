@@ -21,7 +21,7 @@ import datetime
 from flask_babel import lazy_gettext as N_
 from sqlalchemy.sql.expression import or_
 
-from cps import logger, file_helper, ub
+from cps import logger, file_helper, ub, db, app
 from cps.services.worker import CalibreTask
 
 
@@ -51,10 +51,36 @@ class TaskClean(CalibreTask):
             self._handleError('Error deleting expired session keys: ' + str(ex))
             self.app_db_session.rollback()
             return
+        self.delete_stale_downloads()
 
         self._handleSuccess()
         self.app_db_session.remove()
 
+    def delete_stale_downloads(self):
+        """Removes the downloads of books which no longer exist in the library, they are left over if books get
+        deleted outside of Autocaliweb"""
+        try:
+            book_ids = [row.book_id for row in self.app_db_session.query(ub.Downloads.book_id).distinct()]
+            existing = set()
+            with app.app_context():
+                calibre_db = db.CalibreDB(app)
+                for index in range(0, len(book_ids), db.SQL_PARAMETER_CHUNK):
+                    chunk = book_ids[index:index + db.SQL_PARAMETER_CHUNK]
+                    existing.update(row.id for row in calibre_db.session.query(db.Books.id)
+                                    .filter(db.Books.id.in_(chunk)))
+            stale = [book_id for book_id in book_ids if book_id not in existing]
+            for index in range(0, len(stale), db.SQL_PARAMETER_CHUNK):
+                self.app_db_session.query(ub.Downloads)\
+                    .filter(ub.Downloads.book_id.in_(stale[index:index + db.SQL_PARAMETER_CHUNK]))\
+                    .delete(synchronize_session=False)
+            self.app_db_session.commit()
+            if stale:
+                self.log.debug("Deleted downloads of {} books missing in the library".format(len(stale)))
+        except Exception as ex:
+            # The library may not be configured yet
+            self.log.debug('Error deleting downloads of deleted books: ' + str(ex))
+            self.app_db_session.rollback()
+
     @property
     def name(self):
         return "Clean up"
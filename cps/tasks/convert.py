@@ -27,7 +27,7 @@ from uuid import uuid4
 from sqlalchemy.exc import SQLAlchemyError
 from flask_babel import lazy_gettext as N_
 
-from cps.services.worker import CalibreTask
+from cps.services.worker import CalibreTask, LANE_CONVERT
 from cps import db, app
 from cps import logger, config
 from cps.subproc_wrapper import process_open
@@ -355,3 +355,7 @@ class TaskConvert(CalibreTask):
     @property
     def is_cancellable(self):
         return False
+
+    @property
+    def lane(self):
+        return LANE_CONVERT
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import itertools
+import os
+import threading
+from collections import deque
+from time import time
+
+from flask_babel import lazy_gettext as N_
+from sqlalchemy.sql import select
+
+from cps import config, db, logger, ub, app
+from cps.services.worker import CalibreTask, WorkerThread, STAT_WAITING, STAT_STARTED, STAT_FAIL, STAT_CANCELLED, \
+    STAT_ENDED, LANE_PRECONVERT
+from cps.tasks.convert import TaskConvert
+
+log = logger.create()
+
+# Number of books waiting in memory for conversion, books not fitting in are picked up again from the database
+# as soon as the backlog has room
+KEPUB_BACKLOG_SIZE = 200
+
+# Books requested by a reader are converted before the ones found by a library sync
+PRIORITY_REQUESTED = 0
+PRIORITY_SYNC = 1
+
+
+class KepubBacklog:
+    """Bounded priority queue of the books waiting for their EPUB to KEPUB conversion"""
+    def __init__(self, size=KEPUB_BACKLOG_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.heap = list()
+        self.priorities = dict()
+        self.sequence = itertools.count()
+        # the task working off the backlog, a task cancelled before it started never gets to reset this
+        self.task = None
+        self.current = None
+        self.failed = set()
+        self.converted = 0
+        self.deferred = 0
+        self.durations = deque(maxlen=50)
+        self.finished_at = deque(maxlen=1000)
+
+    def add(self, book_ids, priority=PRIORITY_SYNC, create_task=None):
+        """Queues the books and returns the task created with create_task if none is working off the backlog"""
+        with self.lock:
+            for book_id in book_ids:
+                if book_id in self.failed or book_id == self.current:
+                    continue
+                queued = self.priorities.get(book_id)
+                if queued is not None and queued <= priority:
+                    continue
+                if queued is None and len(self.priorities) >= self.size:
+                    self.deferred += 1
+                    continue
+                # a book moved up in priority leaves a stale heap entry behind, it is skipped in pop()
+                self.priorities[book_id] = priority
+                heapq.heappush(self.heap, (priority, next(self.sequence), book_id))
+            if create_task and self.priorities and not self._running():
+                self.task = create_task()
+                return self.task
+            return None
+
+    def _running(self):
+        return self.task is not None and self.task.stat in (STAT_WAITING, STAT_STARTED)
+
+    def pop(self):
+        with self.lock:
+            while self.heap:
+                priority, __, book_id = heapq.heappop(self.heap)
+                if self.priorities.get(book_id) == priority:
+                    del self.priorities[book_id]
+                    self.current = book_id
+                    return book_id
+            self.current = None
+            return None
+
+    def done(self, book_id, duration, error=None):
+        with self.lock:
+            self.current = None
+            if error:
+                self.failed.add(book_id)
+            else:
+                self.converted += 1
+                self.durations.append(duration)
+                self.finished_at.append(time())
+
+    def finish(self, task, force=False):
+        """Marks the working task as ended, unless books were queued in the meantime"""
+        with self.lock:
+            if self.priorities and not force:
+                return False
+            # a newer task took over the backlog already
+            if self.task is task:
+                self.task = None
+                self.current = None
+            return True
+
+    def failed_ids(self):
+        with self.lock:
+            return set(self.failed)
+
+    @property
+    def free(self):
+        with self.lock:
+            return max(self.size - len(self.priorities), 0)
+
+    @property
+    def stats(self):
+        with self.lock:
+            hour_ago = time() - 3600
+            average = sum(self.durations) / len(self.durations) if self.durations else 0.0
+            return {
+                'queued': len(self.priorities),
+                'capacity': self.size,
+                'running': self._running(),
+                'current': self.current,
+                'converted': self.converted,
+                'failed': len(self.failed),
+                'deferred': self.deferred,
+                'converted_last_hour': sum(1 for finished in self.finished_at if finished > hour_ago),
+                'average_seconds': round(average, 2),
+                'books_per_hour': round(3600 / average, 1) if average else 0.0,
+            }
+
+
+kepub_backlog = KepubBacklog()
+
+
+def queue_kepub_conversion(book_ids, priority=PRIORITY_SYNC):
+    """Defers the KEPUB conversion of the given books (which have EPUB but no KEPUB) to the background"""
+    if not config.config_kepubifypath or not book_ids:
+        return
+    task = kepub_backlog.add(book_ids, priority,
+                             lambda: TaskPreconvertKepub(N_("Convert EPUB to KEPUB for Kobo devices")))
+    if task:
+        WorkerThread.add(None, task)
+
+
+class TaskPreconvertKepub(CalibreTask):
+    """Works off the KEPUB backlog one book after the other and refills it from the books already synced to a Kobo
+    device which are still missing their KEPUB"""
+    def __init__(self, task_message):
+        super(TaskPreconvertKepub, self).__init__(task_message)
+        self.backlog = kepub_backlog
+        self.converted = 0
+
+    def run(self, worker_thread):
+        try:
+            with app.app_context():
+                worker_db = db.CalibreDB(app)
+                while self.stat not in (STAT_CANCELLED, STAT_ENDED):
+                    book_id = self.backlog.pop()
+                    if book_id is None:
+                        if self.refill(worker_db):
+                            continue
+                        if self.backlog.finish(self):
+                            break
+                        continue
+                    start = time()
+                    error = self.convert(worker_db, book_id, worker_thread)
+                    self.backlog.done(book_id, time() - start, error)
+                    if error:
+                        log.error("KEPUB conversion of book %s failed: %s", book_id, error)
+                    else:
+                        self.converted += 1
+                    queued = self.backlog.stats['queued']
+                    self.progress = self.converted / (self.converted + queued) if queued else 1
+                worker_db.session.close()
+        finally:
+            self.backlog.finish(self, force=True)
+        if self.stat not in (STAT_CANCELLED, STAT_ENDED):
+            self._handleSuccess()
+
+    def refill(self, worker_db):
+        free = self.backlog.free
+        if not free:
+            return False
+        failed = self.backlog.failed_ids()
+        synced_books = select(ub.KoboSyncedBooks.book_id)
+        # failed books are skipped here instead of in SQL, there can be more of them than SQLite allows parameters
+        book_ids = [row.id for row in worker_db.session.query(db.Books.id)
+                    .filter(db.Books.data.any(db.Data.format == 'EPUB'))
+                    .filter(~db.Books.data.any(db.Data.format == 'KEPUB'))
+                    .filter(db.Books.id.in_(synced_books))
+                    .order_by(db.Books.timestamp.desc())
+                    .limit(free + len(failed))
+                    if row.id not in failed][:free]
+        worker_db.session.rollback()
+        self.backlog.add(book_ids)
+        return bool(book_ids)
+
+    def convert(self, worker_db, book_id, worker_thread):
+        book = worker_db.get_book(book_id)
+        data = worker_db.get_book_format(book_id, 'EPUB')
+        worker_db.session.rollback()
+        if not book or not data:
+            return N_("%(format)s format not found for book id: %(book)d", format='EPUB', book=book_id)
+        file_path = os.path.join(config.get_book_path(), book.path, data.name)
+        converter = TaskConvert(file_path, book_id, self.message,
+                                {'old_book_format': 'EPUB', 'new_book_format': 'KEPUB'}, None)
+        converter.start(worker_thread)
+        if converter.stat == STAT_FAIL:
+            return converter.error or N_('Ebook converter failed with unknown error')
+        return None
+
+    @property
+    def name(self):
+        return N_("Convert")
+
+    def __str__(self):
+        return "Convert KEPUB backlog"
+
+    @property
+    def is_cancellable(self):
+        return True
+
+    @property
+    def lane(self):
+        return LANE_PRECONVERT
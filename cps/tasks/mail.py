@@ -17,22 +17,25 @@
 #  along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import re
+import base64
 import smtplib
 import ssl
 import threading
 import socket
 import mimetypes
+import time
 
-from io import StringIO
+from io import BytesIO
 from email.message import EmailMessage
 from email.utils import formatdate, parseaddr, make_msgid
-from email.generator import Generator
+from email.generator import BytesGenerator
 from flask_babel import lazy_gettext as N_
 
-from cps.services.worker import CalibreTask
+from cps.services.worker import CalibreTask, LANE_MAIL
 from cps.services import gmail
-from cps.embed_helper import do_calibre_export
-from cps import logger, config
+from cps.embed_helper import do_calibre_export, get_embedded_file
+from cps import logger, config, db, app
 from cps import gdriveutils
 from cps.string_helper import strip_whitespaces
 
@@ -40,6 +43,43 @@ from cps.string_helper import strip_whitespaces
 log = logger.create()
 
 CHUNKSIZE = 8192
+# Bytes of the attachment read and encoded at once, a multiple of the 57 bytes base64 puts into one 76 character line
+ATTACHMENT_CHUNKSIZE = 57 * 1024
+# Connections to a mail server are kept open this many seconds after a mail was sent, for the next mail in the queue
+SMTP_IDLE_TIMEOUT = 60
+
+
+class StreamedAttachment:
+    """File attached to a mail, base64 encoded from disk while the mail is sent instead of being read into memory"""
+    def __init__(self, path, temporary=False):
+        self.path = path
+        self.temporary = temporary
+        self.placeholder = None
+
+    @property
+    def encoded_size(self):
+        size = os.path.getsize(self.path)
+        characters = (size + 2) // 3 * 4
+        return characters + (characters + 75) // 76 * 2
+
+    def read(self):
+        with open(self.path, 'rb') as file_:
+            return file_.read()
+
+    def chunks(self):
+        with open(self.path, 'rb') as file_:
+            while True:
+                data = file_.read(ATTACHMENT_CHUNKSIZE)
+                if not data:
+                    break
+                yield base64.encodebytes(data).replace(b"\n", b"\r\n")
+
+    def close(self):
+        if self.temporary:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
 
 
 # Class for sending email with ability to get current progress
@@ -84,6 +124,51 @@ class EmailBase:
     def _print_debug(cls, *args):
         log.debug(args)
 
+    def send_streamed(self, from_addr, to_addrs, parts, size):
+        """Same as sendmail(), but the message is sent from an iterable of byte chunks with CRLF line endings and
+        leading periods already doubled, so it never has to be in memory as a whole"""
+        self.ehlo_or_helo_if_needed()
+        options = ["size=%d" % size] if self.does_esmtp and self.has_extn('size') else []
+        (code, resp) = self.mail(from_addr, options)
+        if code != 250:
+            if code == 421:
+                self.close()
+            else:
+                self._rset()
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+        refused = {}
+        for address in to_addrs:
+            (code, resp) = self.rcpt(address)
+            if code not in (250, 251):
+                refused[address] = (code, resp)
+            if code == 421:
+                self.close()
+                raise smtplib.SMTPRecipientsRefused(refused)
+        if len(refused) == len(to_addrs):
+            self._rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+        self.putcmd("data")
+        (code, resp) = self.getreply()
+        if code != 354:
+            self._rset()
+            raise smtplib.SMTPDataError(code, resp)
+        self.transferSize = size
+        self.progress = 0
+        try:
+            for part in parts:
+                self.sock.sendall(part)
+                self.progress += len(part)
+            self.sock.sendall(b".\r\n")
+        except socket.error:
+            self.close()
+            raise smtplib.SMTPServerDisconnected('Server not connected')
+        (code, resp) = self.getreply()
+        self.transferSize = 0
+        if code != 250:
+            self._rset()
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
     def getTransferStatus(self):
         if self.transferSize:
             lock2 = threading.Lock()
@@ -109,6 +194,67 @@ class EmailSSL(EmailBase, smtplib.SMTP_SSL):
         smtplib.SMTP_SSL.__init__(self, *args, **kwargs)
 
 
+class SMTPPool:
+    """Keeps logged in connections to mail servers open for a short while, so mails queued one after the other don't
+    each pay for connecting, TLS handshake and login"""
+    def __init__(self, idle_timeout=SMTP_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.idle = dict()
+        self.timer = None
+
+    def acquire(self, key):
+        """Returns an idle connection for the settings in key which still answers, None if there is none"""
+        while True:
+            with self.lock:
+                connections = self.idle.get(key)
+                if not connections:
+                    return None
+                connection, released = connections.pop()
+            if time.monotonic() - released < self.idle_timeout:
+                try:
+                    if connection.noop()[0] == 250:
+                        return connection
+                except (smtplib.SMTPException, socket.error):
+                    pass
+            self._quit(connection)
+
+    def release(self, key, connection):
+        with self.lock:
+            self.idle.setdefault(key, []).append((connection, time.monotonic()))
+            if self.timer is None:
+                self.timer = threading.Timer(self.idle_timeout, self.close_idle)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def close_idle(self):
+        expired = []
+        with self.lock:
+            self.timer = None
+            now = time.monotonic()
+            for key, connections in list(self.idle.items()):
+                expired.extend(entry[0] for entry in connections if now - entry[1] >= self.idle_timeout)
+                connections[:] = [entry for entry in connections if now - entry[1] < self.idle_timeout]
+                if not connections:
+                    del self.idle[key]
+            if self.idle and self.timer is None:
+                self.timer = threading.Timer(self.idle_timeout, self.close_idle)
+                self.timer.daemon = True
+                self.timer.start()
+        for connection in expired:
+            self._quit(connection)
+
+    @staticmethod
+    def _quit(connection):
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, socket.error):
+            connection.close()
+
+
+smtp_pool = SMTPPool()
+
+
 class TaskEmail(CalibreTask):
     def __init__(self, subject, filepath, attachment, settings, recipient, task_message, text, id=0, internal=False):
         super(TaskEmail, self).__init__(task_message)
@@ -135,7 +281,9 @@ class TaskEmail(CalibreTask):
             msgid_domain = ''
         return msgid_domain or 'autocaliweb.com'
 
-    def prepare_message(self):
+    def prepare_message(self, streamed=False):
+        """Returns the message and its attachment. A streamed attachment is represented by a placeholder in the message
+        which is replaced by the file while sending"""
         message = EmailMessage()
         # message = MIMEMultipart()
         message['From'] = self.settings["mail_from"]
@@ -144,28 +292,37 @@ class TaskEmail(CalibreTask):
         message['Date'] = formatdate(localtime=True)
         message['Message-ID'] = make_msgid(domain=self.get_msgid_domain())
         message.set_content(self.text.encode('UTF-8'), "text", "plain")
+        attachment = None
         if self.attachment:
-            data = self._get_attachment(self.filepath, self.attachment)
-            if data:
+            attachment = self._get_attachment(self.filepath, self.attachment)
+            if attachment:
                 # Set mimetype
                 content_type, encoding = mimetypes.guess_type(self.attachment)
                 if content_type is None or encoding is not None:
                     content_type = 'application/octet-stream'
                 main_type, sub_type = content_type.split('/', 1)
+                if streamed:
+                    # 45 random bytes are one line of base64 without padding, unique within the message
+                    attachment.placeholder = os.urandom(45)
+                    data = attachment.placeholder
+                else:
+                    data = attachment.read()
                 message.add_attachment(data, maintype=main_type, subtype=sub_type, filename=self.attachment)
             else:
                 self._handleError("Attachment not found")
-                return
-        return message
+                return None, None
+        return message, attachment
 
     def run(self, worker_thread):
+        attachment = None
         try:
             # create MIME message
-            msg = self.prepare_message()
+            streamed = self.settings['mail_server_type'] == 0
+            msg, attachment = self.prepare_message(streamed)
             if not msg:
                 return
-            if self.settings['mail_server_type'] == 0:
-                self.send_standard_email(msg)
+            if streamed:
+                self.send_standard_email(msg, attachment)
             else:
                 self.send_gmail_email(msg)
         except MemoryError as e:
@@ -192,39 +349,68 @@ class TaskEmail(CalibreTask):
         except Exception as ex:
             log.error_or_exception(ex, stacklevel=2)
             self._handleError('Error sending e-mail: {}'.format(ex))
+        finally:
+            if attachment:
+                attachment.close()
 
-    def send_standard_email(self, msg):
+    def connect_smtp(self):
         use_ssl = int(self.settings.get('mail_use_ssl', 0))
         timeout = 600  # set timeout to 5mins
 
-        # on python3 debugoutput is caught with overwritten _print_debug function
-        log.debug("Start sending e-mail")
         if use_ssl == 2:
             context = ssl.create_default_context()
-            self.asyncSMTP = EmailSSL(self.settings["mail_server"], self.settings["mail_port"],
-                                       timeout=timeout, context=context)
+            connection = EmailSSL(self.settings["mail_server"], self.settings["mail_port"],
+                                  timeout=timeout, context=context)
         else:
-            self.asyncSMTP = Email(self.settings["mail_server"], self.settings["mail_port"], timeout=timeout)
+            connection = Email(self.settings["mail_server"], self.settings["mail_port"], timeout=timeout)
 
         # link to logginglevel
         if logger.is_debug_enabled():
-            self.asyncSMTP.set_debuglevel(1)
+            connection.set_debuglevel(1)
         if use_ssl == 1:
             context = ssl.create_default_context()
-            self.asyncSMTP.starttls(context=context)
+            connection.starttls(context=context)
         if self.settings["mail_password_e"]:
-            self.asyncSMTP.login(str(self.settings["mail_login"]), str(self.settings["mail_password_e"]))
+            connection.login(str(self.settings["mail_login"]), str(self.settings["mail_password_e"]))
+        return connection
 
-        # Convert message to something to send
-        fp = StringIO()
-        gen = Generator(fp, mangle_from_=False)
-        gen.flatten(msg)
-
-        self.asyncSMTP.sendmail(self.settings["mail_from"], self.recipient, fp.getvalue())
-        self.asyncSMTP.quit()
+    def send_standard_email(self, msg, attachment=None):
+        # on python3 debugoutput is caught with overwritten _print_debug function
+        log.debug("Start sending e-mail")
+        key = (self.settings["mail_server"], self.settings["mail_port"], int(self.settings.get('mail_use_ssl', 0)),
+               self.settings["mail_login"], self.settings["mail_password_e"])
+        # flattened before a connection is taken, nothing has to be cleaned up if it fails
+        parts, size = self.flatten_message(msg, attachment)
+        self.asyncSMTP = smtp_pool.acquire(key) or self.connect_smtp()
+        try:
+            self.asyncSMTP.send_streamed(self.settings["mail_from"], [self.recipient], parts, size)
+        except Exception:
+            self.asyncSMTP.close()
+            raise
+        smtp_pool.release(key, self.asyncSMTP)
         self._handleSuccess()
         log.debug("E-mail send successfully")
 
+    @staticmethod
+    def flatten_message(msg, attachment=None):
+        """Returns the message as SMTP DATA chunks and their total size, with the attachment encoded from its file
+        in place of the placeholder"""
+        fp = BytesIO()
+        BytesGenerator(fp, mangle_from_=False, policy=msg.policy.clone(linesep="\r\n")).flatten(msg)
+        # a line starting with a period gets a second one, as in smtplib.quotedata
+        message = re.sub(br'(?m)^\.', b'..', fp.getvalue())
+        if not message.endswith(b"\r\n"):
+            message += b"\r\n"
+        if not attachment or not attachment.placeholder:
+            return [message], len(message)
+        head, tail = message.split(base64.b64encode(attachment.placeholder) + b"\r\n", 1)
+
+        def parts():
+            yield head
+            yield from attachment.chunks()
+            yield tail
+        return parts(), len(head) + attachment.encoded_size + len(tail)
+
     def send_gmail_email(self, message):
         gmail.send_messsage(self.settings.get('mail_gmail_token', None), message)
         self._handleSuccess()
@@ -244,7 +430,7 @@ class TaskEmail(CalibreTask):
             self._progress = x
 
     def _get_attachment(self, book_path, filename):
-        """Get file as MIMEBase message"""
+        """Get file to attach as StreamedAttachment"""
         calibre_path = config.get_book_path()
         extension = os.path.splitext(filename)[1][1:]
         if config.config_use_google_drive:
@@ -257,26 +443,36 @@ class TaskEmail(CalibreTask):
             else:
                 return None
             if config.config_binariesdir and config.config_embed_metadata:
-                data_path, data_file = do_calibre_export(self.book_id, extension)
+                data_path, data_file, cached = self._export_with_metadata(extension)
+                return StreamedAttachment(os.path.join(data_path, data_file + "." + extension), temporary=not cached)
+            # the downloaded copy is deleted once the mail is sent
+            return StreamedAttachment(datafile, temporary=True)
+        datafile = os.path.join(calibre_path, book_path, filename)
+        # an export that could not be cached is deleted once the mail is sent
+        temporary = False
+        try:
+            if config.config_binariesdir and config.config_embed_metadata:
+                data_path, data_file, cached = self._export_with_metadata(extension, datafile)
                 datafile = os.path.join(data_path, data_file + "." + extension)
-            with open(datafile, 'rb') as file_:
-                data = file_.read()
-            os.remove(datafile)
-        else:
-            datafile = os.path.join(calibre_path, book_path, filename)
-            try:
-                if config.config_binariesdir and config.config_embed_metadata:
-                    data_path, data_file = do_calibre_export(self.book_id, extension)
-                    datafile = os.path.join(data_path, data_file + "." + extension)
-                with open(datafile, 'rb') as file_:
-                    data = file_.read()
-                if config.config_binariesdir and config.config_embed_metadata:
-                    os.remove(datafile)
-            except IOError as e:
-                log.error_or_exception(e, stacklevel=2)
-                log.error('The requested file could not be read. Maybe wrong permissions?')
-                return None
-        return data
+                temporary = not cached
+            with open(datafile, 'rb'):
+                pass
+        except IOError as e:
+            log.error_or_exception(e, stacklevel=2)
+            log.error('The requested file could not be read. Maybe wrong permissions?')
+            return None
+        return StreamedAttachment(datafile, temporary=temporary)
+
+    def _export_with_metadata(self, extension, source_path=None):
+        """Returns folder and file name of the attachment with embedded metadata, shared with the downloads cache, and
+        whether the file belongs to the cache"""
+        with app.app_context():
+            worker_db = db.CalibreDB(app)
+            book = worker_db.get_book(self.book_id)
+            if not book:
+                return do_calibre_export(self.book_id, extension) + (False,)
+            return get_embedded_file(worker_db.session, book, extension,
+                                     lambda: do_calibre_export(self.book_id, extension), source_path=source_path)
 
     @property
     def name(self):
@@ -286,5 +482,9 @@ class TaskEmail(CalibreTask):
     def is_cancellable(self):
         return False
 
+    @property
+    def lane(self):
+        return LANE_MAIL
+
     def __str__(self):
         return "E-mail {}, {}".format(self.name, self.subject)
@@ -18,13 +18,18 @@
 
 import os
 from lxml import etree
+from sqlalchemy.orm import selectinload
 
 from cps import config, db, gdriveutils, logger, app
-from cps.services.worker import CalibreTask
+from cps.services.worker import CalibreTask, STAT_CANCELLED, STAT_ENDED
 from flask_babel import lazy_gettext as N_
 
 from ..epub_helper import create_new_metadata_backup
 
+# Number of books loaded, backed up and removed from metadata_dirtied at once
+METADATA_BACKUP_CHUNK = 200
+BOOK_RELATIONS = ('authors', 'tags', 'comments', 'series', 'ratings', 'languages', 'publishers', 'identifiers')
+
 
 class TaskBackupMetadata(CalibreTask):
 
@@ -49,9 +54,7 @@ class TaskBackupMetadata(CalibreTask):
         with app.app_context():
             calibre_dbb = db.CalibreDB(app)
             try:
-                books = calibre_dbb.session.query(db.Books).all()
-                for book in books:
-                    calibre_dbb.set_metadata_dirty(book.id)
+                calibre_dbb.set_all_metadata_dirty()
                 calibre_dbb.session.commit()
                 self._handleSuccess()
             except Exception as ex:
@@ -62,26 +65,46 @@ class TaskBackupMetadata(CalibreTask):
 
     def backup_metadata(self):
         with app.app_context():
+            book = None
             try:
                 calibre_dbb = db.CalibreDB(app)
-                metadata_backup = calibre_dbb.session.query(db.Metadata_Dirtied).all()
+                book_ids = [row.book for row in calibre_dbb.session.query(db.Metadata_Dirtied.book)
+                            .order_by(db.Metadata_Dirtied.book)]
                 custom_columns = (calibre_dbb.session.query(db.CustomColumns)
                                   .filter(db.CustomColumns.mark_for_delete == 0)
                                   .filter(db.CustomColumns.datatype.notin_(db.cc_exceptions))
                                   .order_by(db.CustomColumns.label).all())
-                count = len(metadata_backup)
-                i = 0
-                for backup in metadata_backup:
-                    book = calibre_dbb.session.query(db.Books).filter(db.Books.id == backup.book).one_or_none()
+                relations = [getattr(db.Books, relation) for relation in BOOK_RELATIONS]
+                relations.extend(getattr(db.Books, 'custom_column_' + str(cc.id)) for cc in custom_columns)
+                count = len(book_ids)
+                # not a problem of single books, they stay queued for the next run
+                if count and config.config_use_google_drive and not gdriveutils.is_gdrive_ready():
+                    raise Exception('Google Drive is configured but not ready')
+                for start in range(0, count, METADATA_BACKUP_CHUNK):
+                    chunk = book_ids[start:start + METADATA_BACKUP_CHUNK]
+                    books = (calibre_dbb.session.query(db.Books)
+                             .filter(db.Books.id.in_(chunk))
+                             .options(*[selectinload(relation) for relation in relations]).all())
+                    for book in books:
+                        try:
+                            self.open_metadata(book, custom_columns)
+                        except Exception as ex:
+                            # a book failing again on every run would block all books after it
+                            self.log.error("Metadata backup of book {} failed: {}".format(book.id, ex))
+                    for book_id in set(chunk) - set(book.id for book in books):
+                        self.log.error("Book {} not found in database".format(book_id))
+                    # books are only removed from the queue once their backup is written or failed
                     calibre_dbb.session.query(db.Metadata_Dirtied).filter(
-                        db.Metadata_Dirtied.book == backup.book).delete()
+                        db.Metadata_Dirtied.book.in_(chunk)).delete(synchronize_session=False)
                     calibre_dbb.session.commit()
-                    if book:
-                        self.open_metadata(book, custom_columns)
-                    else:
-                        self.log.error("Book {} not found in database".format(backup.book))
-                    i += 1
-                    self.progress = (1.0 / count) * i
+                    # drop the loaded books, the session would otherwise hold the whole library at the end
+                    calibre_dbb.session.expunge_all()
+                    self.progress = (1.0 / count) * min(start + METADATA_BACKUP_CHUNK, count)
+
+                    if self.stat in (STAT_CANCELLED, STAT_ENDED):
+                        self.log.info('Metadata backup has been stopped, {} books remain queued'.format(
+                            max(count - start - METADATA_BACKUP_CHUNK, 0)))
+                        return
                 self._handleSuccess()
                 # self.calibre_db.session.close()
 
@@ -17,15 +17,17 @@
 #   along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import os
-from shutil import copyfile, copyfileobj
+from collections import namedtuple, OrderedDict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from urllib.request import urlopen
-from io import BytesIO
 from datetime import datetime, timezone
 
 from .. import constants
+from .thumbnail_worker import generate_cover_thumbnails, get_resize_height, get_resize_width
 from cps import config, db, fs, gdriveutils, logger, ub, app
-from cps.services.worker import CalibreTask, STAT_CANCELLED, STAT_ENDED
-from sqlalchemy import func, text, or_
+from cps.services.worker import CalibreTask, STAT_CANCELLED, STAT_ENDED, LANE_THUMBNAILS
+from sqlalchemy import func, text, or_, and_
 from flask_babel import lazy_gettext as N_
 
 try:
@@ -34,16 +36,21 @@ try:
 except (ImportError, RuntimeError) as e:
     use_IM = False
 
+# Number of books whose thumbnail rows are written with one commit
+THUMBNAIL_COMMIT_BATCH = 50
 
-def get_resize_height(resolution):
-    return int(255 * resolution)
-
+# Forking this multithreaded server could copy locks held by other threads into the workers, they are forked from a
+# single threaded server process instead. The server imports the cps package once for the image code, the workers
+# forked from it start with everything loaded
+try:
+    POOL_CONTEXT = multiprocessing.get_context("forkserver")
+    POOL_CONTEXT.set_forkserver_preload(['cps.tasks.thumbnail_worker'])
+except ValueError:
+    # no fork server on Windows
+    POOL_CONTEXT = multiprocessing.get_context("spawn")
 
-def get_resize_width(resolution, original_width, original_height):
-    height = get_resize_height(resolution)
-    percent = (height / float(original_height))
-    width = int((float(original_width) * float(percent)))
-    return width if width % 2 == 0 else width + 1
+CoverBook = namedtuple('CoverBook', 'id, path, last_modified, thumbnails')
+CoverThumbnail = namedtuple('CoverThumbnail', 'id, resolution, generated_at, filename')
 
 
 def get_best_fit(width, height, image_width, image_height):
@@ -80,30 +87,36 @@ class TaskGenerateCoverThumbnails(CalibreTask):
     def run(self, worker_thread):
         if use_IM and self.stat != STAT_CANCELLED and self.stat != STAT_ENDED:
             self.message = 'Scanning Books'
-            books_with_covers = self.get_books_with_covers(self.book_id)
-            count = len(books_with_covers)
+            books = self.get_books_with_cover_thumbnails(self.book_id)
+            count = len(books)
 
             total_generated = 0
-            for i, book in enumerate(books_with_covers):
-
-                # Generate new thumbnails for missing covers
-                generated = self.create_book_cover_thumbnails(book)
-
-                # Increment the progress
-                self.progress = (1.0 / count) * i
+            done = 0
+            workers = 1 if count <= 1 else max(1, min(os.cpu_count() or 1, count))
+            batch_size = max(THUMBNAIL_COMMIT_BATCH, workers * 8)
+            executor = ProcessPoolExecutor(max_workers=workers, mp_context=POOL_CONTEXT) if workers > 1 else None
+            try:
+                for start in range(0, count, batch_size):
+                    jobs = self.prepare_thumbnail_jobs(books[start:start + batch_size])
+                    for generated in self.generate_thumbnails(jobs, executor):
+                        total_generated += generated
+                        self.message = N_('Generated %(count)s cover thumbnails', count=total_generated)
+                    done += len(books[start:start + batch_size])
 
-                if generated > 0:
-                    total_generated += generated
-                    self.message = N_('Generated %(count)s cover thumbnails', count=total_generated)
+                    # Increment the progress
+                    self.progress = (1.0 / count) * done
 
-                # Check if job has been cancelled or ended
-                if self.stat == STAT_CANCELLED:
-                    self.log.info(f'GenerateCoverThumbnails task has been cancelled.')
-                    return
+                    # Check if job has been cancelled or ended
+                    if self.stat == STAT_CANCELLED:
+                        self.log.info(f'GenerateCoverThumbnails task has been cancelled.')
+                        return
 
-                if self.stat == STAT_ENDED:
-                    self.log.info(f'GenerateCoverThumbnails task has been ended.')
-                    return
+                    if self.stat == STAT_ENDED:
+                        self.log.info(f'GenerateCoverThumbnails task has been ended.')
+                        return
+            finally:
+                if executor:
+                    executor.shutdown(wait=True)
 
             if total_generated == 0:
                 self.self_cleanup = True
@@ -112,121 +125,125 @@ class TaskGenerateCoverThumbnails(CalibreTask):
         self.app_db_session.remove()
 
     @staticmethod
-    def get_books_with_covers(book_id=-1):
+    def get_books_with_cover_thumbnails(book_id=-1):
+        """Returns all books with a cover together with their valid cover thumbnails in one joined query"""
         filter_exp = (db.Books.id == book_id) if book_id != -1 else True
         with app.app_context():
-            calibre_db = db.CalibreDB(app) #, expire_on_commit=False, init=True)
-            books_cover = calibre_db.session.query(db.Books).filter(db.Books.has_cover == 1).filter(filter_exp).all()
-            # calibre_db.session.close()
-        return books_cover
-
-    def get_book_cover_thumbnails(self, book_id):
-        return self.app_db_session \
-            .query(ub.Thumbnail) \
-            .filter(ub.Thumbnail.type == constants.THUMBNAIL_TYPE_COVER) \
-            .filter(ub.Thumbnail.entity_id == book_id) \
-            .filter(or_(ub.Thumbnail.expiration.is_(None), ub.Thumbnail.expiration > datetime.now(timezone.utc))) \
-            .all()
-
-    def create_book_cover_thumbnails(self, book):
-        generated = 0
-        book_cover_thumbnails = self.get_book_cover_thumbnails(book.id)
-
-        # Generate new thumbnails for missing covers
-        resolutions = list(map(lambda t: t.resolution, book_cover_thumbnails))
-        missing_resolutions = list(set(self.resolutions).difference(resolutions))
-        for resolution in missing_resolutions:
-            generated += 1
-            self.create_book_cover_single_thumbnail(book, resolution)
-
-        # Replace outdated or missing thumbnails
-        for thumbnail in book_cover_thumbnails:
-            if book.last_modified.replace(tzinfo=None) > thumbnail.generated_at:
-                generated += 1
-                self.update_book_cover_thumbnail(book, thumbnail)
-
-            elif not self.cache.get_cache_file_exists(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS):
-                generated += 1
-                self.update_book_cover_thumbnail(book, thumbnail)
-        return generated
-
-    def create_book_cover_single_thumbnail(self, book, resolution):
-        thumbnail = ub.Thumbnail()
-        thumbnail.type = constants.THUMBNAIL_TYPE_COVER
-        thumbnail.entity_id = book.id
-        thumbnail.format = 'jpeg'
-        thumbnail.resolution = resolution
-
-        self.app_db_session.add(thumbnail)
+            calibre_db = db.CalibreDB(app)
+            rows = (calibre_db.session.query(db.Books.id, db.Books.path, db.Books.last_modified,
+                                             ub.Thumbnail.id, ub.Thumbnail.resolution,
+                                             ub.Thumbnail.generated_at, ub.Thumbnail.filename)
+                    .outerjoin(ub.Thumbnail,
+                               and_(ub.Thumbnail.entity_id == db.Books.id,
+                                    ub.Thumbnail.type == constants.THUMBNAIL_TYPE_COVER,
+                                    or_(ub.Thumbnail.expiration.is_(None),
+                                        ub.Thumbnail.expiration > datetime.now(timezone.utc))))
+                    .filter(db.Books.has_cover == 1)
+                    .filter(filter_exp)
+                    .order_by(db.Books.id)
+                    .all())
+        books = OrderedDict()
+        for book_id, path, last_modified, thumb_id, resolution, generated_at, filename in rows:
+            book = books.setdefault(book_id, CoverBook(book_id, path, last_modified, []))
+            if thumb_id is not None:
+                book.thumbnails.append(CoverThumbnail(thumb_id, resolution, generated_at, filename))
+        return list(books.values())
+
+    def prepare_thumbnail_jobs(self, books):
+        """Creates missing and marks outdated thumbnail rows of a batch of books with one commit
+
+        Returns a list of (book, [(resolution, format, cache file path)]) entries for the covers to render
+        """
+        jobs = list()
+        new_thumbnails = list()
+        outdated_ids = list()
         try:
+            for book in books:
+                targets = list()
+                # Generate new thumbnails for missing covers
+                resolutions = [t.resolution for t in book.thumbnails]
+                for resolution in set(self.resolutions).difference(resolutions):
+                    thumbnail = ub.Thumbnail()
+                    thumbnail.type = constants.THUMBNAIL_TYPE_COVER
+                    thumbnail.entity_id = book.id
+                    thumbnail.format = 'jpeg'
+                    thumbnail.resolution = resolution
+                    self.app_db_session.add(thumbnail)
+                    new_thumbnails.append((thumbnail, targets))
+
+                # Replace outdated or missing thumbnails
+                for thumbnail in book.thumbnails:
+                    if (book.last_modified.replace(tzinfo=None) > thumbnail.generated_at
+                            or not self.cache.get_cache_file_exists(thumbnail.filename,
+                                                                    constants.CACHE_TYPE_THUMBNAILS)):
+                        outdated_ids.append(thumbnail.id)
+                        self.cache.delete_cache_file(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS)
+                        targets.append((thumbnail.resolution, 'jpeg',
+                                        self.cache.get_cache_file_path(thumbnail.filename,
+                                                                       constants.CACHE_TYPE_THUMBNAILS)))
+                jobs.append((book, targets))
+
+            # flush assigns uuid and filename of the new rows
+            self.app_db_session.flush()
+            for thumbnail, targets in new_thumbnails:
+                targets.append((thumbnail.resolution, thumbnail.format,
+                                self.cache.get_cache_file_path(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS)))
+            if outdated_ids:
+                (self.app_db_session.query(ub.Thumbnail)
+                 .filter(ub.Thumbnail.id.in_(outdated_ids))
+                 .update({ub.Thumbnail.generated_at: datetime.now(timezone.utc)}, synchronize_session=False))
             self.app_db_session.commit()
-            self.generate_book_thumbnail(book, thumbnail)
         except Exception as ex:
             self.log.debug('Error creating book thumbnail: ' + str(ex))
             self._handleError('Error creating book thumbnail: ' + str(ex))
             self.app_db_session.rollback()
-
-    def update_book_cover_thumbnail(self, book, thumbnail):
-        thumbnail.generated_at = datetime.now(timezone.utc)
-
-        try:
-            self.app_db_session.commit()
-            self.cache.delete_cache_file(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS)
-            self.generate_book_thumbnail(book, thumbnail)
-        except Exception as ex:
-            self.log.debug('Error updating book thumbnail: ' + str(ex))
-            self._handleError('Error updating book thumbnail: ' + str(ex))
-            self.app_db_session.rollback()
-
-    def generate_book_thumbnail(self, book, thumbnail):
-        if book and thumbnail:
-            if config.config_use_google_drive:
-                if not gdriveutils.is_gdrive_ready():
-                    raise Exception('Google Drive is configured but not ready')
-
-                content = gdriveutils.get_cover_via_gdrive(book.path)
-                if not content:
-                    raise Exception('Google Drive cover url not found')
+            return list()
+        return [job for job in jobs if job[1]]
+
+    def generate_thumbnails(self, jobs, executor):
+        """Renders the thumbnails of a batch, in the process pool if there is one, yields the number generated"""
+        pending = dict()
+        for book, targets in jobs:
+            try:
+                source = self.get_cover_source(book)
+            except Exception as ex:
+                self.log.debug('Error generating thumbnail file: ' + str(ex))
+                self._handleError('Error creating book thumbnail: ' + str(ex))
+                continue
+            if executor is None:
                 try:
-                    stream = BytesIO(content)
-                    with Image(file=stream) as img:
-                        filename = self.cache.get_cache_file_path(thumbnail.filename,
-                                                                  constants.CACHE_TYPE_THUMBNAILS)
-                        height = get_resize_height(thumbnail.resolution)
-                        if img.height > height:
-                            width = get_resize_width(thumbnail.resolution, img.width, img.height)
-                            img.resize(width=width, height=height, filter='lanczos')
-                            img.format = thumbnail.format
-                            img.save(filename=filename)
-                        else:
-                            stream.seek(0)
-                            with open(filename, 'wb') as fd:
-                                copyfileobj(stream, fd)
-
-
+                    yield generate_cover_thumbnails(source, targets)
                 except Exception as ex:
-                    # Bubble exception to calling function
                     self.log.debug('Error generating thumbnail file: ' + str(ex))
-                    raise ex
-                finally:
-                    if stream is not None:
-                        stream.close()
+                    self._handleError('Error creating book thumbnail: ' + str(ex))
             else:
-                book_cover_filepath = os.path.join(config.get_book_path(), book.path, 'cover.jpg')
-                if not os.path.isfile(book_cover_filepath):
-                    raise Exception('Book cover file not found')
+                pending[executor.submit(generate_cover_thumbnails, source, targets)] = book
+        for future in as_completed(pending):
+            if self.stat in (STAT_CANCELLED, STAT_ENDED):
+                for waiting in pending:
+                    waiting.cancel()
+            if future.cancelled():
+                continue
+            try:
+                yield future.result()
+            except Exception as ex:
+                self.log.debug('Error generating thumbnail file for book {}: {}'.format(pending[future].id, ex))
+                self._handleError('Error creating book thumbnail: ' + str(ex))
 
-                with Image(filename=book_cover_filepath) as img:
-                    height = get_resize_height(thumbnail.resolution)
-                    filename = self.cache.get_cache_file_path(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS)
-                    if img.height > height:
-                        width = get_resize_width(thumbnail.resolution, img.width, img.height)
-                        img.resize(width=width, height=height, filter='lanczos')
-                        img.format = thumbnail.format
-                        img.save(filename=filename)
-                    else:
-                        # take cover as is
-                        copyfile(book_cover_filepath, filename)
+    @staticmethod
+    def get_cover_source(book):
+        if config.config_use_google_drive:
+            if not gdriveutils.is_gdrive_ready():
+                raise Exception('Google Drive is configured but not ready')
+
+            content = gdriveutils.get_cover_via_gdrive(book.path)
+            if not content:
+                raise Exception('Google Drive cover url not found')
+            return content
+        book_cover_filepath = os.path.join(config.get_book_path(), book.path, 'cover.jpg')
+        if not os.path.isfile(book_cover_filepath):
+            raise Exception('Book cover file not found')
+        return book_cover_filepath
 
     @property
     def name(self):
@@ -242,6 +259,10 @@ class TaskGenerateCoverThumbnails(CalibreTask):
     def is_cancellable(self):
         return True
 
+    @property
+    def lane(self):
+        return LANE_THUMBNAILS
+
 
 class TaskGenerateSeriesThumbnails(CalibreTask):
     def __init__(self, task_message=''):
@@ -454,6 +475,10 @@ class TaskGenerateSeriesThumbnails(CalibreTask):
     def is_cancellable(self):
         return True
 
+    @property
+    def lane(self):
+        return LANE_THUMBNAILS
+
 
 class TaskClearCoverThumbnailCache(CalibreTask):
     def __init__(self, book_id, task_message=N_('Clearing cover thumbnail cache')):
@@ -527,3 +552,7 @@ class TaskClearCoverThumbnailCache(CalibreTask):
     @property
     def is_cancellable(self):
         return False
+
+    @property
+    def lane(self):
+        return LANE_THUMBNAILS
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+#   This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#     Copyright (C) 2020 monkey
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Image work of the cover thumbnail task run in its process pool. Unlike cps.tasks.thumbnail it can be imported before
+the command line parameters are parsed, which is the state the processes of the pool start in. Importing it still
+loads the cps package with the application objects."""
+
+from shutil import copyfile
+
+try:
+    from wand.image import Image
+except (ImportError, RuntimeError):
+    # the task doesn't start the pool without Wand
+    pass
+
+
+def get_resize_height(resolution):
+    return int(255 * resolution)
+
+
+def get_resize_width(resolution, original_width, original_height):
+    height = get_resize_height(resolution)
+    percent = (height / float(original_height))
+    width = int((float(original_width) * float(percent)))
+    return width if width % 2 == 0 else width + 1
+
+
+def generate_cover_thumbnails(source, targets):
+    """Decode one cover and write a thumbnail for every (resolution, format, filename) target.
+
+    Runs inside the process pool of TaskGenerateCoverThumbnails, source is either the path of the cover file or
+    the raw image content.
+    """
+    if isinstance(source, bytes):
+        cover = Image(blob=source)
+    else:
+        cover = Image(filename=source)
+    with cover as img:
+        for resolution, file_format, filename in sorted(targets, key=lambda t: t[0], reverse=True):
+            height = get_resize_height(resolution)
+            if img.height > height:
+                width = get_resize_width(resolution, img.width, img.height)
+                with img.clone() as thumb:
+                    thumb.resize(width=width, height=height, filter='lanczos')
+                    thumb.format = file_format
+                    thumb.save(filename=filename)
+            elif isinstance(source, bytes):
+                with open(filename, 'wb') as fd:
+                    fd.write(source)
+            else:
+                # take cover as is
+                copyfile(source, filename)
+    return len(targets)
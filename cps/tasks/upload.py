@@ -16,18 +16,35 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 
+from flask import g, session, url_for
 from flask_babel import lazy_gettext as N_
+from markupsafe import escape, Markup
+from sqlalchemy import event
 
-from cps.services.worker import CalibreTask, STAT_FINISH_SUCCESS
+from cps import app, calibre_db, config, db, gdriveutils, helper, logger, uploader, ub
+from cps.file_helper import get_temp_dir
+from cps.services.worker import CalibreTask, WorkerThread, STAT_FINISH_SUCCESS, STAT_FAIL, LANE_UPLOAD
+
+log = logger.create()
+
+# Number of uploaded books added to the library with one commit
+UPLOAD_COMMIT_BATCH = 20
+# Uploaded files whose metadata is read at the same time
+UPLOAD_WORKERS = min(4, os.cpu_count() or 1)
 
 
 class TaskUpload(CalibreTask):
-    def __init__(self, task_message, book_title):
+    def __init__(self, task_message, book_title, error=None):
         super(TaskUpload, self).__init__(task_message)
         self.start_time = self.end_time = datetime.now()
-        self.stat = STAT_FINISH_SUCCESS
+        self.stat = STAT_FAIL if error else STAT_FINISH_SUCCESS
+        self.error = error
         self.progress = 1
         self.book_title = book_title
 
@@ -44,3 +61,147 @@ class TaskUpload(CalibreTask):
     @property
     def is_cancellable(self):
         return False
+
+
+class TaskUploadBooks(CalibreTask):
+    """Reads the metadata of files uploaded together in parallel and adds them to the library in batches, every file
+    shows up in the task list once it is added"""
+    def __init__(self, task_message, files, user_id, base_url):
+        super(TaskUploadBooks, self).__init__(task_message)
+        self.files = files
+        self.user_id = user_id
+        self.base_url = base_url
+        self.done = 0
+
+    @contextmanager
+    def user_request(self, user):
+        """Request context of the uploading user, the upload helpers translate, flash and build links"""
+        with app.test_request_context(base_url=self.base_url):
+            g.flask_httpauth_user = user
+            yield
+
+    def run(self, worker_thread):
+        # imported here, editbooks imports this module
+        from cps.editbooks import add_uploaded_book
+        app_db_session = ub.get_new_session_instance()
+        user = app_db_session.query(ub.User).filter(ub.User.id == self.user_id).first()
+
+        def read_metadata(staged):
+            tmp_file_path, filename_root, extension = staged
+            with self.user_request(user):
+                return staged, uploader.process(tmp_file_path, filename_root, extension,
+                                                config.config_rarfile_location)
+
+        try:
+            with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor, self.user_request(user):
+                calibre_db.create_functions(config)
+                batch = []
+                for result in executor.map(read_metadata, self.files):
+                    batch.append(result)
+                    if len(batch) >= UPLOAD_COMMIT_BATCH:
+                        self.add_books(batch, add_uploaded_book, user.name)
+                        batch = []
+                if batch:
+                    self.add_books(batch, add_uploaded_book, user.name)
+        finally:
+            app_db_session.remove()
+        self._handleSuccess()
+
+    def add_books(self, batch, add_uploaded_book, user_name):
+        """Adds the books of the batch with one commit, every book gets a savepoint so a failing book only takes its
+        own changes with it"""
+        added = []
+        created = []
+
+        def book_created(__, instance):
+            if isinstance(instance, db.Books):
+                created.append(instance)
+
+        # a failing flush rolls back the savepoint itself and forgets the books inserted in it
+        event.listen(calibre_db.session(), "pending_to_persistent", book_created)
+        try:
+            for staged, meta in batch:
+                file_name = staged[1] + staged[2]
+                created.clear()
+                savepoint = calibre_db.session.begin_nested()
+                try:
+                    db_book, error = add_uploaded_book(meta)
+                    savepoint.commit()
+                    added.append((db_book.id, db_book.title, db_book.path, error))
+                except Exception as ex:
+                    log.error_or_exception("Error adding uploaded file {}: {}".format(file_name, ex))
+                    savepoint.rollback()
+                    for book in created:
+                        self.remove_book_folder(book.id, book.path)
+                    self.remove_staged(staged, meta)
+                    self.report_failure(user_name, file_name, ex)
+                # the helpers flash warnings for the browser, which isn't waiting for them anymore
+                for __, message in session.pop('_flashes', []):
+                    log.warning("Upload of %s: %s", file_name, Markup(message).striptags())
+        finally:
+            event.remove(calibre_db.session(), "pending_to_persistent", book_created)
+
+        try:
+            calibre_db.session.commit()
+        except Exception as ex:
+            calibre_db.session.rollback()
+            log.error_or_exception("Error adding uploaded books: {}".format(ex))
+            for book_id, title, path, __ in added:
+                self.remove_book_folder(book_id, path)
+                self.report_failure(user_name, title, ex)
+            added = []
+
+        if added and config.config_use_google_drive:
+            gdriveutils.updateGdriveCalibreFromLocal()
+        for book_id, title, __, error in added:
+            link = '<a href="{}">{}</a>'.format(url_for('web.show_book', book_id=book_id), escape(title))
+            WorkerThread.add(user_name, TaskUpload(N_("File %(file)s uploaded", file=link), escape(title), error))
+            helper.add_book_to_thumbnail_cache(book_id)
+        self.done += len(batch)
+        self.progress = self.done / len(self.files)
+
+    @staticmethod
+    def remove_book_folder(book_id, book_path):
+        """Deletes the folder the files of a book were already moved to, its database entry is rolled back"""
+        try:
+            if config.config_use_google_drive:
+                g_file = gdriveutils.getFileFromEbooksFolder(os.path.dirname(book_path), book_path.split('/')[-1])
+                if g_file:
+                    gdriveutils.deleteDatabaseEntry(g_file['id'])
+                    g_file.Trash()
+                return
+            book_dir = os.path.join(config.get_book_path(), book_path)
+            if book_path and os.path.isdir(book_dir):
+                shutil.rmtree(book_dir)
+                # the author folder was created for the book if it is empty now
+                if not os.listdir(os.path.dirname(book_dir)):
+                    os.rmdir(os.path.dirname(book_dir))
+        except Exception as ex:
+            log.error("Removing the folder of book %s failed: %s", book_id, ex)
+
+    @staticmethod
+    def remove_staged(staged, meta):
+        for file_path in {staged[0], meta.file_path, meta.cover}:
+            if file_path and os.path.isfile(file_path) and os.path.dirname(file_path) == get_temp_dir():
+                os.remove(file_path)
+
+    @staticmethod
+    def report_failure(user_name, file_name, ex):
+        file_name = escape(file_name)
+        WorkerThread.add(user_name, TaskUpload(N_("File %(file)s could not be added", file=file_name),
+                                               file_name, str(ex)))
+
+    @property
+    def name(self):
+        return N_("Upload")
+
+    def __str__(self):
+        return "Upload {} books".format(len(self.files))
+
+    @property
+    def is_cancellable(self):
+        return False
+
+    @property
+    def lane(self):
+        return LANE_UPLOAD
@@ -16,6 +16,8 @@
 
 from markupsafe import escape
 
+from datetime import datetime, timedelta
+
 from flask import Blueprint, jsonify
 from .cw_login import current_user
 from flask_babel import gettext as _
@@ -44,18 +46,23 @@ def get_email_status_json():
 @user_login_required
 def get_tasks_status():
     # if current user admin, show all email, otherwise only own emails
-    return render_title_template('tasks.html', title=_("Tasks"), page="tasks")
+    lanes = render_lane_status(WorkerThread.get_instance().lane_stats) if current_user.role_admin() else []
+    return render_title_template('tasks.html', title=_("Tasks"), page="tasks", lanes=lanes)
 
 
 # helper function to apply localize status information in tasklist entries
 def render_task_status(tasklist):
     rendered_tasklist = list()
-    for __, user, __, task, __ in tasklist:
+    for __, user, added, task, __ in tasklist:
         if user == current_user.name or current_user.role_admin():
             ret = {}
             if task.start_time:
                 ret['starttime'] = format_datetime(task.start_time, format='short')
                 ret['runtime'] = format_runtime(task.runtime)
+                ret['waittime'] = format_runtime(max(task.start_time - added, timedelta(0)))
+            elif task.stat == STAT_WAITING:
+                ret['waittime'] = format_runtime(datetime.now() - added)
+            ret['lane'] = task.lane
 
             # localize the task status
             if isinstance(task.stat, int):
@@ -89,6 +96,22 @@ def render_task_status(tasklist):
     return rendered_tasklist
 
 
+# helper function for displaying the depth, wait and run time of the task lanes
+def render_lane_status(lane_stats):
+    rendered_lanes = list()
+    for lane in lane_stats:
+        rendered_lanes.append({
+            'name': lane['name'],
+            'limit': lane['limit'],
+            'running': lane['running'],
+            'depth': lane['depth'],
+            'finished': lane['finished'],
+            'wait_time': format_runtime(timedelta(seconds=lane['wait_time'])),
+            'run_time': format_runtime(timedelta(seconds=lane['run_time'])),
+        })
+    return rendered_lanes
+
+
 # helper function for displaying the runtime of tasks
 def format_runtime(runtime):
     ret_val = ""
@@ -135,6 +135,9 @@ def store_combo_ids(result):
         ids.append(element[0].id)
     searched_ids[current_user.id] = ids
 
+def store_search_ids(ids):
+    searched_ids[current_user.id] = list(ids)
+
 
 class UserBase:
 
@@ -544,6 +547,26 @@ class KOSyncProgress(Base):
         return '<KOSyncProgress %r - %r>' % (self.user_id, self.document)
 
 
+# Normalized title and primary author of a book, used to find duplicates which differ in case, accents or punctuation
+class DuplicateKey(Base):
+    __tablename__ = 'duplicate_key'
+
+    book_id = Column(Integer, primary_key=True)
+    title_key = Column(String, index=True)
+    author_key = Column(String)
+    last_modified = Column(DateTime)
+
+
+# Names of authors, tags, series, publishers and custom column values as written to the full text search index,
+# renamed and deleted entries mark the books linked to them for reindexing
+class SearchIndexName(Base):
+    __tablename__ = 'book_search_name'
+
+    kind = Column(String, primary_key=True)
+    item = Column(Integer, primary_key=True)
+    name = Column(String)
+
+
 # Baseclass representing allowed domains for registration
 class Registration(Base):
     __tablename__ = 'registration'
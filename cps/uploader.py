@@ -18,6 +18,7 @@
 
 import os
 import hashlib
+from uuid import uuid4
 from flask_babel import gettext as _
 
 from . import logger, comic, isoLanguages
@@ -275,3 +276,13 @@ def upload(uploadfile, rar_excecutable):
     log.debug("Temporary file: %s", tmp_file_path)
     uploadfile.save(tmp_file_path)
     return process(tmp_file_path, filename_root, file_extension, rar_excecutable)
+
+
+def stage_upload(uploadfile):
+    """Saves the uploaded file under a unique name in the temp dir, for processing it after the request ended.
+    Returns the path, the file name without extension and the extension"""
+    filename_root, file_extension = os.path.splitext(uploadfile.filename)
+    tmp_file_path = os.path.join(get_temp_dir(), uuid4().hex)
+    log.debug("Staged upload: %s", tmp_file_path)
+    uploadfile.save(tmp_file_path)
+    return tmp_file_path, filename_root, file_extension
@@ -16,6 +16,12 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+from collections import OrderedDict
 from functools import wraps
 
 from sqlalchemy.sql.expression import func
@@ -33,6 +39,55 @@ from . import lm, ub, config, logger, limiter, constants, services
 log = logger.create()
 auth = HTTPBasicAuth()
 
+# Verified Basic auth passwords are remembered this many seconds, for this many users
+CREDENTIAL_CACHE_TTL = 300
+CREDENTIAL_CACHE_SIZE = 256
+
+
+class CredentialCache:
+    """Remembers passwords which passed check_password_hash as keyed digests, so e-readers sending their credentials
+    with every request don't cost a password hash each time. The digest covers the stored password hash of the user,
+    so an entry stops matching as soon as the password is changed or the user is deleted"""
+
+    def __init__(self, ttl=CREDENTIAL_CACHE_TTL, size=CREDENTIAL_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._key = secrets.token_bytes(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _digest(self, password_hash, password):
+        return hmac.new(self._key, password_hash.encode() + b"\0" + password.encode(), hashlib.sha256).digest()
+
+    def check_password(self, user, password):
+        password_hash = str(user.password)
+        digest = self._digest(password_hash, password)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user.id)
+            if entry and entry[1] > now and hmac.compare_digest(entry[0], digest):
+                self._entries.move_to_end(user.id)
+                self.hits += 1
+                return True
+            self.misses += 1
+        if not check_password_hash(password_hash, password):
+            return False
+        with self._lock:
+            self._entries[user.id] = (digest, now + self.ttl)
+            self._entries.move_to_end(user.id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+credential_cache = CredentialCache()
+
 
 @auth.verify_password
 def verify_password(username, password):
@@ -50,7 +105,7 @@ def verify_password(username, password):
                 log.error(error)
         else:
             limiter.check()
-            if check_password_hash(str(user.password), password):
+            if credential_cache.check_password(user, password):
                 [limiter.limiter.storage.clear(k.key) for k in limiter.current_limits]
                 return user
     ip_address = request.headers.get('X-Forwarded-For', request.remote_addr)
@@ -133,6 +133,15 @@ web = Blueprint('web', __name__)
 
 log = logger.create()
 
+# Plain book columns the books table can be sorted by
+BOOK_TABLE_SORT_COLUMNS = {
+    "sort": db.Books.sort,
+    "title": db.Books.title,
+    "author_sort": db.Books.author_sort,
+    "authors_sort": db.Books.author_sort,
+    "series_index": db.Books.series_index,
+}
+
 
 # ################################### Login logic and rights management ###############################################
 
@@ -397,18 +406,7 @@ def acw_get_library_location() -> str:
 
 def acw_get_num_books_in_library() -> int:
     try:
-        # Path to user's Calibre library's metadata.db
-        db_path = acw_get_library_location() + "metadata.db"
-        # Connect to the SQLite database
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        # Query the number of books
-        cursor.execute("SELECT COUNT(*) FROM books")
-        count = cursor.fetchone()[0]
-        # Close the connection
-        conn.close()
-        # Return the result
-        return count
+        return calibre_db.get_library_counts()['books']
     except Exception:
         return 0
 
@@ -507,19 +505,8 @@ def render_hot_books(page, order):
             random = false()
 
         off = int(int(config.config_books_per_page) * (page - 1))
-        all_books = ub.session.query(ub.Downloads, func.count(ub.Downloads.book_id)) \
-            .order_by(*order[0]).group_by(ub.Downloads.book_id)
-        hot_books = all_books.offset(off).limit(config.config_books_per_page)
-        entries = list()
-        for book in hot_books:
-            query = calibre_db.generate_linked_query(config.config_read_column, db.Books)
-            download_book = query.filter(calibre_db.common_filters()).filter(
-                book.Downloads.book_id == db.Books.id).first()
-            if download_book:
-                entries.append(download_book)
-            else:
-                ub.delete_download(book.Downloads.book_id)
-        num_books = entries.__len__()
+        entries, num_books = calibre_db.get_hot_books(off, config.config_books_per_page, order[0],
+                                                      config.config_read_column)
         pagination = Pagination(page, config.config_books_per_page, num_books)
         return render_title_template('index.html', random=random, entries=entries, pagination=pagination,
                                      title=_("Hot Books (Most Downloaded)"), page="hot", order=order[1])
@@ -544,10 +531,6 @@ def render_downloaded_books(page, order, user_id):
                                                             db.Books.id == db.books_series_link.c.book,
                                                             db.Series,
                                                             ub.Downloads, db.Books.id == ub.Downloads.book_id)
-        for book in entries:
-            if not (calibre_db.session.query(db.Books).filter(calibre_db.common_filters())
-                    .filter(db.Books.id == book.Books.id).first()):
-                ub.delete_download(book.Books.id)
         return render_title_template('index.html',
                                      random=random,
                                      entries=entries,
@@ -949,13 +932,15 @@ def list_books():
     elif sort_param == "languages":
         order = [db.Languages.lang_code.asc()] if order == "asc" else [db.Languages.lang_code.desc()]
         join = db.books_languages_link, db.Books.id == db.books_languages_link.c.book, db.Languages
-    elif order and sort_param in ["sort", "title", "authors_sort", "series_index"]:
-        order = [text(sort_param + " " + order)]
+    elif order and sort_param in BOOK_TABLE_SORT_COLUMNS:
+        column = BOOK_TABLE_SORT_COLUMNS[sort_param]
+        order = [column.desc() if order == "desc" else column.asc()]
     elif not state:
         order = [db.Books.timestamp.desc()]
 
-    total_count = filtered_count = calibre_db.session.query(db.Books).filter(
-        calibre_db.common_filters(allow_show_archived=True)).count()
+    total_count = filtered_count = calibre_db.cached_count(calibre_db.session.query(db.Books).filter(
+        calibre_db.common_filters(allow_show_archived=True)), allow_show_archived=True)
+    next_seek = None
     if state is not None:
         if search_param:
             books = calibre_db.search_query(search_param, config).all()
@@ -972,15 +957,17 @@ def list_books():
                                                                     limit,
                                                                     *join)
     else:
-        entries, __, __ = calibre_db.fill_indexpage_with_archived_books((int(off) / (int(limit)) + 1),
-                                                                        db.Books,
-                                                                        limit,
-                                                                        True,
-                                                                        order,
-                                                                        True,
-                                                                        True,
-                                                                        config.config_read_column,
-                                                                        *join)
+        entries, __, pagination = calibre_db.fill_indexpage_with_archived_books((int(off) / (int(limit)) + 1),
+                                                                                db.Books,
+                                                                                limit,
+                                                                                True,
+                                                                                order,
+                                                                                True,
+                                                                                True,
+                                                                                config.config_read_column,
+                                                                                *join,
+                                                                                seek=request.args.get("after"))
+        next_seek = pagination.next_seek if pagination else None
 
     result = list()
     for entry in entries:
@@ -992,7 +979,7 @@ def list_books():
                 lang_index].lang_code)
         result.append(val)
 
-    table_entries = {'totalNotFiltered': total_count, 'total': filtered_count, "rows": result}
+    table_entries = {'totalNotFiltered': total_count, 'total': filtered_count, "rows": result, "after": next_seek}
     js_list = json.dumps(table_entries, cls=db.AlchemyEncoder)
 
     response = make_response(js_list)
@@ -1,5 +1,9 @@
+import copy
+import json
 import sqlite3
 import sys
+import threading
+import zlib
 from sqlite3 import Error as sqlError
 import re
 from datetime import datetime
@@ -8,6 +12,12 @@ from tabulate import tabulate
 
 
 class ACW_DB:
+    # The schema is applied once per process and the settings are kept in memory until they are changed, instances
+    # created afterwards only open a connection
+    _schema_lock = threading.Lock()
+    _schema_cache: dict[str, tuple[list[str], list[str], dict]] = {}
+    _settings_cache: dict[str, dict] = {}
+
     def __init__(self, verbose=False):
         self.verbose = verbose
 
@@ -17,13 +27,14 @@ class ACW_DB:
 
         self.schema_path = "/app/autocaliweb/scripts/acw_schema.sql"
         self.stats_tables = ["acw_enforcement", "acw_import", "acw_conversions", "epub_fixes"]
-        self.tables, self.schema = self.make_tables()
+        self.tables, self.schema, self.acw_default_settings = self.load_schema()
 
-        self.acw_default_settings = self.get_acw_default_settings()
-        self.ensure_settings_schema_match()
-        self.match_stat_table_columns_with_schema()
-        self.set_default_settings()
-        self.acw_settings = self.get_acw_settings()
+    @property
+    def acw_settings(self) -> dict:
+        """The settings as last read from acw.db by this process"""
+        if self.db_path + self.db_file not in ACW_DB._settings_cache:
+            return self.get_acw_settings()
+        return copy.deepcopy(ACW_DB._settings_cache[self.db_path + self.db_file])
 
     def connect_to_db(self) -> tuple[sqlite3.Connection, sqlite3.Cursor] | None:
         """Establishes connection with the db or makes one if one doesn't already exist"""
@@ -41,8 +52,29 @@ class ACW_DB:
             return con, cur
 
 
-    def make_tables(self) -> tuple[list[str], list[str]]:
-        """Creates the tables for the ACW DB if they don't already exist"""
+    def load_schema(self) -> tuple[list[str], list[str], dict]:
+        """Brings acw.db up to date with the schema file. This is only done by the first instance of a process and
+        skipped altogether if acw.db was already migrated to the current schema file, which is tracked in its
+        user_version"""
+        key = self.db_path + self.db_file
+        with ACW_DB._schema_lock:
+            if key not in ACW_DB._schema_cache:
+                self.tables, self.schema = self.read_schema()
+                self.acw_default_settings = self.get_acw_default_settings()
+                schema_version = zlib.crc32("".join(self.schema).encode()) & 0x7fffffff
+                if self.cur.execute("PRAGMA user_version;").fetchone()[0] != schema_version:
+                    self.make_tables()
+                    self.ensure_settings_schema_match()
+                    self.match_stat_table_columns_with_schema()
+                    self.set_default_settings()
+                    self.get_acw_settings()
+                    self.cur.execute(f"PRAGMA user_version = {schema_version};")
+                    self.con.commit()
+                ACW_DB._schema_cache[key] = (self.tables, self.schema, self.acw_default_settings)
+            return ACW_DB._schema_cache[key]
+
+
+    def read_schema(self) -> tuple[list[str], list[str]]:
         schema = []
         with open(self.schema_path, 'r') as f:
             for line in f:
@@ -53,13 +85,17 @@ class ACW_DB:
         tables.pop(-1)
         for x in range(len(tables)):
             tables[x] = tables[x] + ";"
-        for table in tables:
-            self.cur.execute(table)
-            self.con.commit()
 
         return tables, schema
 
 
+    def make_tables(self) -> None:
+        """Creates the tables for the ACW DB if they don't already exist"""
+        for table in self.tables:
+            self.cur.execute(table)
+        self.con.commit()
+
+
     def get_acw_default_settings(self):
         for table in self.tables:
             if "acw_settings" in table:
@@ -181,6 +217,7 @@ class ACW_DB:
                 else:
                     self.cur.execute(f'UPDATE acw_settings SET {setting}="{self.acw_default_settings[setting]}";')
                     self.con.commit()
+            self.get_acw_settings()
             print("[acw-db] ACW Default Settings successfully applied!")
             return
         try:
@@ -219,13 +256,15 @@ class ACW_DB:
     def get_acw_settings(self) -> dict:
         """Gets the current acw_settings values from the table of the same name in acw.db and returns them as a dict"""
         self.cur.execute("SELECT * FROM acw_settings")
-        if self.cur.fetchall() == []: # If settings table is empty, populates it with default values
+        rows = self.cur.fetchall()
+        if rows == []: # If settings table is empty, populates it with default values
             self.cur.execute("INSERT INTO acw_settings DEFAULT VALUES;")
             self.con.commit()
-            
-        self.cur.execute("SELECT * FROM acw_settings")
+            self.cur.execute("SELECT * FROM acw_settings")
+            rows = self.cur.fetchall()
+
         headers = [header[0] for header in self.cur.description]
-        acw_settings = [dict(zip(headers,row)) for row in self.cur.fetchall()][0]
+        acw_settings = [dict(zip(headers,row)) for row in rows][0]
 
         for header in headers:
             if type(acw_settings[header]) == int:
@@ -233,6 +272,7 @@ class ACW_DB:
             elif type(acw_settings[header]) == str and ',' in acw_settings[header]:
                 acw_settings[header] = acw_settings[header].split(',')
 
+        ACW_DB._settings_cache[self.db_path + self.db_file] = copy.deepcopy(acw_settings)
         return acw_settings
 
 
@@ -248,6 +288,7 @@ class ACW_DB:
                 self.cur.execute(f'UPDATE acw_settings SET {setting}="{result[setting]}";')
             self.con.commit()
         self.set_default_settings()
+        self.get_acw_settings()
 
 
     def enforce_add_entry_from_log(self, log_info: dict):
@@ -270,6 +311,17 @@ class ACW_DB:
             self.con.commit()
 
 
+    def get_last_enforcements(self) -> dict[int, float]:
+        """Returns the time each book's cover & metadata were last enforced, by book id"""
+        last_enforcements = {}
+        for book_id, timestamp in self.cur.execute("SELECT book_id, MAX(timestamp) FROM acw_enforcement GROUP BY book_id;"):
+            try:
+                last_enforcements[int(book_id)] = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S').timestamp()
+            except (TypeError, ValueError):
+                continue
+        return last_enforcements
+
+
     def enforce_show(self, paths: bool, verbose: bool, web_ui=False):
         results_no_path = self.cur.execute("SELECT timestamp, book_id, book_title, author, trigger_type FROM acw_enforcement ORDER BY timestamp DESC;").fetchall()
         results_with_path = self.cur.execute("SELECT timestamp, book_id, file_path FROM acw_enforcement ORDER BY timestamp DESC;").fetchall()
@@ -370,6 +422,45 @@ class ACW_DB:
         self.cur.execute("INSERT INTO epub_fixes(timestamp, filename, manually_triggered, num_of_fixes_applied, original_backed_up, file_path, fixes_applied) VALUES (?, ?, ?, ?, ?, ?, ?);", (timestamp, filename, manually_triggered, num_of_fixes_applied, original_backed_up, file_path, fixes_applied))
         self.con.commit()
 
+    def set_ingest_status(self, status: str) -> None:
+        """Stores the latest status snapshot of the ingest daemon"""
+        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.cur.execute("INSERT OR REPLACE INTO ingest_status(id, timestamp, status) VALUES (1, ?, ?);", (timestamp, status))
+        self.con.commit()
+
+    def get_ingest_status(self) -> dict | None:
+        """Returns the latest status snapshot of the ingest daemon with the time it was stored, None if there is none"""
+        result = self.cur.execute("SELECT timestamp, status FROM ingest_status WHERE id=1;").fetchone()
+        if not result:
+            return None
+        try:
+            status = json.loads(result[1])
+        except ValueError:
+            return None
+        status["timestamp"] = result[0]
+        return status
+
+    def conversion_journal_start(self, file_paths: list[str], target_format: str) -> None:
+        """Replaces the journal of convert-library with the books of a new run, all waiting for their conversion"""
+        self.cur.execute("DELETE FROM convert_library_journal;")
+        self.cur.executemany("INSERT INTO convert_library_journal(file_path, target_format) VALUES (?, ?);",
+                             [(file_path, target_format) for file_path in file_paths])
+        self.con.commit()
+
+    def get_conversion_journal(self, target_format: str) -> list[tuple[str, str]]:
+        """Returns the books of the last convert-library run for the given target format with their status"""
+        return self.cur.execute("SELECT file_path, status FROM convert_library_journal WHERE target_format=? ORDER BY id;",
+                                (target_format,)).fetchall()
+
+    def conversion_journal_update(self, file_path: str, status: str) -> None:
+        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.cur.execute("UPDATE convert_library_journal SET status=?, timestamp=? WHERE file_path=?;", (status, timestamp, file_path))
+        self.con.commit()
+
+    def conversion_journal_clear(self) -> None:
+        self.cur.execute("DELETE FROM convert_library_journal;")
+        self.con.commit()
+
     def get_stat_totals(self) -> dict[str,int]:
         totals = {"acw_enforcement":0,
                 "acw_conversions":0,
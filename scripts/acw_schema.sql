@@ -45,4 +45,16 @@ CREATE TABLE IF NOT EXISTS acw_settings(
     auto_metadata_enforcement SMALLINT DEFAULT 1 NOT NULL,
     kindle_epub_fixer SMALLINT DEFAULT 1 NOT NULL,
     auto_backup_epub_fixes SMALLINT DEFAULT 1 NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ingest_status(
+    id INTEGER PRIMARY KEY NOT NULL,
+    timestamp TEXT NOT NULL,
+    status TEXT DEFAULT "" NOT NULL
+);
+CREATE TABLE IF NOT EXISTS convert_library_journal(
+    id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    file_path TEXT NOT NULL UNIQUE,
+    target_format TEXT NOT NULL,
+    status TEXT DEFAULT "pending" NOT NULL,
+    timestamp TEXT DEFAULT "" NOT NULL
 );
\ No newline at end of file
@@ -8,7 +8,9 @@ import shutil
 from pathlib import Path
 import subprocess
 import tempfile
+import threading
 import atexit
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import sqlite3
 
@@ -17,6 +19,7 @@ import grp
 
 from acw_db import ACW_DB
 from kindle_epub_fixer import EPUBFixer
+from library_permissions import fix_library_permissions
 
 ### Global Variables
 convert_library_log_file = "/config/convert-library.log"
@@ -33,6 +36,9 @@ file_handler.setFormatter(formatter)
 # Add the handler to the logger
 logger.addHandler(file_handler)
 
+# Number of books converted at the same time, can be overridden with the ACW_CONVERT_WORKERS env variable
+CONVERT_WORKERS = max(1, int(os.environ.get("ACW_CONVERT_WORKERS", min(4, os.cpu_count() or 1))))
+
 # Define user and group
 USER_NAME = "abc"
 GROUP_NAME = "abc"
@@ -50,24 +56,57 @@ def print_and_log(string) -> None:
     print(string)
 
 
-# Creates a lock file unless one already exists meaning an instance of the script is
-# already running, then the script is closed, the user is notified and the program
-# exits with code 2
-try:
-    lock = open(tempfile.gettempdir() + '/convert_library.lock', 'x')
-    lock.close()
-except FileExistsError:
-    print_and_log("[convert-library]: CANCELLING... convert-library was initiated but is already running")
-    logger.info(f"\nACW Convert Library Service - Run Cancelled: {datetime.now()}")
-    sys.exit(2)
+LOCK_FILE = tempfile.gettempdir() + '/convert_library.lock'
+
+
+def acquire_lock() -> bool:
+    """Creates the lock file holding our pid unless another running instance holds it already, a lock left behind by
+    a killed run is removed so the run can be resumed"""
+    while True:
+        try:
+            with open(LOCK_FILE, 'x') as lock:
+                lock.write(str(os.getpid()))
+            return True
+        except FileExistsError:
+            try:
+                with open(LOCK_FILE, 'r') as lock:
+                    pid = int(lock.read().strip() or 0)
+            except (OSError, ValueError):
+                pid = 0
+            if pid and pid_running(pid):
+                return False
+            if not pid:
+                # Lock files of older versions don't hold a pid, they can't be told apart from a running instance
+                return False
+            print_and_log(f"[convert-library]: Removing stale lock of process {pid}")
+            removeLock()
+
+
+def pid_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
 
 # Defining function to delete the lock on script exit
 def removeLock():
     try:
-        os.remove(tempfile.gettempdir() + '/convert_library.lock')
+        os.remove(LOCK_FILE)
     except FileNotFoundError:
         ...
 
+
+# Creates a lock file unless an instance of the script is already running, then the
+# script is closed, the user is notified and the program exits with code 2
+if not acquire_lock():
+    print_and_log("[convert-library]: CANCELLING... convert-library was initiated but is already running")
+    logger.info(f"\nACW Convert Library Service - Run Cancelled: {datetime.now()}")
+    sys.exit(2)
+
 # Will automatically run when the script exits
 atexit.register(removeLock)
 
@@ -79,11 +118,19 @@ backup_destinations = {
 
 
 class LibraryConverter:
+    """Converts the books of the library without a copy in the target format, several books at the same time.
+
+    Only adding the converted files with calibredb is done one book after the other. The books of a run are journaled
+    in acw.db, a run which was cancelled or killed continues with the books it didn't get to the next time it's started"""
     def __init__(self, args) -> None:
         self.args = args
         self.verbose = args.verbose
+        self.workers = max(1, args.workers)
 
         self.db = ACW_DB()
+        self.local = threading.local()
+        self.local.db = self.db
+        self.import_lock = threading.Lock()
         self.acw_settings = self.db.acw_settings
         self.target_format = self.acw_settings['auto_convert_target_format']
         self.convert_ignored_formats = self.acw_settings['auto_convert_ignored_formats']
@@ -92,9 +139,9 @@ class LibraryConverter:
         self.supported_book_formats = {'azw', 'azw3', 'azw4', 'cbz', 'cbr', 'cb7', 'cbc', 'chm', 'djvu', 'docx', 'epub', 'fb2', 'fbz', 'html', 'htmlz', 'lit', 'lrf', 'mobi', 'odt', 'pdf', 'prc', 'pdb', 'pml', 'rb', 'rtf', 'snb', 'tcr', 'txt', 'txtz'}
         self.hierarchy_of_success = {'epub', 'lit', 'mobi', 'azw', 'azw3', 'fb2', 'fbz', 'azw4', 'prc', 'odt', 'lrf', 'pdb',  'cbz', 'pml', 'rb', 'cbr', 'cb7', 'cbc', 'chm', 'djvu', 'snb', 'tcr', 'pdf', 'docx', 'rtf', 'html', 'htmlz', 'txtz', 'txt'}
 
-        self.current_book = 1
-        self.ingest_folder, self.library_dir, self.tmp_conversion_dir = self.get_dirs('/app/autocaliweb/dirs.json') 
-        self.to_convert = self.get_books_to_convert()
+        self.ingest_folder, self.library_dir, self.tmp_conversion_dir = self.get_dirs('/app/autocaliweb/dirs.json')
+        # Every book is converted in its own folder below this one
+        self.work_root = os.path.join(self.tmp_conversion_dir, "convert-library")
 
         self.calibre_env = os.environ.copy()
         self.calibre_env["HOME"] = "/config"
@@ -104,6 +151,14 @@ class LibraryConverter:
             self.library_dir = self.split_library['split_path']
             self.calibre_env["CALIBRE_OVERRIDE_DATABASE_PATH"] = os.path.join(self.split_library['db_path'], 'metadata.db')
 
+        self.to_convert, self.finished = self.get_books_to_convert()
+
+    def acw_db(self) -> ACW_DB:
+        # sqlite connections can't be shared between threads, every worker keeps its own
+        if not hasattr(self.local, "db"):
+            self.local.db = ACW_DB()
+        return self.local.db
+
     def get_split_library(self) -> dict[str, str] | None:
         con = sqlite3.connect('/config/app.db')
         cur = con.cursor()
@@ -133,27 +188,43 @@ class LibraryConverter:
         return ingest_folder, library_dir, tmp_conversion_dir
 
 
-    def get_books_to_convert(self):
-        library_files = [os.path.join(dirpath,f) for (dirpath, dirnames, filenames) in os.walk(self.library_dir) for f in filenames]
+    def get_books_to_convert(self) -> tuple[list[str], set[str]]:
+        """Returns the books of the run and the ones of them already handled. An unfinished run for the same target
+        format is continued, otherwise the library is scanned and the new run is journaled"""
+        journal = self.db.get_conversion_journal(self.target_format)
+        finished = {file for file, status in journal if status != "pending"}
+        if len(finished) < len(journal):
+            print_and_log(f"[convert-library]: Continuing the previous run, {len(journal) - len(finished)} of {len(journal)} books are left to convert...")
+            return [file for file, status in journal], finished
+
+        to_convert = self.scan_library()
+        self.db.conversion_journal_start(to_convert, self.target_format)
+        return to_convert, set()
+
+
+    def scan_library(self) -> list[str]:
+        # Files of the same book only differ in their extension
+        books: dict[str, dict[str, str]] = {}
+        for dirpath, dirnames, filenames in os.walk(self.library_dir):
+            for f in filenames:
+                filename, file_extension = os.path.splitext(os.path.join(dirpath, f))
+                books.setdefault(filename, {})[file_extension[1:]] = filename + file_extension
 
-        exclusion_list = [] # If multiple formats for a book exist, only the one with the highest success rate will be converted and the rest will be left alone
-        files_already_in_target_format = [f for f in library_files if f.endswith(f'.{self.target_format}')]
-        for file in files_already_in_target_format:
-            filename, file_extension = os.path.splitext(file)
-            exclusion_list.append(filename) # Adding books with a file already in the target format to the exclusion list
-        
         to_convert = [] # Will only contain a single filepath for each book without an existing file in the target format in the format with the highest available conversion success rate, where that filepath is allow to be converted
+        allowed_formats = []
         for format in self.hierarchy_of_success:
             if format in self.convert_ignored_formats:
                 print_and_log(f"{format} in list of user-defined ignored formats for conversion. To change this, navigate to the ACW Settings panel from the Settings page in the Web UI.")
                 continue
-            files_in_format = [f for f in library_files if f.endswith(f'.{format}')]
-            if len(files_in_format) > 0:
-                for file in files_in_format:
-                    filename, file_extension = os.path.splitext(file)
-                    if filename not in exclusion_list:
-                        to_convert.append(file)
-                        exclusion_list.append(filename)
+            allowed_formats.append(format)
+
+        for formats in books.values():
+            if self.target_format in formats: # Books with a file already in the target format are left alone
+                continue
+            for format in allowed_formats: # If multiple formats for a book exist, only the one with the highest success rate will be converted and the rest will be left alone
+                if format in formats:
+                    to_convert.append(formats[format])
+                    break
 
         return to_convert
 
@@ -166,110 +237,128 @@ class LibraryConverter:
             print_and_log(f"[convert-library]: ERROR - The following error occurred when trying to copy {input_file} to {output_path}:\n{e}")
 
 
+    def run_command(self, command: list, env=None) -> None:
+        """Runs the command and passes its output on, raises a CalledProcessError if it fails"""
+        with subprocess.Popen(
+            command,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True
+        ) as process:
+            for line in process.stdout: # Read from the combined stdout (which includes stderr)
+                if self.verbose:
+                    print_and_log(line)
+                else:
+                    print(line)
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command)
+
+
     def convert_library(self):
-        for file in self.to_convert:
-            filename = os.path.basename(file)
-            file_extension = Path(file).suffix
+        shutil.rmtree(self.work_root, ignore_errors=True)
+        Path(self.work_root).mkdir(parents=True, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="convert-worker") as pool:
+            for position, file in enumerate(self.to_convert, start=1):
+                if file not in self.finished:
+                    pool.submit(self.convert_book, file, f"({position}/{len(self.to_convert)})")
+        shutil.rmtree(self.work_root, ignore_errors=True)
+        self.db.conversion_journal_clear()
+
+
+    def convert_book(self, file: str, progress: str) -> None:
+        work_dir = tempfile.mkdtemp(dir=self.work_root) + "/"
+        try:
+            converted = self.convert_and_import(file, progress, work_dir)
+        except Exception as e:
+            print_and_log(f"[convert-library]: {progress} The conversion of {os.path.basename(file)} ran into the following error:\n{e}")
+            converted = False
+        shutil.rmtree(work_dir, ignore_errors=True)
+        self.acw_db().conversion_journal_update(file, "converted" if converted else "failed")
 
-            print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) Converting {filename} from {file_extension} format to {self.target_format} format...")
 
-            try: # Get Calibre Library Book ID
-                book_id = (re.search(r'\(\d*\)', file).group(0))[1:-1] # type: ignore
-            except Exception as e:
-                print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) A Calibre Library Book ID could not be determined for {file}. Make sure the structure of your calibre library matches the following example:\n")
-                print_and_log("Terry Goodkind/")
-                print_and_log("└── Wizard's First Rule (6120)")
-                print_and_log("    ├── cover.jpg")
-                print_and_log("    ├── metadata.opf")
-                print_and_log("    └── Wizard's First Rule - Terry Goodkind.epub")
-
-                self.backup(file, backup_type="failed")
-                self.current_book += 1
-                continue
+    def convert_and_import(self, file: str, progress: str, work_dir: str) -> bool:
+        filename = os.path.basename(file)
+        file_extension = Path(file).suffix
 
-            if self.target_format == "kepub":
-                convert_successful, target_filepath = self.convert_to_kepub(file, file_extension)
-                if not convert_successful:
-                    print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) Conversion of {os.path.basename(file)} was unsuccessful. Moving to next book...")
-                    self.current_book += 1
-                    continue
-            else:
-                try: # Convert Book to target format (target is not kepub)
-                    target_filepath = f"{self.tmp_conversion_dir}{Path(file).stem}.{self.target_format}"
-                    with subprocess.Popen(
-                        ["ebook-convert", file, target_filepath],
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.STDOUT,
-                        text=True
-                    ) as process:
-                        for line in process.stdout: # Read from the combined stdout (which includes stderr)
-                            if self.verbose:
-                                print_and_log(line)
-                            else:
-                                print(line)
-
-                    if self.acw_settings['auto_backup_conversions']:
-                        self.backup(file, backup_type="converted")
-
-                    self.db.conversion_add_entry(os.path.basename(target_filepath),
-                                                Path(file).suffix,
-                                                self.target_format,
-                                                str(self.acw_settings["auto_backup_conversions"]))
-
-                    print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) Conversion of {os.path.basename(file)} to {self.target_format} format successful!") # Removed as of V3.0.0 - Removing old version from library...
-                except subprocess.CalledProcessError as e:
-                    print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) Conversion of {os.path.basename(file)} was unsuccessful. See the following error:\n{e}")
-                    self.current_book += 1
-                    continue
-
-            if self.target_format == "epub" and self.kindle_epub_fixer:
-                try:
-                    EPUBFixer().process(input_path=target_filepath)
-                    print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) Resulting EPUB file successfully processed by ACW-EPUB-Fixer!")
-                except Exception as e:
-                    print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) An error occurred while processing {os.path.basename(target_filepath)} with the kindle-epub-fixer. See the following error:\n{e}")
+        if not os.path.isfile(file):
+            print_and_log(f"[convert-library]: {progress} {filename} no longer exists in the library, skipping it...")
+            return False
+
+        print_and_log(f"[convert-library]: {progress} Converting {filename} from {file_extension} format to {self.target_format} format...")
+
+        try: # Get Calibre Library Book ID
+            book_id = (re.search(r'\(\d*\)', file).group(0))[1:-1] # type: ignore
+        except Exception as e:
+            print_and_log(f"[convert-library]: {progress} A Calibre Library Book ID could not be determined for {file}. Make sure the structure of your calibre library matches the following example:\n")
+            print_and_log("Terry Goodkind/")
+            print_and_log("└── Wizard's First Rule (6120)")
+            print_and_log("    ├── cover.jpg")
+            print_and_log("    ├── metadata.opf")
+            print_and_log("    └── Wizard's First Rule - Terry Goodkind.epub")
+
+            self.backup(file, backup_type="failed")
+            return False
+
+        if self.target_format == "kepub":
+            convert_successful, target_filepath = self.convert_to_kepub(file, file_extension, progress, work_dir)
+            if not convert_successful:
+                print_and_log(f"[convert-library]: {progress} Conversion of {os.path.basename(file)} was unsuccessful. Moving to next book...")
+                return False
+        else:
+            try: # Convert Book to target format (target is not kepub)
+                target_filepath = f"{work_dir}{Path(file).stem}.{self.target_format}"
+                self.run_command(["ebook-convert", file, target_filepath])
+
+                if self.acw_settings['auto_backup_conversions']:
+                    self.backup(file, backup_type="converted")
+
+                self.acw_db().conversion_add_entry(os.path.basename(target_filepath),
+                                                   Path(file).suffix,
+                                                   self.target_format,
+                                                   str(self.acw_settings["auto_backup_conversions"]))
+
+                print_and_log(f"[convert-library]: {progress} Conversion of {os.path.basename(file)} to {self.target_format} format successful!") # Removed as of V3.0.0 - Removing old version from library...
+            except subprocess.CalledProcessError as e:
+                print_and_log(f"[convert-library]: {progress} Conversion of {os.path.basename(file)} was unsuccessful. See the following error:\n{e}")
+                return False
+
+        if self.target_format == "epub" and self.kindle_epub_fixer:
+            try:
+                EPUBFixer().process(input_path=target_filepath)
+                print_and_log(f"[convert-library]: {progress} Resulting EPUB file successfully processed by ACW-EPUB-Fixer!")
+            except Exception as e:
+                print_and_log(f"[convert-library]: {progress} An error occurred while processing {os.path.basename(target_filepath)} with the kindle-epub-fixer. See the following error:\n{e}")
 
+        # calibredb doesn't cope with several processes writing to the library at the same time
+        with self.import_lock:
             try: # Import converted book to library. As of V3.0.0, "add_format" is used instead of "add"
-                with subprocess.Popen(
-                    ["calibredb", "add_format", book_id, target_filepath, f"--library-path={self.library_dir}"],
-                    env=self.calibre_env,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    text=True
-                ) as process:
-                    for line in process.stdout: # Read from the combined stdout (which includes stderr)
-                        if self.verbose:
-                            print_and_log(line)
-                        else:
-                            print(line)
+                self.run_command(["calibredb", "add_format", book_id, target_filepath, f"--library-path={self.library_dir}"], env=self.calibre_env)
 
                 if self.acw_settings['auto_backup_imports']:
                     self.backup(target_filepath, backup_type="imported")
 
-                self.db.import_add_entry(os.path.basename(target_filepath),
-                                        str(self.acw_settings["auto_backup_imports"]))
+                self.acw_db().import_add_entry(os.path.basename(target_filepath),
+                                               str(self.acw_settings["auto_backup_imports"]))
 
-                print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) Import of {os.path.basename(target_filepath)} successfully completed!")
+                print_and_log(f"[convert-library]: {progress} Import of {os.path.basename(target_filepath)} successfully completed!")
             except subprocess.CalledProcessError as e:
-                print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) Import of {os.path.basename(target_filepath)} was not successfully completed. Converted file moved to /config/processed_books/failed/{os.path.basename(target_filepath)}. See the following error:\n{e}")
+                print_and_log(f"[convert-library]: {progress} Import of {os.path.basename(target_filepath)} was not successfully completed. Converted file moved to /config/processed_books/failed/{os.path.basename(target_filepath)}. See the following error:\n{e}")
                 try:
                     output_path = f"/config/processed_books/failed/{os.path.basename(target_filepath)}"
                     shutil.move(target_filepath, output_path)
                 except Exception as e:
                     print_and_log(f"[convert-library]: ERROR - The following error occurred when trying to copy {file} to {output_path}:\n{e}")
-                self.current_book += 1
-                continue
+                return False
 
-            self.set_library_permissions()
-            self.empty_tmp_con_dir()
-            self.current_book += 1
-            continue
+            self.set_library_permissions(os.path.dirname(file), progress)
+        return True
 
 
-    def convert_to_kepub(self, filepath:str ,import_format:str) -> tuple[bool, str]:
+    def convert_to_kepub(self, filepath:str ,import_format:str, progress: str, work_dir: str) -> tuple[bool, str]:
         """Kepubify is limited in that it can only convert from epub to kepub, therefore any files not already in epub need to first be converted to epub, and then to kepub"""
         if import_format == "epub":
-            print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) File already in epub format, converting directly to kepub...")
+            print_and_log(f"[convert-library]: {progress} File already in epub format, converting directly to kepub...")
 
             if self.acw_settings['auto_backup_conversions']:
                 self.backup(filepath, backup_type="converted")
@@ -277,81 +366,48 @@ class LibraryConverter:
             epub_filepath = filepath
             epub_ready = True
         else:
-            print_and_log(f"\n[convert-library]: ({self.current_book}/{len(self.to_convert)}) *** NOTICE TO USER: Kepubify is limited in that it can only convert from epubs. To get around this, ACW will automatically convert other supported formats to epub using the Calibre's conversion tools & then use Kepubify to produce your desired kepubs. Obviously multi-step conversions aren't ideal so if you notice issues with your converted files, bare in mind starting with epubs will ensure the best possible results***\n")
+            print_and_log(f"\n[convert-library]: {progress} *** NOTICE TO USER: Kepubify is limited in that it can only convert from epubs. To get around this, ACW will automatically convert other supported formats to epub using the Calibre's conversion tools & then use Kepubify to produce your desired kepubs. Obviously multi-step conversions aren't ideal so if you notice issues with your converted files, bare in mind starting with epubs will ensure the best possible results***\n")
             try: # Convert book to epub format so it can then be converted to kepub
-                epub_filepath = f"{self.tmp_conversion_dir}{Path(filepath).stem}.epub"
-                with subprocess.Popen(
-                    ["ebook-convert", filepath, epub_filepath],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    text=True
-                ) as process:
-                    for line in process.stdout: # Read from the combined stdout (which includes stderr)
-                        if self.verbose:
-                            print_and_log(line)
-                        else:
-                            print(line)
+                epub_filepath = f"{work_dir}{Path(filepath).stem}.epub"
+                self.run_command(["ebook-convert", filepath, epub_filepath])
 
                 if self.acw_settings['auto_backup_conversions']:
                     self.backup(filepath, backup_type="converted")
 
-                print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) Intermediate conversion of {os.path.basename(filepath)} to epub from {import_format} successful, now converting to kepub...")
+                print_and_log(f"[convert-library]: {progress} Intermediate conversion of {os.path.basename(filepath)} to epub from {import_format} successful, now converting to kepub...")
                 epub_ready = True
             except subprocess.CalledProcessError as e:
-                print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) Intermediate conversion of {os.path.basename(filepath)} to epub was unsuccessful. Cancelling kepub conversion and moving on to next file. See the following error:\n{e}")
+                print_and_log(f"[convert-library]: {progress} Intermediate conversion of {os.path.basename(filepath)} to epub was unsuccessful. Cancelling kepub conversion and moving on to next file. See the following error:\n{e}")
                 return False, ""
             
         if epub_ready:
             epub_filepath = Path(epub_filepath)
-            target_filepath = f"{self.tmp_conversion_dir}{epub_filepath.stem}.kepub"
+            target_filepath = f"{work_dir}{epub_filepath.stem}.kepub"
             try:
-                with subprocess.Popen(
-                    ['kepubify', '--inplace', '--calibre', '--output', self.tmp_conversion_dir, epub_filepath],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    text=True
-                ) as process:
-                    for line in process.stdout: # Read from the combined stdout (which includes stderr)
-                        if self.verbose:
-                            print_and_log(line)
-                        else:
-                            print(line)
+                self.run_command(['kepubify', '--inplace', '--calibre', '--output', work_dir, epub_filepath])
 
                 if self.acw_settings['auto_backup_conversions']:
                     self.backup(filepath, backup_type="converted")
 
-                self.db.conversion_add_entry(epub_filepath.stem,
-                                            import_format,
-                                            self.target_format,
-                                            str(self.acw_settings["auto_backup_conversions"]))
+                self.acw_db().conversion_add_entry(epub_filepath.stem,
+                                                   import_format,
+                                                   self.target_format,
+                                                   str(self.acw_settings["auto_backup_conversions"]))
 
                 return True, target_filepath
             except subprocess.CalledProcessError as e:
-                print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) CON_ERROR: {os.path.basename(filepath)} could not be converted to kepub due to the following error:\nEXIT/ERROR CODE: {e.returncode}\n{e.stderr}")
+                print_and_log(f"[convert-library]: {progress} CON_ERROR: {os.path.basename(filepath)} could not be converted to kepub due to the following error:\nEXIT/ERROR CODE: {e.returncode}\n{e.stderr}")
                 self.backup(epub_filepath, backup_type="failed")
                 return False, ""
         else:
-            print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) An error occurred when converting the original {import_format} to epub. Cancelling kepub conversion and moving on to next file...")
+            print_and_log(f"[convert-library]: {progress} An error occurred when converting the original {import_format} to epub. Cancelling kepub conversion and moving on to next file...")
             return False, ""
 
 
-    def empty_tmp_con_dir(self):
-        try:
-            files = os.listdir(self.tmp_conversion_dir)
-            for file in files:
-                file_path = os.path.join(self.tmp_conversion_dir, file)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-        except OSError:
-            print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) An error occurred while emptying {self.tmp_conversion_dir}.")
-
-
-    def set_library_permissions(self):
-        try:
-            subprocess.run(["chown", "-R", "abc:abc", self.library_dir], check=True)
-            print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) Successfully set ownership of new files in {self.library_dir} to abc:abc.")
-        except subprocess.CalledProcessError as e:
-            print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) An error occurred while attempting to recursively set ownership of {self.library_dir} to abc:abc. See the following error:\n{e}")
+    def set_library_permissions(self, book_dir: str, progress: str):
+        """add_format only writes to the folder of the converted book and to metadata.db"""
+        if fix_library_permissions(self.library_dir, [book_dir], log=print_and_log):
+            print_and_log(f"[convert-library]: {progress} Successfully set ownership of new files in {book_dir} to abc:abc.")
 
 
 def main():
@@ -361,6 +417,7 @@ def main():
     )
 
     parser.add_argument('--verbose', '-v', action='store_true', required=False, dest='verbose', help='When passed, the output from the ebook-convert command will be included in what is shown to the user in the Web UI', default=False)
+    parser.add_argument('--workers', '-w', type=int, required=False, dest='workers', help='Number of books converted at the same time', default=CONVERT_WORKERS)
     args = parser.parse_args()
 
     logger.info(f"Autocaliweb Convert Library Service - Run Started: {datetime.now()}\n")
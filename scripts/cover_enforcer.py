@@ -3,11 +3,13 @@ import atexit
 import json
 import os
 import re
+import shutil
 import sqlite3
 import subprocess
 import sys
 import tempfile
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 from pathlib import Path
 
@@ -18,6 +20,10 @@ dirs_json = "/app/autocaliweb/dirs.json"
 change_logs_dir = "/app/autocaliweb/metadata_change_logs"
 metadata_temp_dir = "/app/autocaliweb/metadata_temp"
 
+# Number of books polished at the same time by a full library enforcement, can be overridden with the
+# ACW_ENFORCE_WORKERS env variable
+ENFORCE_WORKERS = max(1, int(os.environ.get("ACW_ENFORCE_WORKERS", min(4, os.cpu_count() or 1))))
+
 
 # Creates a lock file unless one already exists meaning an instance of the script is
 # already running, then the script is closed, the user is notified and the program
@@ -42,7 +48,8 @@ atexit.register(removeLock)
 
 
 class Book:
-    def __init__(self, book_dir: str, file_path: str):
+    def __init__(self, book_dir: str, file_path: str, new_metadata_path: str | None = None,
+                 metadata_dir: str = metadata_temp_dir):
         self.book_dir: str = book_dir
         self.file_path: str = file_path
         self.calibre_library = self.get_calibre_library()
@@ -66,7 +73,9 @@ class Book:
 
         self.cover_path = book_dir + "/cover.jpg"
         self.old_metadata_path = book_dir + "/metadata.opf"
-        self.new_metadata_path = self.get_new_metadata_path()
+        self.metadata_dir = metadata_dir
+        # All formats of a book share the metadata exported for the first one
+        self.new_metadata_path = new_metadata_path or self.get_new_metadata_path()
 
         self.log_info = None
 
@@ -116,7 +125,7 @@ class Book:
                 "--with-library",
                 self.calibre_library,
                 "--to-dir",
-                metadata_temp_dir,
+                self.metadata_dir,
                 self.book_id,
             ],
             env=self.calibre_env,
@@ -124,7 +133,7 @@ class Book:
         )
         temp_files = [
             os.path.join(dirpath, f)
-            for (dirpath, dirnames, filenames) in os.walk(metadata_temp_dir)
+            for (dirpath, dirnames, filenames) in os.walk(self.metadata_dir)
             for f in filenames
         ]
         return [f for f in temp_files if f.endswith(".opf")][0]
@@ -226,6 +235,41 @@ class Enforcer:
 
         return supported_files
 
+    def prepare_books(self, book_dir: str, supported_files: list[str], metadata_dir: str) -> list[Book]:
+        """Exports the metadata of the book once for all of its supported files and puts it into the library"""
+        book_objects = []
+        for file in supported_files:
+            new_metadata_path = book_objects[0].new_metadata_path if book_objects else None
+            book_objects.append(Book(book_dir, file, new_metadata_path, metadata_dir))
+        self.replace_old_metadata(
+            book_objects[0].old_metadata_path, book_objects[0].new_metadata_path
+        )
+        return book_objects
+
+    def polish_books(self, book_objects: list[Book]) -> list[Book]:
+        """Embeds the cover & metadata in the files of the book, returns the books where this succeeded"""
+        polished = []
+        for book in book_objects:
+            try:
+                subprocess.run(
+                    ["ebook-polish", "-c", book.cover_path, "-o", book.new_metadata_path, "-U", book.file_path, book.file_path],
+                    check=True,
+                )
+            except subprocess.CalledProcessError as e:
+                print(
+                    f"[cover-metadata-enforcer]: ERROR: '{book.title_author}.{book.file_format}': ebook-polish failed with exit code {e.returncode}",
+                    flush=True,
+                )
+                continue
+            # The files were changed after the metadata was exported, the book counts as enforced from now on
+            book.timestamp = book.get_time()
+            print(
+                f"[cover-metadata-enforcer]: DONE: '{book.title_author}.{book.file_format}': Cover & Metadata updated",
+                flush=True,
+            )
+            polished.append(book)
+        return polished
+
     def enforce_cover(self, book_dir: str) -> list:
         """Will force the Cover & Metadata to update for the supported book files in the given directory"""
         supported_files = self.get_supported_files_from_dir(book_dir)
@@ -235,23 +279,11 @@ class Enforcer:
                     "[cover-metadata-enforcer] Multiple file formats for current book detected...",
                     flush=True,
                 )
-            book_objects = []
-            for file in supported_files:
-                book = Book(book_dir, file)
-                self.replace_old_metadata(
-                    book.old_metadata_path, book.new_metadata_path
-                )
-                os.system(
-                    f'ebook-polish -c "{book.cover_path}" -o "{book.new_metadata_path}" -U "{file}" "{file}"'
-                )
-                self.empty_metadata_temp()
-                print(
-                    f"[cover-metadata-enforcer]: DONE: '{book.title_author}.{book.file_format}': Cover & Metadata updated",
-                    flush=True,
-                )
-                book_objects.append(book)
-
-            return book_objects
+            metadata_dir = tempfile.mkdtemp(dir=metadata_temp_dir)
+            try:
+                return self.polish_books(self.prepare_books(book_dir, supported_files, metadata_dir))
+            finally:
+                shutil.rmtree(metadata_dir, ignore_errors=True)
         else:
             print(
                 f"[cover-metadata-enforcer]: No supported file formats found in {book_dir}.",
@@ -263,44 +295,101 @@ class Enforcer:
             )
             return []
 
-    def enforce_all_covers(self) -> tuple[int, float, int] | tuple[bool, bool, bool]:
-        """Will force the covers and metadata to be re-generated for all books in the library"""
+    def is_enforced(self, book_dir: str, last_enforcements: dict[int, float]) -> bool:
+        """True if neither metadata.opf nor cover.jpg of the book changed since it was last enforced"""
+        try:
+            book_id = int((list(re.findall(r"\(\d*\)", book_dir))[-1])[1:-1])
+        except (IndexError, ValueError):
+            return False
+        last_enforced = last_enforcements.get(book_id)
+        if last_enforced is None:
+            return False
+        # The enforcement timestamps are cut off to the second
+        last_enforced += 1
+        for path in (os.path.join(book_dir, "metadata.opf"), os.path.join(book_dir, "cover.jpg")):
+            try:
+                if os.stat(path).st_mtime >= last_enforced:
+                    return False
+            except FileNotFoundError:
+                continue
+        return True
+
+    def enforce_all_covers(self, force: bool = False) -> tuple[int, float, int] | tuple[bool, bool, bool]:
+        """Will force the covers and metadata to be re-generated for all books in the library, which changed since
+        they were last enforced unless force is set.
+
+        The metadata of the books is exported one book after the other, the ebook-polish runs of up to
+        ENFORCE_WORKERS books run at the same time"""
         t_start = time.time()
 
         supported_files = self.get_supported_files_from_dir(self.calibre_library)
         if supported_files:
-            book_dirs = []
+            # A book with several supported formats is enforced once for all of them
+            book_dirs: dict[str, list[str]] = {}
             for file in supported_files:
-                book_dirs.append(os.path.dirname(file))
+                book_dirs.setdefault(os.path.dirname(file), []).append(file)
 
             print(
                 f"[cover-metadata-enforcer]: {len(book_dirs)} books detected in Library"
             )
+
+            last_enforcements = {} if force else self.db.get_last_enforcements()
+            to_enforce = {book_dir: files for book_dir, files in book_dirs.items()
+                          if not self.is_enforced(book_dir, last_enforcements)}
+            n_files = sum(len(files) for files in to_enforce.values())
+            if len(to_enforce) < len(book_dirs):
+                print(
+                    f"[cover-metadata-enforcer]: Skipping {len(book_dirs) - len(to_enforce)} books whose cover & metadata didn't change since they were last enforced"
+                )
             print(
-                f"[cover-metadata-enforcer]: Enforcing covers for {len(supported_files)} supported file(s) in {self.calibre_library} ..."
+                f"[cover-metadata-enforcer]: Enforcing covers for {n_files} supported file(s) in {self.calibre_library} ..."
             )
 
-            successful_enforcements = len(supported_files)
-
-            for book_dir in book_dirs:
-                try:
-                    book_objects = self.enforce_cover(book_dir)
+            successful_enforcements = 0
+            running = {}
+
+            def finish(done):
+                nonlocal successful_enforcements
+                for future in done:
+                    book_dir, metadata_dir = running.pop(future)
+                    shutil.rmtree(metadata_dir, ignore_errors=True)
+                    try:
+                        book_objects = future.result()
+                    except Exception as e:
+                        print(f"[cover-metadata-enforcer]: ERROR: {book_dir}")
+                        print(
+                            f"[cover-metadata-enforcer]: Skipping book due to following error: {e}"
+                        )
+                        continue
                     if book_objects:
                         book_dicts = []
                         for book in book_objects:
                             book_dicts.append(book.export_as_dict())
                         self.db.enforce_add_entry_from_all(book_dicts)
-                except Exception as e:
-                    print(f"[cover-metadata-enforcer]: ERROR: {book_dir}")
-                    print(
-                        f"[cover-metadata-enforcer]: Skipping book due to following error: {e}"
-                    )
-                    successful_enforcements = successful_enforcements - 1
-                    continue
+                    successful_enforcements += len(book_objects)
+
+            with ThreadPoolExecutor(max_workers=ENFORCE_WORKERS, thread_name_prefix="enforce-worker") as pool:
+                for book_dir, files in to_enforce.items():
+                    # Every waiting book holds a copy of its files in metadata_temp
+                    while len(running) >= ENFORCE_WORKERS * 2:
+                        finish(wait(running, return_when=FIRST_COMPLETED).done)
+                    metadata_dir = tempfile.mkdtemp(dir=metadata_temp_dir)
+                    try:
+                        book_objects = self.prepare_books(book_dir, files, metadata_dir)
+                    except Exception as e:
+                        shutil.rmtree(metadata_dir, ignore_errors=True)
+                        print(f"[cover-metadata-enforcer]: ERROR: {book_dir}")
+                        print(
+                            f"[cover-metadata-enforcer]: Skipping book due to following error: {e}"
+                        )
+                        continue
+                    running[pool.submit(self.polish_books, book_objects)] = (book_dir, metadata_dir)
+                while running:
+                    finish(wait(running, return_when=FIRST_COMPLETED).done)
 
             t_end = time.time()
 
-            return successful_enforcements, (t_end - t_start), len(supported_files)
+            return successful_enforcements, (t_end - t_start), n_files
         else:  # No supported files found
             return False, False, False
 
@@ -324,10 +413,6 @@ class Enforcer:
         else:
             os.remove(log_path)
 
-    def empty_metadata_temp(self):
-        """Empties the metadata_temp folder"""
-        os.system(f"rm -r {metadata_temp_dir}/*")
-
     def check_for_other_logs(self):
         log_files = [
             os.path.join(dirpath, f)
@@ -348,6 +433,7 @@ class Enforcer:
                         for book in book_objects:
                             book.log_info = log_info
                             book.log_info["file_path"] = book.file_path
+                            book.log_info["timestamp"] = book.timestamp
                             self.db.enforce_add_entry_from_log(book.log_info)
                     self.delete_log(auto=False, log_path=log)
 
@@ -385,6 +471,13 @@ def main():
         help="Will enforce covers & metadata for ALL books currently in your calibre-library-dir",
         default=False,
     )
+    parser.add_argument(
+        "-force",
+        action="store_true",
+        dest="force",
+        help="Use with '-all' to also enforce the books whose cover & metadata didn't change since they were last enforced",
+        default=False,
+    )
     parser.add_argument(
         "-list",
         "-l",
@@ -456,11 +549,15 @@ def main():
         print(
             "[cover-metadata-enforcer]: Enforcing metadata and covers for all books in library..."
         )
-        n_enforced, completion_time, n_supported_files = enforcer.enforce_all_covers()
-        if n_enforced == False:
+        n_enforced, completion_time, n_supported_files = enforcer.enforce_all_covers(args.force)
+        if n_supported_files is False:
             print(
                 f"\n[cover-metadata-enforcer]: No supported ebook files found in library (only EPUB & AZW3 formats are currently supported)"
             )
+        elif n_supported_files == 0:
+            print(
+                f"\n[cover-metadata-enforcer]: SUCCESS: The covers & metadata of all books in the library are already up to date. Run with '-all -force' to enforce them anyway."
+            )
         elif n_enforced == n_supported_files:
             print(
                 f"\n[cover-metadata-enforcer]: SUCCESS: All covers & metadata successfully updated for all {n_enforced} supported ebooks in the library in {completion_time:.2f} seconds!"
@@ -514,6 +611,8 @@ def main():
             for book in book_objects:
                 book.log_info = log_info
                 book.log_info["file_path"] = book.file_path
+                # Recorded as the time the enforcement finished, not the time of the edit
+                book.log_info["timestamp"] = book.timestamp
                 enforcer.db.enforce_add_entry_from_log(book.log_info)
             enforcer.delete_log()
             enforcer.check_for_other_logs()
@@ -1,36 +1,91 @@
+import argparse
 import atexit
+import hashlib
 import json
 import os
+import queue
+import re
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
 from pathlib import Path
 import sqlite3
 
 from acw_db import ACW_DB
 from kindle_epub_fixer import EPUBFixer
+from library_permissions import (PERMISSION_SWEEP_HOURS, PermissionSweeper, fix_library_permissions, get_book_dirs,
+                                 get_changed_book_dirs, parse_calibredb_book_ids)
 import audiobook
 
 
+LOCK_FILE = tempfile.gettempdir() + '/ingest_processor.lock'
+DIRS_JSON = "/app/autocaliweb/dirs.json"
+
+# Number of books converted at the same time, can be overridden with the ACW_INGEST_WORKERS env variable
+INGEST_WORKERS = max(1, int(os.environ.get("ACW_INGEST_WORKERS", min(4, os.cpu_count() or 1))))
+# Books handed to a single calibredb add call, the importer waits up to IMPORT_BATCH_WAIT seconds for a batch to fill
+IMPORT_BATCH_SIZE = 50
+IMPORT_BATCH_WAIT = 2
+# Seconds a single ebook-convert, kepubify or calibredb call may take before the book is given up
+SUBPROCESS_TIMEOUT = 900
+# Seconds a calibredb add of a batch may take for every book beyond the first
+IMPORT_TIMEOUT_PER_BOOK = 120
+# A file is ingested once it wasn't written to for STABILITY_QUIESCENCE seconds, files still changing after
+# STABILITY_TIMEOUT seconds are skipped
+STABILITY_QUIESCENCE = 1
+STABILITY_TIMEOUT = 120
+# Seconds between two updates of the ingest status in acw.db
+STATUS_INTERVAL = 2
+
+MAX_FILENAME_LENGTH = 150
+
+
+def acquire_lock() -> bool:
+    """Creates the lock file holding our pid unless another running instance holds it already,
+    lock files left behind by a process which is gone are removed"""
+    while True:
+        try:
+            with open(LOCK_FILE, 'x') as lock:
+                lock.write(str(os.getpid()))
+            return True
+        except FileExistsError:
+            try:
+                with open(LOCK_FILE, 'r') as lock:
+                    pid = int(lock.read().strip() or 0)
+            except (OSError, ValueError):
+                pid = 0
+            if pid and pid_running(pid):
+                return False
+            if not pid:
+                # Lock files of older versions don't hold a pid, they can't be told apart from a running instance
+                return False
+            print(f"[ingest-processor] Removing stale lock of process {pid}", flush=True)
+            removeLock()
+
+
+def pid_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
 
-# Creates a lock file unless one already exists meaning an instance of the script is
-# already running, then the script is closed, the user is notified and the program
-# exits with code 2
-try:
-    lock = open(tempfile.gettempdir() + '/ingest_processor.lock', 'x')
-    lock.close()
-except FileExistsError:
-    print("[ingest-processor] CANCELLING... ingest-processor initiated but is already running")
-    sys.exit(2)
 
 # Defining function to delete the lock on script exit
 def removeLock():
-    os.remove(tempfile.gettempdir() + '/ingest_processor.lock')
+    try:
+        os.remove(LOCK_FILE)
+    except FileNotFoundError:
+        ...
 
-# Will automatically run when the script exits
-atexit.register(removeLock)
 
 # Generates dictionary of available backup directories and their paths
 backup_destinations = {
@@ -39,10 +94,127 @@ backup_destinations = {
         if entry.is_dir()
     }
 
+
+def get_dirs(dirs_json_path: str) -> tuple[str, str, str]:
+    dirs = {}
+    with open(dirs_json_path, 'r') as f:
+        dirs: dict[str, str] = json.load(f)
+
+    ingest_folder = f"{dirs['ingest_folder']}/"
+    library_dir = f"{dirs['calibre_library_dir']}/"
+    tmp_conversion_dir = f"{dirs['tmp_conversion_dir']}/"
+
+    return ingest_folder, library_dir, tmp_conversion_dir
+
+
+def get_split_library() -> dict[str, str] | None:
+    con = sqlite3.connect(f"/config/app.db")
+    cur = con.cursor()
+    split_library = cur.execute("SELECT config_calibre_split FROM settings;").fetchone()[0]
+
+    if split_library:
+        split_path = cur.execute("SELECT config_calibre_split_dir FROM settings;").fetchone()[0]
+        db_path = cur.execute("SELECT config_calibre_dir FROM settings;").fetchone()[0]
+        con.close()
+        return {
+            "split_path": split_path,
+            "db_path": db_path
+        }
+    else:
+        con.close()
+        return None
+
+
+class FileStabilityTracker:
+    """Hands on files once no close_write/moved_to event was reported for them and their size and mtime stayed the
+    same for the quiescence window, all pending files are watched by a single thread"""
+    def __init__(self, on_stable, on_dropped, quiescence=STABILITY_QUIESCENCE, timeout=STABILITY_TIMEOUT):
+        self.on_stable = on_stable
+        self.on_dropped = on_dropped
+        self.quiescence = quiescence
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.files = {} # path -> [first event, last event or change, size, mtime], monotonic times
+        threading.Thread(target=self.run, name="ingest-stability", daemon=True).start()
+
+    def track(self, filepath: str) -> bool:
+        """Starts watching the file, files which weren't written to for longer than the quiescence window already
+        are handed on without waiting. Returns False if the file is gone"""
+        now = time.monotonic()
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return False
+        with self.condition:
+            age = max(time.time() - stat.st_mtime, 0)
+            self.files[filepath] = [now, now - min(age, self.quiescence), stat.st_size, stat.st_mtime_ns]
+            self.condition.notify()
+        return True
+
+    def touch(self, filepath: str) -> None:
+        """Restarts the quiescence window of a file which is still watched"""
+        with self.condition:
+            entry = self.files.get(filepath)
+            if entry:
+                entry[1] = time.monotonic()
+
+    def run(self) -> None:
+        while True:
+            stable = []
+            dropped = []
+            with self.condition:
+                while not self.files:
+                    self.condition.wait()
+                now = time.monotonic()
+                wake_up = now + self.quiescence
+                for filepath, entry in list(self.files.items()):
+                    first_event, last_change, size, mtime = entry
+                    if now - last_change < self.quiescence:
+                        wake_up = min(wake_up, last_change + self.quiescence)
+                        continue
+                    try:
+                        stat = os.stat(filepath)
+                    except OSError:
+                        # Deleted or moved away in the meantime, a moved file is reported again under its new name
+                        del self.files[filepath]
+                        dropped.append((filepath, None))
+                        continue
+                    if (stat.st_size, stat.st_mtime_ns) == (size, mtime):
+                        del self.files[filepath]
+                        stable.append((filepath, now - first_event))
+                    elif now - first_event > self.timeout:
+                        del self.files[filepath]
+                        dropped.append((filepath, f"File {filepath} did not stabilize within {self.timeout} seconds."))
+                    else:
+                        entry[1:] = [now, stat.st_size, stat.st_mtime_ns]
+                        wake_up = min(wake_up, now + self.quiescence)
+                if not stable and not dropped:
+                    self.condition.wait(max(wake_up - time.monotonic(), 0.05))
+            for filepath, error in dropped:
+                self.on_dropped(filepath, error)
+            for filepath, waited in stable:
+                self.on_stable(filepath, waited)
+
+
+def shorten_filename(filepath: str) -> str:
+    """Renames files whose name is too long for calibre and returns the new path"""
+    filename = os.path.basename(filepath)
+    name, ext = os.path.splitext(filename)
+    allowed_len = MAX_FILENAME_LENGTH - len(ext)
+
+    if len(name) > allowed_len:
+        new_name = name[:allowed_len] + ext
+        new_path = os.path.join(os.path.dirname(filepath), new_name)
+        os.rename(filepath, new_path)
+        return new_path
+    return filepath
+
+
 class NewBookProcessor:
-    def __init__(self, filepath: str):
-        self.db = ACW_DB()
-        self.acw_settings = self.db.acw_settings
+    def __init__(self, filepath: str, db: ACW_DB | None = None, dirs: tuple[str, str, str] | None = None):
+        self.db = db if db else ACW_DB()
+        # The settings are read again for every book, they may have been changed since the daemon was started
+        self.acw_settings = self.db.get_acw_settings() if db else self.db.acw_settings
 
         self.auto_convert_on = self.acw_settings['auto_convert']
         self.target_format = self.acw_settings['auto_convert_target_format']
@@ -58,77 +230,31 @@ class NewBookProcessor:
         self.supported_book_formats = {'azw', 'azw3', 'azw4', 'cbz', 'cbr', 'cb7', 'cbc', 'chm', 'djvu', 'docx', 'epub', 'fb2', 'fbz', 'html', 'htmlz', 'lit', 'lrf', 'mobi', 'odt', 'pdf', 'prc', 'pdb', 'pml', 'rb', 'rtf', 'snb', 'tcr', 'txtz', 'txt', 'kepub'}
         self.hierarchy_of_success = {'epub', 'lit', 'mobi', 'azw', 'epub', 'azw3', 'fb2', 'fbz', 'azw4',  'prc', 'odt', 'lrf', 'pdb',  'cbz', 'pml', 'rb', 'cbr', 'cb7', 'cbc', 'chm', 'djvu', 'snb', 'tcr', 'pdf', 'docx', 'rtf', 'html', 'htmlz', 'txtz', 'txt'}
         self.supported_audiobook_formats = {'m4a', 'm4b', 'mp4'}
-        self.ingest_folder, self.library_dir, self.tmp_conversion_dir = self.get_dirs("/app/autocaliweb/dirs.json")
+        self.ingest_folder, self.library_dir, self.tmp_conversion_dir = dirs if dirs else get_dirs(DIRS_JSON)
 
         # Create the tmp_conversion_dir if it does not already exist
         Path(self.tmp_conversion_dir).mkdir(exist_ok=True)
-        
+        # Every book gets its own directory for the conversion results, books are converted in parallel
+        self.work_dir = tempfile.mkdtemp(dir=self.tmp_conversion_dir) + "/"
+
         self.filepath = filepath # path of the book we're targeting
+        self.source = filepath # path the book was queued with, before a too long name got shortened
         self.filename = os.path.basename(filepath)
         self.is_target_format = bool(self.filepath.endswith(self.target_format))
         self.can_convert, self.input_format = self.can_convert_check()
+        self.is_audiobook = False
+        self.import_path = None # file added to the library once the book is prepared
+        self.book_ids = [] # ids calibredb reported for the imported book
 
         self.calibre_env = os.environ.copy()
         self.calibre_env['HOME'] = "/config"
 
-        self.split_library = self.get_split_library()
+        self.metadata_db = os.path.join(self.library_dir, 'metadata.db')
+        self.split_library = get_split_library()
         if self.split_library:
             self.library_dir = self.split_library['split_path']
-            self.calibre_env["CALIBRE_OVERRIDE_DATABASE_PATH"] = os.path.join(self.split_library['db_path'], 'metadata.db')
-
-    def get_split_library(self) -> dict[str, str] | None:
-        con = sqlite3.connect(f"/config/app.db")
-        cur = con.cursor()
-        split_library = cur.execute("SELECT config_calibre_split FROM settings;").fetchone()[0]
-
-        if split_library:
-            split_path = cur.execute("SELECT config_calibre_split_dir FROM settings;").fetchone()[0]
-            db_path = cur.execute("SELECT config_calibre_dir FROM settings;").fetchone()[0]
-            con.close()
-            return {
-                "split_path": split_path,
-                "db_path": db_path
-            }
-        else:
-            con.close()
-            return None
-        
-    def wait_for_file_stable(filepath, stable_seconds=5, timeout=120):
-        """Waits for a file to become stable, meaning it hasn't changed in size for a certain period of time."""
-        last_size = -1
-        stable_time = 0
-        start_time = time.time()
-
-        while True:
-            try: 
-                current_size = os.path.getsize(filepath)
-            except FileNotFoundError:
-                current_size = -1
-
-            if current_size == last_size and current_size != -1:
-                stable_time += 1
-            else:
-                stable_time = 0
-                last_size = current_size
-
-            if stable_time >= stable_seconds:
-                break
-
-            if time.time() - start_time > timeout:
-                raise TimeoutError(f"File {filepath} did not stabilize within {timeout} seconds.")
-            
-            time.sleep(1)
-
-    def get_dirs(self, dirs_json_path: str) -> tuple[str, str, str]:
-        dirs = {}
-        with open(dirs_json_path, 'r') as f:
-            dirs: dict[str, str] = json.load(f)
-
-        ingest_folder = f"{dirs['ingest_folder']}/"
-        library_dir = f"{dirs['calibre_library_dir']}/"
-        tmp_conversion_dir = f"{dirs['tmp_conversion_dir']}/"
-
-        return ingest_folder, library_dir, tmp_conversion_dir
+            self.metadata_db = os.path.join(self.split_library['db_path'], 'metadata.db')
+            self.calibre_env["CALIBRE_OVERRIDE_DATABASE_PATH"] = self.metadata_db
 
 
     def can_convert_check(self) -> tuple[bool, str]:
@@ -139,7 +265,7 @@ class NewBookProcessor:
         if input_format in self.supported_book_formats:
             can_convert = True
         return can_convert, input_format
-    
+
     def is_supported_audiobook(self) -> bool:
         input_format = Path(self.filepath).suffix[1:]
         if input_format in self.supported_audiobook_formats:
@@ -158,6 +284,41 @@ class NewBookProcessor:
             print(f"[ingest-processor]: ERROR - The following error occurred when trying to copy {input_file} to {output_path}:\n{e}")
 
 
+    @property
+    def is_ignored(self) -> bool:
+        """The user has chosen to exclude files of this type from the ingest process, or the file is still being
+        downloaded"""
+        return Path(self.filename).suffix in self.ingest_ignored_formats
+
+    def prepare(self) -> str | None:
+        """Converts the book to the target format if required and returns the path of the file to import into the
+        library, None if the book can't be imported"""
+        if self.is_target_format: # File can just be imported
+            print(f"\n[ingest-processor]: No conversion needed for {self.filename}, importing now...", flush=True)
+            return self.fix_epub(self.filepath)
+        elif self.is_supported_audiobook():
+            print(f"\n[ingest-processor]: No Conversion needed, Audiobook detected, importing now...", flush=True)
+            self.is_audiobook = True
+            return self.filepath
+        elif self.auto_convert_on and self.can_convert: # File can be converted to target format and Auto-Converter is on
+            if self.input_format in self.convert_ignored_formats: # File could be converted & the converter is activated but the user has specified files of this format should not be converted
+                print(f"\n[ingest-processor]: {self.filename} not in target format but user has told ACW not to convert this format so importing the file anyway...", flush=True)
+                return self.fix_epub(self.filepath)
+            elif self.target_format == "kepub": # File is not in the convert ignore list and target is kepub, so we start the kepub conversion process
+                convert_successful, converted_filepath = self.convert_to_kepub()
+            else: # File is not in the convert ignore list and target is not kepub, so we start the regular conversion process
+                convert_successful, converted_filepath = self.convert_book()
+            if convert_successful:
+                return self.fix_epub(converted_filepath)
+            return None
+        elif self.can_convert and not self.auto_convert_on: # Books not in target format but Auto-Converter is off so files are imported anyway
+            print(f"\n[ingest-processor]: {self.filename} not in target format but ACW Auto-Convert is deactivated so importing the file anyway...", flush=True)
+            return self.fix_epub(self.filepath)
+        else:
+            print(f"[ingest-processor]: Cannot convert {self.filepath}. {self.input_format} is currently unsupported / is not a known ebook format.", flush=True)
+            return None
+
+
     def convert_book(self, end_format=None) -> tuple[bool, str]:
         """Uses the following terminal command to convert the books provided using the calibre converter tool:\n\n--- ebook-convert myfile.input_format myfile.output_format\n\nAnd then saves the resulting files to the autocaliweb import folder."""
         print(f"[ingest-processor]: Starting conversion process for {self.filename}...", flush=True)
@@ -168,10 +329,10 @@ class NewBookProcessor:
             end_format = self.target_format # If end_format isn't given, the file is converted to the target format specified in the ACW Settings page
 
         original_filepath = Path(self.filepath)
-        target_filepath = f"{self.tmp_conversion_dir}{original_filepath.stem}.{end_format}"
+        target_filepath = f"{self.work_dir}{original_filepath.stem}.{end_format}"
         try:
             t_convert_book_start = time.time()
-            subprocess.run(['ebook-convert', self.filepath, target_filepath], env=self.calibre_env, check=True)
+            subprocess.run(['ebook-convert', self.filepath, target_filepath], env=self.calibre_env, check=True, timeout=SUBPROCESS_TIMEOUT)
             t_convert_book_end = time.time()
             time_book_conversion = t_convert_book_end - t_convert_book_start
             print(f"\n[ingest-processor]: END_CON: Conversion of {self.filename} complete in {time_book_conversion:.2f} seconds.\n", flush=True)
@@ -190,6 +351,10 @@ class NewBookProcessor:
             print(f"\n[ingest-processor]: CON_ERROR: {self.filename} could not be converted to {end_format} due to the following error:\nEXIT/ERROR CODE: {e.returncode}\n{e.stderr}", flush=True)
             self.backup(self.filepath, backup_type="failed")
             return False, ""
+        except subprocess.TimeoutExpired:
+            print(f"\n[ingest-processor]: CON_ERROR: TIMEOUT: Converting {self.filename} to {end_format} took longer than {SUBPROCESS_TIMEOUT} seconds", flush=True)
+            self.backup(self.filepath, backup_type="failed")
+            return False, ""
 
 
     # Kepubify can only convert EPUBs to Kepubs
@@ -203,13 +368,13 @@ class NewBookProcessor:
             print("\n[ingest-processor]: *** NOTICE TO USER: Kepubify is limited in that it can only convert from epubs. To get around this, ACW will automatically convert other"
             "supported formats to epub using the Calibre's conversion tools & then use Kepubify to produce your desired kepubs. Obviously multi-step conversions aren't ideal"
             "so if you notice issues with your converted files, bare in mind starting with epubs will ensure the best possible results***\n", flush=True)
-            convert_successful, converted_filepath = self.convert_book(self.input_format, end_format="epub") # type: ignore
-            
+            convert_successful, converted_filepath = self.convert_book(end_format="epub")
+
         if convert_successful:
             converted_filepath = Path(converted_filepath)
-            target_filepath = f"{self.tmp_conversion_dir}{converted_filepath.stem}.kepub"
+            target_filepath = f"{self.work_dir}{converted_filepath.stem}.kepub"
             try:
-                subprocess.run(['kepubify', '--inplace', '--calibre', '--output', self.tmp_conversion_dir, converted_filepath], check=True)
+                subprocess.run(['kepubify', '--inplace', '--calibre', '--output', self.work_dir, converted_filepath], check=True, timeout=SUBPROCESS_TIMEOUT)
                 if self.acw_settings['auto_backup_conversions']:
                     self.backup(self.filepath, backup_type="converted")
 
@@ -226,6 +391,7 @@ class NewBookProcessor:
                 return False, ""
             except Exception as e:
                 print(f"[ingest-processor] ingest-processor ran into the following error:\n{e}", flush=True)
+                return False, ""
         else:
             print(f"[ingest-processor]: An error occurred when converting the original {self.input_format} to epub. Cancelling kepub conversion...", flush=True)
             return False, ""
@@ -233,24 +399,35 @@ class NewBookProcessor:
 
     def delete_current_file(self) -> None:
         """Deletes file just processed from ingest folder"""
-        os.remove(self.filepath) # Removes processed file
-        if not os.path.samefile(os.path.dirname(self.filepath), self.ingest_folder): # File is not on ingest_folder, subdirectories to delete
+        try:
+            os.remove(self.filepath) # Removes processed file
+        except FileNotFoundError:
+            return
+        if os.path.isdir(os.path.dirname(self.filepath)) and not os.path.samefile(os.path.dirname(self.filepath), self.ingest_folder): # File is not on ingest_folder, subdirectories to delete
             subprocess.run(["find", f"{os.path.dirname(self.filepath)}", "-type", "d", "-empty", "-delete"]) # Removes any now empty folders including the parent directory
 
 
-    def add_book_to_library(self, book_path:str, text: bool=True, format: str="text") -> None:
+    def fix_epub(self, book_path: str) -> str:
+        """Runs the kindle epub fixer if enabled and returns the path of the fixed epub"""
         if self.target_format == "epub" and self.is_kindle_epub_fixer:
-            self.run_kindle_epub_fixer(book_path, dest=self.tmp_conversion_dir)
-            fixed_epub_path = Path(self.tmp_conversion_dir) / os.path.basename(book_path)
+            self.run_kindle_epub_fixer(book_path, dest=self.work_dir)
+            fixed_epub_path = Path(self.work_dir) / os.path.basename(book_path)
             if Path(fixed_epub_path).exists():
                 book_path = str(fixed_epub_path)
+        return book_path
+
 
+    def calibredb_add_command(self, book_paths: list[str]) -> list[str]:
+        return ["calibredb", "add", *book_paths, "--automerge", self.acw_settings['auto_ingest_automerge'], f"--library-path={self.library_dir}"]
+
+
+    def add_book_to_library(self, book_path:str, text: bool=True, format: str="text") -> bool:
         print("[ingest-processor]: Importing new book to ACW...")
         import_path = Path(book_path)
-        import_filename = os.path.basename(book_path)
         try:
             if text:
-                subprocess.run(["calibredb", "add", book_path, "--automerge", self.acw_settings['auto_ingest_automerge'], f"--library-path={self.library_dir}"], env=self.calibre_env, check=True)
+                result = subprocess.run(self.calibredb_add_command([book_path]), env=self.calibre_env, check=True,
+                                        timeout=SUBPROCESS_TIMEOUT, stdout=subprocess.PIPE, text=True)
                 print(f"[ingest-processor] Added {import_path.stem} to Calibre database", flush=True)
             else:
                 meta = audiobook.get_audio_file_info(book_path, format, os.path.basename(book_path), False)
@@ -259,33 +436,47 @@ class NewBookProcessor:
                     for i in meta[12]:
                         identifiers = identifiers + " " + i
 
-                subprocess.run(
+                result = subprocess.run(
                     [
-                        "calibredb", "add", book_path, "--automerge", self.acw_settings['auto_ingest_automerge'], 
-                        "--title", meta[2], 
-                        "--authors", meta[3], 
-                        "--cover", meta[4], 
-                        "--tags", meta[6], 
-                        "--series", meta[7], 
-                        "--series_index", meta[8], 
-                        "--language", meta[9], 
-                        "identifiers", identifiers, 
+                        "calibredb", "add", book_path, "--automerge", self.acw_settings['auto_ingest_automerge'],
+                        "--title", meta[2],
+                        "--authors", meta[3],
+                        "--cover", meta[4],
+                        "--tags", meta[6],
+                        "--series", meta[7],
+                        "--series_index", meta[8],
+                        "--language", meta[9],
+                        "identifiers", identifiers,
                         f"--library-path={self.library_dir}"
-                    ], 
-                    check=True
+                    ],
+                    check=True,
+                    timeout=SUBPROCESS_TIMEOUT,
+                    stdout=subprocess.PIPE,
+                    text=True
                 )
 
-            if self.acw_settings['auto_backup_imports']:
-                self.backup(book_path, backup_type="imported")
-
-            self.db.import_add_entry(import_path.stem,
-                                    str(self.acw_settings["auto_backup_imports"]))
+            print(result.stdout, end="", flush=True)
+            self.book_ids = parse_calibredb_book_ids(result.stdout)
+            self.book_imported(book_path)
+            return True
 
         except subprocess.CalledProcessError as e:
             print(f"[ingest-processor] {import_path.stem} was not able to be added to the Calibre Library due to the following error:\nCALIBREDB EXIT/ERROR CODE: {e.returncode}\n{e.stderr}", flush=True)
             self.backup(book_path, backup_type="failed")
+        except subprocess.TimeoutExpired:
+            print(f"[ingest-processor] TIMEOUT: Adding {import_path.stem} to the Calibre Library took longer than {SUBPROCESS_TIMEOUT} seconds", flush=True)
+            self.backup(book_path, backup_type="failed")
         except Exception as e:
             print(f"[ingest-processor] ingest-processor ran into the following error:\n{e}", flush=True)
+        return False
+
+
+    def book_imported(self, book_path: str) -> None:
+        if self.acw_settings['auto_backup_imports']:
+            self.backup(book_path, backup_type="imported")
+
+        self.db.import_add_entry(Path(book_path).stem,
+                                str(self.acw_settings["auto_backup_imports"]))
 
 
     def run_kindle_epub_fixer(self, filepath:str, dest=None) -> None:
@@ -296,89 +487,400 @@ class NewBookProcessor:
             print(f"[ingest-processor] An error occurred while processing {os.path.basename(filepath)} with the kindle-epub-fixer. See the following error:\n{e}")
 
 
-    def empty_tmp_con_dir(self):
+    def empty_work_dir(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def set_library_permissions(self, book_ids: list[int], since: float) -> None:
+        """Sets the ownership of the book folders created or changed by the import, the folders of merged books are
+        only known from the ids calibredb reported, new folders are also found by their modification time"""
+        book_dirs = []
         try:
-            files = os.listdir(self.tmp_conversion_dir)
-            for file in files:
-                file_path = os.path.join(self.tmp_conversion_dir, file)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-        except OSError:
-            print(f"[ingest-processor] An error occurred while emptying {self.tmp_conversion_dir}.", flush=True)
+            book_dirs = get_book_dirs(self.library_dir, self.metadata_db, book_ids)
+        except sqlite3.Error as e:
+            print(f"[ingest-processor] Looking up the folders of the imported books failed: {e}", flush=True)
+        try:
+            book_dirs.extend(get_changed_book_dirs(self.library_dir, since))
+        except OSError as e:
+            print(f"[ingest-processor] Looking for changed folders in {self.library_dir} failed: {e}", flush=True)
+        fix_library_permissions(self.library_dir, book_dirs, log=lambda message: print(message, flush=True))
+
+
+class IngestStatus:
+    """Queue depth and timings of the ingest stages, published in acw.db for the web UI"""
+    stages = ("stabilize", "convert", "import")
+
+    def __init__(self, workers: int):
+        self.lock = threading.Lock()
+        self.workers = workers
+        self.stabilizing = 0 # waiting for the writes to the file to end
+        self.queued = 0 # waiting for a worker
+        self.active = {} # file -> (stage, start)
+        self.ready = 0 # prepared, waiting for calibredb add
+        self.imported = 0
+        self.failed = 0
+        self.batches = 0
+        self.timings = {stage: {"count": 0, "total": 0.0, "last": 0.0} for stage in self.stages}
+        self.version = 0
+
+    def changed(self):
+        self.version += 1
+
+    @contextmanager
+    def stage(self, stage: str, files: list[str], count: int = 1):
+        """Marks the files as being in the given stage and records the time the stage took per book"""
+        start = time.monotonic()
+        with self.lock:
+            for filename in files:
+                self.active[filename] = (stage, time.time())
+            self.changed()
+        try:
+            yield
+        finally:
+            with self.lock:
+                for filename in files:
+                    self.active.pop(filename, None)
+            self.record(stage, time.monotonic() - start, count)
+
+    def record(self, stage: str, duration: float, count: int = 1):
+        with self.lock:
+            timing = self.timings[stage]
+            timing["count"] += count
+            timing["total"] += duration
+            timing["last"] = duration / max(count, 1)
+            self.changed()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            now = time.time()
+            return {
+                "pid": os.getpid(),
+                "workers": self.workers,
+                "stabilizing": self.stabilizing,
+                "queued": self.queued,
+                "in_progress": [{"file": os.path.basename(filename), "stage": stage, "seconds": round(now - start, 1)}
+                                for filename, (stage, start) in self.active.items()],
+                "waiting_for_import": self.ready,
+                "imported": self.imported,
+                "failed": self.failed,
+                "import_batches": self.batches,
+                "stages": {stage: {"count": timing["count"],
+                                   "average_seconds": round(timing["total"] / timing["count"], 2) if timing["count"] else 0.0,
+                                   "last_seconds": round(timing["last"], 2)}
+                           for stage, timing in self.timings.items()},
+            }
+
 
-    def set_library_permissions(self):
+class IngestPipeline:
+    """Waits for new books to be written completely, converts them on a pool of workers and adds the prepared books
+    to the library in batches
+
+    Used by the ingest daemon for the files reported by inotifywait and by a one-off run for a whole folder"""
+    def __init__(self, workers: int = INGEST_WORKERS, daemon: bool = False):
+        self.daemon = daemon
+        self.dirs = get_dirs(DIRS_JSON)
+        self.status = IngestStatus(workers)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest-worker")
+        self.ready = queue.Queue()
+        self.local = threading.local()
+        self.lock = threading.Condition()
+        self.pending = set()
+        self.holds_lock = False
+        self.stability = FileStabilityTracker(self.file_stable, self.file_dropped)
+
+        threading.Thread(target=self.import_books, name="ingest-importer", daemon=True).start()
+        if daemon:
+            threading.Thread(target=self.publish_status, name="ingest-status", daemon=True).start()
+
+    def acw_db(self) -> ACW_DB:
+        # sqlite connections can't be shared between threads, every thread keeps its own
+        if not hasattr(self.local, "db"):
+            self.local.db = ACW_DB()
+        return self.local.db
+
+    def submit(self, filepath: str) -> None:
+        """Queues a file, or all files of a directory as inotifywait doesn't report files of moved directories"""
+        if os.path.isdir(filepath):
+            for root, __, files in os.walk(filepath):
+                for filename in sorted(files):
+                    self.submit(os.path.join(root, filename))
+            return
+        if not os.path.exists(filepath):
+            return
+        with self.lock:
+            if filepath in self.pending:
+                # Another write to a file which is still settling restarts its quiescence window
+                self.stability.touch(filepath)
+                return
+            if self.daemon and not self.pending:
+                self.wait_for_lock()
+            self.pending.add(filepath)
+        with self.status.lock:
+            self.status.stabilizing += 1
+            self.status.changed()
+        if not self.stability.track(filepath):
+            self.file_dropped(filepath, None)
+
+    def file_stable(self, filepath: str, waited: float) -> None:
+        with self.status.lock:
+            self.status.stabilizing -= 1
+            self.status.queued += 1
+        self.status.record("stabilize", waited)
+        self.pool.submit(self.prepare_book, filepath)
+
+    def file_dropped(self, filepath: str, error: str | None) -> None:
+        with self.status.lock:
+            self.status.stabilizing -= 1
+        if error:
+            print(f"[ingest-processor] Skipping {filepath} due to timeout error: {error}", flush=True)
+        self.done(filepath, failed=bool(error))
+
+    def wait_for_lock(self) -> None:
+        """The daemon holds the lock while it has work, a library refresh running in the meantime is waited for"""
+        if self.holds_lock:
+            return
+        waiting = False
+        while not acquire_lock():
+            if not waiting:
+                print("[ingest-processor] Waiting for the running library refresh to finish...", flush=True)
+                waiting = True
+            time.sleep(1)
+        self.holds_lock = True
+
+    def done(self, filepath: str, failed: bool = False) -> None:
+        with self.status.lock:
+            if failed:
+                self.status.failed += 1
+            self.status.changed()
+        with self.lock:
+            self.pending.discard(filepath)
+            if not self.pending:
+                if self.daemon and self.holds_lock:
+                    removeLock()
+                    self.holds_lock = False
+                self.lock.notify_all()
+
+    def wait(self) -> None:
+        with self.lock:
+            while self.pending:
+                self.lock.wait()
+
+    def prepare_book(self, filepath: str) -> None:
+        with self.status.lock:
+            self.status.queued -= 1
+        nbp = None
         try:
-            subprocess.run(["chown", "-R", "abc:abc", self.library_dir], check=True)
-        except subprocess.CalledProcessError as e:
-            print(f"[ingest-processor] An error occurred while attempting to recursively set ownership of {self.library_dir} to abc:abc. See the following error:\n{e}", flush=True)
+            nbp = NewBookProcessor(shorten_filename(filepath), self.acw_db(), self.dirs)
+            nbp.source = filepath
+            if nbp.is_ignored:
+                # Ignored files stay in the ingest folder untouched
+                nbp.empty_work_dir()
+                self.done(filepath)
+                return
+            with self.status.stage("convert", [filepath]):
+                nbp.import_path = nbp.prepare()
+        except Exception as e:
+            print(f"[ingest-processor] ingest-processor ran into the following error while preparing {filepath}:\n{e}", flush=True)
+            if nbp:
+                nbp.empty_work_dir()
+            self.done(filepath, failed=True)
+            return
+
+        if nbp.import_path:
+            with self.status.lock:
+                self.status.ready += 1
+                self.status.changed()
+            self.ready.put(nbp)
+        else:
+            nbp.empty_work_dir()
+            nbp.delete_current_file()
+            self.done(filepath)
 
+    def import_books(self) -> None:
+        while True:
+            batch = [self.ready.get()]
+            deadline = time.monotonic() + IMPORT_BATCH_WAIT
+            while len(batch) < IMPORT_BATCH_SIZE:
+                with self.lock:
+                    # Nothing else is being prepared, no reason to wait for more books
+                    if len(self.pending) <= len(batch) and self.ready.empty():
+                        break
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.ready.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            with self.status.lock:
+                self.status.ready -= len(batch)
+            try:
+                self.import_batch(batch)
+            except Exception as e:
+                print(f"[ingest-processor] ingest-processor ran into the following error while importing:\n{e}", flush=True)
+                for nbp in batch:
+                    nbp.empty_work_dir()
+                    self.done(nbp.source, failed=True)
+
+    def import_batch(self, batch: list[NewBookProcessor]) -> None:
+        """Adds all books of the batch with a single calibredb call, if that fails the books are added one by one to
+        find the ones calibre rejects"""
+        for nbp in batch:
+            # The books were prepared on the worker threads, their import is recorded with the importer's connection
+            nbp.db = self.acw_db()
+        books = [nbp for nbp in batch if not nbp.is_audiobook]
+        audiobooks = [nbp for nbp in batch if nbp.is_audiobook]
+        imported = set()
+        # Folder timestamps may be rounded to the second
+        since = time.time() - 1
+        with self.status.stage("import", [nbp.source for nbp in batch], count=len(batch)):
+            if len(books) > 1:
+                print(f"[ingest-processor]: Importing {len(books)} new books to ACW...", flush=True)
+                timeout = SUBPROCESS_TIMEOUT + IMPORT_TIMEOUT_PER_BOOK * (len(books) - 1)
+                try:
+                    result = subprocess.run(books[0].calibredb_add_command([nbp.import_path for nbp in books]),
+                                            env=books[0].calibre_env, check=True, timeout=timeout,
+                                            stdout=subprocess.PIPE, text=True)
+                    print(result.stdout, end="", flush=True)
+                    books[0].book_ids = parse_calibredb_book_ids(result.stdout)
+                    for nbp in books:
+                        print(f"[ingest-processor] Added {Path(nbp.import_path).stem} to Calibre database", flush=True)
+                        nbp.book_imported(nbp.import_path)
+                        imported.add(nbp)
+                except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+                    print(f"[ingest-processor] Adding {len(books)} books at once failed ({e}), adding them one by one...", flush=True)
+                    # Books calibredb added before it failed would be added a second time
+                    for nbp, book_id in self.find_added_books(books, since).items():
+                        print(f"[ingest-processor] {Path(nbp.import_path).stem} was added to the Calibre database before the failure", flush=True)
+                        nbp.book_ids = [book_id]
+                        nbp.book_imported(nbp.import_path)
+                        imported.add(nbp)
+            for nbp in books:
+                if nbp not in imported and nbp.add_book_to_library(nbp.import_path):
+                    imported.add(nbp)
+            for nbp in audiobooks:
+                if nbp.add_book_to_library(nbp.import_path, False, Path(nbp.filename).suffix):
+                    imported.add(nbp)
+            batch[0].set_library_permissions([book_id for nbp in batch for book_id in nbp.book_ids], since)
+
+        with self.status.lock:
+            self.status.imported += len(imported)
+            self.status.batches += 1
+        for nbp in batch:
+            nbp.empty_work_dir()
+            nbp.delete_current_file()
+            self.done(nbp.source, failed=nbp not in imported)
+
+    @staticmethod
+    def find_added_books(books: list[NewBookProcessor], since: float) -> dict[NewBookProcessor, int]:
+        """Finds the books of a failed batch which are in the library already, by comparing their files with the files
+        of the book folders changed since the batch started. Returns the book id of every book found"""
+        found = {}
+        by_size = {}
+        for nbp in books:
+            try:
+                by_size.setdefault(os.path.getsize(nbp.import_path), []).append(nbp)
+            except OSError:
+                continue
+        try:
+            book_dirs = get_changed_book_dirs(books[0].library_dir, since)
+        except OSError as e:
+            print(f"[ingest-processor] Looking for changed folders in {books[0].library_dir} failed: {e}", flush=True)
+            return found
+        digests = {}
+        for book_dir in book_dirs:
+            book_id = re.search(r"\((\d+)\)$", book_dir)
+            if not book_id:
+                continue
+            for entry in os.scandir(book_dir):
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                candidates = [nbp for nbp in by_size.get(entry.stat().st_size, []) if nbp not in found]
+                if not candidates:
+                    continue
+                digest = file_digest(entry.path)
+                for nbp in candidates:
+                    if nbp not in digests:
+                        digests[nbp] = file_digest(nbp.import_path)
+                    if digests[nbp] == digest:
+                        found[nbp] = int(book_id.group(1))
+                        break
+        return found
+
+    def publish_status(self) -> None:
+        published = None
+        while True:
+            if published != self.status.version:
+                published = self.status.version
+                try:
+                    self.acw_db().set_ingest_status(json.dumps(self.status.snapshot()))
+                except Exception as e:
+                    print(f"[ingest-processor] Updating the ingest status in acw.db failed: {e}", flush=True)
+            time.sleep(STATUS_INTERVAL)
 
-def main(filepath=sys.argv[1]):
-    """Checks if filepath is a directory. If it is, main will be ran on every file in the given directory
-    Inotifywait won't detect files inside folders if the folder was moved rather than copied"""
-    
-    MAX_LENGTH = 150
-    filename = os.path.basename(filepath)
-    name, ext = os.path.splitext(filename)
-    allowed_len = MAX_LENGTH - len(ext)
 
-    if len(name) > allowed_len:
-        new_name = name[:allowed_len] + ext
-        new_path = os.path.join(os.path.dirname(filepath), new_name)
-        os.rename(filepath, new_path)
-        filepath = new_path
-
-    if os.path.isdir(filepath) and Path(filepath).exists():
-        # print(os.listdir(filepath))
-        for filename in os.listdir(filepath):
-            f = os.path.join(filepath, filename)
-            if Path(f).exists():
-                main(f)
-        return
-    
-    try:
-        self.wait_for_file_stable(filepath)
-    except TimeoutError as e:
-        print(f"[ingest-processor] Skipping {filepath} due to timeout error: {e}", flush=True)
-        return
+def file_digest(filepath: str) -> str:
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-    nbp = NewBookProcessor(filepath)
 
-    # Check if the user has chosen to exclude files of this type from the ingest process
-    if Path(nbp.filename).suffix in nbp.ingest_ignored_formats:
-        pass
-    else:
-        if nbp.is_target_format: # File can just be imported
-            print(f"\n[ingest-processor]: No conversion needed for {nbp.filename}, importing now...", flush=True)
-            nbp.add_book_to_library(filepath)
-        elif nbp.is_supported_audiobook():
-            print(f"\n[ingest-processor]: No Conversion needed, Audiobook detected, importing now...", flush=True)
-            nbp.add_book_to_library(filepath, False, Path(nbp.filename).suffix)
-        else:
-            if nbp.auto_convert_on and nbp.can_convert: # File can be converted to target format and Auto-Converter is on
-
-                if nbp.input_format in nbp.convert_ignored_formats: # File could be converted & the converter is activated but the user has specified files of this format should not be converted
-                    print(f"\n[ingest-processor]: {nbp.filename} not in target format but user has told ACW not to convert this format so importing the file anyway...", flush=True)
-                    nbp.add_book_to_library(filepath)
-                    convert_successful = False
-                elif nbp.target_format == "kepub": # File is not in the convert ignore list and target is kepub, so we start the kepub conversion process
-                    convert_successful, converted_filepath = nbp.convert_to_kepub()
-                else: # File is not in the convert ignore list and target is not kepub, so we start the regular conversion process
-                    convert_successful, converted_filepath = nbp.convert_book()
-                    
-                if convert_successful: # If previous conversion process was successful, remove tmp files and import into library
-                    nbp.add_book_to_library(converted_filepath) # type: ignore
-
-            elif nbp.can_convert and not nbp.auto_convert_on: # Books not in target format but Auto-Converter is off so files are imported anyway
-                print(f"\n[ingest-processor]: {nbp.filename} not in target format but ACW Auto-Convert is deactivated so importing the file anyway...", flush=True)
-                nbp.add_book_to_library(filepath)
+def empty_tmp_con_dir(tmp_conversion_dir: str) -> None:
+    try:
+        for entry in os.scandir(tmp_conversion_dir):
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
             else:
-                print(f"[ingest-processor]: Cannot convert {nbp.filepath}. {nbp.input_format} is currently unsupported / is not a known ebook format.", flush=True)
+                os.remove(entry.path)
+    except OSError:
+        print(f"[ingest-processor] An error occurred while emptying {tmp_conversion_dir}.", flush=True)
+
+
+def run_daemon(workers: int) -> None:
+    """Reads the events of 'inotifywait -m --format="%e %w%f"' from stdin and ingests the reported files until stdin
+    is closed"""
+    pipeline = IngestPipeline(workers, daemon=True)
+    empty_tmp_con_dir(pipeline.dirs[2])
+    atexit.register(lambda: pipeline.holds_lock and removeLock())
+    print(f"[ingest-processor] Ingest daemon started with {workers} workers, watching {pipeline.dirs[0]}", flush=True)
+    if PERMISSION_SWEEP_HOURS > 0:
+        split_library = get_split_library()
+        library_dir = split_library['split_path'] if split_library else pipeline.dirs[1]
+        PermissionSweeper(library_dir, log=lambda message: print(message, flush=True)).start()
+    for line in sys.stdin:
+        line = line.rstrip("\n")
+        if not line:
+            continue
+        events, __, filepath = line.partition(" ")
+        if not filepath:
+            continue
+        print(f"[ingest-processor] New file detected ({events}) - {filepath}", flush=True)
+        pipeline.submit(filepath)
+    pipeline.wait()
+
+
+def main(filepath=None, workers=INGEST_WORKERS):
+    """Ingests a single file or every file of the given directory, then exits"""
+    if not acquire_lock():
+        print("[ingest-processor] CANCELLING... ingest-processor initiated but is already running")
+        sys.exit(2)
+    atexit.register(removeLock)
+
+    pipeline = IngestPipeline(workers)
+    pipeline.submit(filepath)
+    pipeline.wait()
 
-        nbp.empty_tmp_con_dir()
-        nbp.set_library_permissions()
-        nbp.delete_current_file()
-        del nbp # New in Version 2.0.0, should drastically reduce memory usage with large ingests
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Imports new books from the ingest folder into the Calibre library")
+    parser.add_argument("filepath", nargs="?", help="File or folder to ingest once")
+    parser.add_argument("--daemon", action="store_true", help="Keep running and ingest the files reported by inotifywait on stdin")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS, help="Number of books converted in parallel")
+    args = parser.parse_args()
+    if args.daemon:
+        run_daemon(max(1, args.workers))
+    elif args.filepath:
+        main(args.filepath, max(1, args.workers))
+    else:
+        parser.error("either a filepath or --daemon is required")
@@ -0,0 +1,136 @@
+import grp
+import os
+import pwd
+import re
+import sqlite3
+import threading
+import time
+
+# Owner of everything inside the library
+USER_NAME = "abc"
+GROUP_NAME = "abc"
+
+# Interval of the background sweep over the whole library in hours, 0 disables it
+PERMISSION_SWEEP_HOURS = float(os.environ.get("ACW_PERMISSION_SWEEP_HOURS", 24))
+# Pause between two author folders of the sweep, keeps it from competing with imports and the web UI for the disk
+PERMISSION_SWEEP_PAUSE = 0.05
+
+
+def get_owner_ids() -> tuple[int, int] | None:
+    try:
+        return pwd.getpwnam(USER_NAME).pw_uid, grp.getgrnam(GROUP_NAME).gr_gid
+    except KeyError:
+        return None
+
+
+def set_ownership(path: str, owner: tuple[int, int], recursive: bool = False) -> int:
+    """Sets the owner of the path, and of everything below it if recursive, skipping entries which already have the
+    right owner. Returns the number of entries changed"""
+    changed = 0
+    paths = [path]
+    if recursive and os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            paths.extend(os.path.join(root, name) for name in dirs + files)
+    for entry in paths:
+        try:
+            stat = os.lstat(entry)
+            if (stat.st_uid, stat.st_gid) != owner:
+                os.chown(entry, *owner, follow_symlinks=False)
+                changed += 1
+        except FileNotFoundError:
+            continue
+    return changed
+
+
+def fix_library_permissions(library_dir: str, book_dirs: list[str], log=print) -> bool:
+    """Sets the ownership of the given book folders, their author folders and the files in the library root
+    (metadata.db and its journal) instead of walking the whole library"""
+    owner = get_owner_ids()
+    if not owner:
+        log(f"[library-permissions] User {USER_NAME}:{GROUP_NAME} doesn't exist, ownership of the library is left as is")
+        return False
+    changed = 0
+    try:
+        for entry in os.scandir(library_dir):
+            if entry.is_file(follow_symlinks=False):
+                changed += set_ownership(entry.path, owner)
+        for book_dir in set(book_dirs):
+            changed += set_ownership(os.path.dirname(os.path.normpath(book_dir)), owner)
+            changed += set_ownership(book_dir, owner, recursive=True)
+    except OSError as e:
+        log(f"[library-permissions] An error occurred while attempting to set ownership of {len(book_dirs)} book folders in {library_dir} to {USER_NAME}:{GROUP_NAME}. See the following error:\n{e}")
+        return False
+    if changed:
+        log(f"[library-permissions] Set ownership of {changed} files and folders in {len(set(book_dirs))} book folders to {USER_NAME}:{GROUP_NAME}")
+    return True
+
+
+def parse_calibredb_book_ids(output: str) -> list[int]:
+    """Returns the ids calibredb add reported as added or merged"""
+    book_ids = []
+    for match in re.finditer(r"book ids?: ([\d, ]+)", output or "", re.IGNORECASE):
+        book_ids.extend(int(book_id) for book_id in re.findall(r"\d+", match.group(1)))
+    return book_ids
+
+
+def get_book_dirs(library_dir: str, metadata_db: str, book_ids: list[int]) -> list[str]:
+    """Looks up the folders of the given books in metadata.db"""
+    book_dirs = []
+    if not book_ids:
+        return book_dirs
+    con = sqlite3.connect(f"file:{metadata_db}?mode=ro", uri=True)
+    try:
+        for index in range(0, len(book_ids), 500):
+            chunk = book_ids[index:index + 500]
+            rows = con.execute(f"SELECT path FROM books WHERE id IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+            book_dirs.extend(os.path.join(library_dir, row[0]) for row in rows)
+    finally:
+        con.close()
+    return book_dirs
+
+
+def get_changed_book_dirs(library_dir: str, since: float) -> list[str]:
+    """Finds the book folders created or changed since the given time, looking only at the folders whose modification
+    time changed on the way down from the library root"""
+    book_dirs = []
+    for author in os.scandir(library_dir):
+        if not author.is_dir(follow_symlinks=False) or author.stat().st_mtime < since:
+            continue
+        book_dirs.extend(book.path for book in os.scandir(author.path)
+                         if book.is_dir(follow_symlinks=False) and book.stat().st_mtime >= since)
+    return book_dirs
+
+
+class PermissionSweeper(threading.Thread):
+    """Sets the ownership of the whole library in the background, one author folder at a time, so files added behind
+    ACW's back are picked up eventually"""
+    def __init__(self, library_dir: str, interval_hours: float = PERMISSION_SWEEP_HOURS, log=print):
+        super().__init__(name="library-permission-sweep", daemon=True)
+        self.library_dir = library_dir
+        self.interval = interval_hours * 3600
+        self.log = log
+
+    def run(self) -> None:
+        while True:
+            self.sweep()
+            time.sleep(self.interval)
+
+    def sweep(self) -> None:
+        owner = get_owner_ids()
+        if not owner:
+            return
+        changed = 0
+        start = time.monotonic()
+        try:
+            entries = sorted(entry.path for entry in os.scandir(self.library_dir))
+        except OSError as e:
+            self.log(f"[library-permissions] Library sweep failed: {e}")
+            return
+        for path in entries:
+            try:
+                changed += set_ownership(path, owner, recursive=True)
+            except OSError as e:
+                self.log(f"[library-permissions] Library sweep couldn't set ownership of {path}: {e}")
+            time.sleep(PERMISSION_SWEEP_PAUSE)
+        changed += set_ownership(self.library_dir, owner)
+        self.log(f"[library-permissions] Library sweep set ownership of {changed} files and folders to {USER_NAME}:{GROUP_NAME} in {time.monotonic() - start:.1f} seconds")
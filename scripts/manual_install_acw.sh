@@ -1003,13 +1003,10 @@ INSTALL_PATH="${INSTALL_DIR}"
 WATCH_FOLDER=\$(grep -o '"ingest_folder": "[^"]*' \${INSTALL_PATH}/dirs.json | grep -o '[^"]*\$')
 echo "[acw-ingest-service] Watching folder: \$WATCH_FOLDER"
 
-# Monitor the folder for new files
+# Monitor the folder for new files, a single long running ingest processor converts and imports them
+# Use the Python interpreter from the virtual environment
 /usr/bin/inotifywait -m -r --format="%e %w%f" -e close_write -e moved_to "\$WATCH_FOLDER" |
-while read -r events filepath ; do
-    echo "[acw-ingest-service] New files detected - \$filepath - Starting Ingest Processor..."
-    # Use the Python interpreter from the virtual environment
-    \${INSTALL_PATH}/venv/bin/python \${INSTALL_PATH}/scripts/ingest_processor.py "\$filepath"
-done
+    \${INSTALL_PATH}/venv/bin/python \${INSTALL_PATH}/scripts/ingest_processor.py --daemon
 EOF
 
     # --- acw-ingest-service ---
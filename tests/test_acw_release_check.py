@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2025 Autocaliweb
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Runs the scheduled ACW release check against a releases endpoint served on localhost, once answering and once
+hanging past the timeout. Runs with pytest or as a script."""
+
+import builtins
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "scripts"))
+
+from cps import cli_param
+# gdriveutils opens its database on import, normally the path comes from the command line
+cli_param.gd_path = os.path.join(tempfile.mkdtemp(), "gdrive.db")
+from cps import render_template
+
+CURRENT_VERSION = "v1.0.0"
+RELEASE_TIMEOUT = 1
+
+
+class ReleasesHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/hanging":
+            time.sleep(RELEASE_TIMEOUT * 3)
+        body = json.dumps({"tag_name": "v1.1.0"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def run_check(release_url, version_file):
+    real_open = builtins.open
+
+    def release_open(path, *args, **kwargs):
+        return real_open(version_file if path == "/app/ACW_RELEASE" else path, *args, **kwargs)
+
+    acw_db = mock.Mock()
+    acw_db.return_value.acw_settings = {"acw_update_notifications": 1}
+    with mock.patch.object(render_template, "ACW_RELEASE_URL", release_url), \
+            mock.patch.object(render_template, "ACW_RELEASE_TIMEOUT", RELEASE_TIMEOUT), \
+            mock.patch.object(render_template, "ACW_DB", acw_db), \
+            mock.patch.object(builtins, "open", release_open):
+        render_template.check_acw_release()
+
+
+def test_release_check():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ReleasesHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = "http://127.0.0.1:{}".format(server.server_address[1])
+    state = render_template.acw_release
+    # the notice file is only read when nothing was checked yet
+    state.last_notification = "0001-01-01"
+    try:
+        with tempfile.NamedTemporaryFile("w", suffix="ACW_RELEASE") as version_file:
+            version_file.write(CURRENT_VERSION + "\n")
+            version_file.flush()
+
+            run_check(base_url + "/latest", version_file.name)
+            assert state.update_available
+            assert state.current_version == CURRENT_VERSION
+            assert state.tag_name == "v1.1.0"
+            checked = state.checked
+            assert checked is not None
+
+            # a notification shown while the check waits for GitHub keeps its date
+            check_release = render_template.acw_update_available
+
+            def notify_during_check():
+                result = check_release()
+                state.last_notification = "2025-01-01"
+                return result
+            with mock.patch.object(render_template, "acw_update_available", notify_during_check):
+                run_check(base_url + "/latest", version_file.name)
+            assert state.last_notification == "2025-01-01"
+            checked = state.checked
+
+            started = time.monotonic()
+            run_check(base_url + "/hanging", version_file.name)
+            assert time.monotonic() - started < RELEASE_TIMEOUT * 2
+            assert state.checked == checked
+            assert state.update_available and state.tag_name == "v1.1.0"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    test_release_check()
+    print("ok")
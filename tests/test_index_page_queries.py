@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2025 Autocaliweb
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Counts the queries of an index page at different page sizes, ordering the authors of the books on a page must not
+cost queries per book or author. Runs with pytest or as a script."""
+
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import uuid
+from unittest import mock
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from cps import cli_param
+# gdriveutils opens its database on import, normally the path comes from the command line
+cli_param.gd_path = os.path.join(tempfile.mkdtemp(), "gdrive.db")
+from cps import app, db, ub
+from sqlalchemy import event
+
+BOOKS = 300
+AUTHORS = 120
+PAGE_SIZES = (10, 30, 60, 120)
+
+
+class Config:
+    db_configured = False
+    config_books_per_page = 60
+    config_random_books = 4
+    config_read_column = 0
+    config_restricted_column = 0
+
+    def invalidate(self, error=None):
+        pass
+
+
+def make_library():
+    """Copies the empty library of the repository and adds books with one to three authors each, the author sort of
+    every book lists its authors in the order they were linked"""
+    library_dir = tempfile.mkdtemp()
+    for name in ("metadata.db", "app.db"):
+        shutil.copy(os.path.join(REPO_DIR, "library", name), library_dir)
+    con = sqlite3.connect(os.path.join(library_dir, "metadata.db"))
+    con.create_function("title_sort", 1, lambda title: title)
+    con.create_function("uuid4", 0, lambda: str(uuid.uuid4()))
+    for author in range(AUTHORS):
+        con.execute("INSERT INTO authors(name, sort) VALUES (?, ?)",
+                    ("First{0} Last{0}".format(author), "Last{0}, First{0}".format(author)))
+    shuffle = random.Random(1)
+    for book in range(BOOKS):
+        authors = shuffle.sample(range(1, AUTHORS + 1), shuffle.choice([1, 1, 2, 3]))
+        author_sort = " & ".join("Last{0}, First{0}".format(author - 1) for author in authors)
+        book_id = con.execute("INSERT INTO books(title, sort, author_sort, path, last_modified, has_cover) "
+                              "VALUES (?, ?, ?, ?, datetime('now'), 1)",
+                              ("Title {}".format(book), "Title {}".format(book), author_sort,
+                               "p/{}".format(book))).lastrowid
+        for author in authors:
+            con.execute("INSERT INTO books_authors_link(book, author) VALUES (?, ?)", (book_id, author))
+    con.commit()
+    con.close()
+    return library_dir
+
+
+def test_index_page_queries():
+    library_dir = make_library()
+    queries = []
+
+    def count_query(conn, cursor, statement, *args):
+        queries.append(statement)
+
+    ub.init_db(os.path.join(library_dir, "app.db"))
+    db.CalibreDB.update_config(Config(), library_dir, os.path.join(library_dir, "app.db"))
+    calibre_db = db.CalibreDB()
+    with app.app_context():
+        # the engine is created with the first session
+        calibre_db.session
+    event.listen(db.CalibreDB.engine, "before_cursor_execute", count_query)
+    try:
+        user = mock.MagicMock()
+        user.id = 1
+        user.show_detail_random.return_value = False
+        user.filter_language.return_value = "all"
+        user.list_denied_tags.return_value = [""]
+        user.list_allowed_tags.return_value = [""]
+        per_page = {}
+        with mock.patch("cps.db.current_user", user):
+            # the first page fills the caches of the counters
+            with app.app_context():
+                calibre_db.fill_indexpage(1, PAGE_SIZES[0], db.Books, True, [db.Books.timestamp.desc()])
+            for size in PAGE_SIZES:
+                with app.app_context():
+                    queries.clear()
+                    entries, __, __ = calibre_db.fill_indexpage(1, size, db.Books, True, [db.Books.timestamp.desc()])
+                    per_page[size] = len(queries)
+                    assert len(entries) == size
+                    for book in entries:
+                        assert " & ".join(author.sort for author in book.ordered_authors) == book.author_sort
+        assert len(set(per_page.values())) == 1, "queries per page size: {}".format(per_page)
+        return per_page
+    finally:
+        event.remove(db.CalibreDB.engine, "before_cursor_execute", count_query)
+        shutil.rmtree(library_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    print("queries per page size: {}".format(test_index_page_queries()))
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#    Copyright (C) 2025 Autocaliweb
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Sends a large book through TaskEmail to a local SMTP sink and checks the attachment is streamed from disk instead
+of being held in memory. Runs with pytest or as a script."""
+
+import email
+import email.policy
+import hashlib
+import json
+import os
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ATTACHMENT_MB = 64
+# The sending process may only grow by a fraction of the attachment size, a message built in memory holds the
+# attachment several times
+RSS_LIMIT_MB = 16
+
+SENDER = """
+import json, os, resource, sys
+sys.path.insert(0, sys.argv[1])
+from cps import cli_param
+cli_param.gd_path = os.path.join(sys.argv[2], "gdrive.db")
+import cps.helper
+import cps.tasks.mail as mail
+
+class Config:
+    config_use_google_drive = False
+    config_binariesdir = None
+    config_embed_metadata = False
+    def get_book_path(self):
+        return sys.argv[2]
+
+mail.config = Config()
+settings = {"mail_server_type": 0, "mail_server": "127.0.0.1", "mail_port": int(sys.argv[3]), "mail_use_ssl": 0,
+            "mail_login": "", "mail_password_e": "", "mail_from": "acw@example.com"}
+errors = []
+task = mail.TaskEmail("Large book", "book", "book.epub", settings, "reader@example.com", "Send", "Your book")
+task._handleSuccess = lambda: None
+task._handleError = errors.append
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+task.run(None)
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({"rss_growth_kb": after - before, "errors": [str(error) for error in errors]}))
+"""
+
+
+class SMTPSink(socketserver.StreamRequestHandler):
+    """Accepts every message and writes its DATA to the spool file of the server"""
+    def handle(self):
+        self.reply("220 sink")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.strip().upper()
+            if command.startswith(b"EHLO"):
+                self.reply("250-sink")
+                self.reply("250 SIZE 1000000000")
+            elif command == b"DATA":
+                self.reply("354 go ahead")
+                with open(self.server.spool, "wb") as spool:
+                    for data in iter(self.rfile.readline, b".\r\n"):
+                        spool.write(data[1:] if data.startswith(b"..") else data)
+                self.reply("250 queued")
+            elif command == b"QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("250 ok")
+
+    def reply(self, text):
+        self.wfile.write(text.encode() + b"\r\n")
+
+
+def test_attachment_is_streamed():
+    with tempfile.TemporaryDirectory() as work_dir:
+        book_dir = os.path.join(work_dir, "book")
+        os.mkdir(book_dir)
+        digest = hashlib.sha256()
+        with open(os.path.join(book_dir, "book.epub"), "wb") as book:
+            for __ in range(ATTACHMENT_MB):
+                data = os.urandom(1 << 20)
+                digest.update(data)
+                book.write(data)
+
+        server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), SMTPSink)
+        server.daemon_threads = True
+        server.spool = os.path.join(work_dir, "message.eml")
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            sender = subprocess.run([sys.executable, "-c", SENDER, REPO_DIR, work_dir, str(server.server_address[1])],
+                                    capture_output=True, text=True, timeout=300)
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert sender.returncode == 0, sender.stderr
+        result = json.loads(sender.stdout.strip().splitlines()[-1])
+        assert not result["errors"], result["errors"]
+
+        with open(server.spool, "rb") as spool:
+            message = email.message_from_binary_file(spool, policy=email.policy.default)
+        attachments = list(message.iter_attachments())
+        assert len(attachments) == 1
+        assert hashlib.sha256(attachments[0].get_content()).hexdigest() == digest.hexdigest()
+        assert result["rss_growth_kb"] < RSS_LIMIT_MB * 1024, \
+            "sending grew the process by {} MB".format(result["rss_growth_kb"] // 1024)
+
+
+if __name__ == "__main__":
+    test_attachment_is_streamed()
+    print("ok")